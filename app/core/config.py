@@ -5,6 +5,26 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def parse_rate_limits(spec: str) -> dict[str, tuple[float, float]]:
+    """Parse "type=rate:burst,..." (messages per second, bucket size) into a dict."""
+    limits = {}
+    for item in spec.split(","):
+        name, _, value = item.strip().partition("=")
+        if not name or not value:
+            continue
+        rate, _, burst = value.partition(":")
+        limits[name] = (float(rate), float(burst or rate))
+    return limits
+
+
+# Inbound token buckets per connection; "other" covers types without their own entry.
+# A joiner reports one peer-connection per peer at once, so its burst matches the default room cap.
+DEFAULT_RATE_LIMITS = (
+    "join=1:3,chat=5:10,history=2:5,roster-sync=2:5,offer=20:50,answer=20:50,ice=100:300,"
+    "mute=2:5,media-state=2:5,pitch=5:10,vad=10:20,batch=50:100,peer-connection=10:50,other=5:10"
+)
+
+
 class Settings(BaseModel):
     host: str = os.getenv("APP_HOST", "0.0.0.0")
     port: int = int(os.getenv("APP_PORT", "8000"))
@@ -24,6 +44,96 @@ class Settings(BaseModel):
     whop_product_id: str | None = os.getenv("WHOP_PRODUCT_ID")
     whop_company_id: str | None = os.getenv("WHOP_COMPANY_ID")
 
+    # Shared Whop HTTP pool and token verification cache
+    whop_http_max_connections: int = int(os.getenv("WHOP_HTTP_MAX_CONNECTIONS", "20"))
+    whop_token_cache_size: int = int(os.getenv("WHOP_TOKEN_CACHE_SIZE", "4096"))
+    whop_token_cache_ttl: float = float(os.getenv("WHOP_TOKEN_CACHE_TTL", "60"))
+    whop_token_cache_negative_ttl: float = float(os.getenv("WHOP_TOKEN_CACHE_NEGATIVE_TTL", "10"))
+    # Signing secret of the Whop webhook (whsec_...); deliveries without a valid signature get a 401
+    whop_webhook_secret: str | None = os.getenv("WHOP_WEBHOOK_SECRET")
+    # Largest age of a signed webhook, in seconds, before it is rejected as a replay
+    whop_webhook_tolerance: float = float(os.getenv("WHOP_WEBHOOK_TOLERANCE", "300"))
+    # Webhooks waiting for the ingest worker; deliveries beyond this get a 503 and are retried by Whop
+    whop_webhook_queue_size: int = int(os.getenv("WHOP_WEBHOOK_QUEUE_SIZE", "1000"))
+    # Recent webhook event ids remembered for deduplicating redeliveries
+    whop_webhook_dedup_size: int = int(os.getenv("WHOP_WEBHOOK_DEDUP_SIZE", "10000"))
+    # Deny joins from users the entitlement index has no webhook record of (else token validity suffices)
+    whop_require_entitlement: bool = os.getenv("WHOP_REQUIRE_ENTITLEMENT", "false").lower() == "true"
+
+    # Per-client outbound queue limits (see app.services.rooms.OutboundQueue)
+    send_queue_max: int = int(os.getenv("SEND_QUEUE_MAX", "256"))
+    send_queue_high_water: int = int(os.getenv("SEND_QUEUE_HIGH_WATER", "64"))
+    slow_consumer_timeout: float = float(os.getenv("SLOW_CONSUMER_TIMEOUT", "5"))
+
+    # Rate of the per-room telemetry frame (pitch + speaking) in Hz
+    telemetry_hz: float = float(os.getenv("TELEMETRY_HZ", "5"))
+    # Window over which ICE candidates for the same peer pair are bundled into one frame
+    ice_bundle_window_ms: float = float(os.getenv("ICE_BUNDLE_WINDOW_MS", "5"))
+
+    # Per-room chat history ring buffer (capped by both count and bytes)
+    chat_history_messages: int = int(os.getenv("CHAT_HISTORY_MESSAGES", "200"))
+    chat_history_bytes: int = int(os.getenv("CHAT_HISTORY_BYTES", "65536"))
+    chat_history_on_join: int = int(os.getenv("CHAT_HISTORY_ON_JOIN", "50"))
+    chat_history_page: int = int(os.getenv("CHAT_HISTORY_PAGE", "50"))
+
+    # Recent roster changes kept per room so clients can catch up on a version gap
+    roster_log_size: int = int(os.getenv("ROSTER_LOG_SIZE", "128"))
+
+    # Inbound rate limits (see app.services.limits); over-limit messages are dropped and count as strikes
+    rate_limits: dict[str, tuple[float, float]] = parse_rate_limits(os.getenv("RATE_LIMITS", DEFAULT_RATE_LIMITS))
+    # Connections collecting this many strikes within the window are disconnected (0 never disconnects)
+    rate_limit_max_strikes: int = int(os.getenv("RATE_LIMIT_MAX_STRIKES", "50"))
+    rate_limit_strike_window: float = float(os.getenv("RATE_LIMIT_STRIKE_WINDOW", "10"))
+
+    # Admission control; 0 means unlimited
+    max_room_participants: int = int(os.getenv("MAX_ROOM_PARTICIPANTS", "50"))
+    max_connections: int = int(os.getenv("MAX_CONNECTIONS", "5000"))
+
+    # Seconds a dropped client is held (and its messages buffered) for resumption; 0 disables
+    session_resume_grace: float = float(os.getenv("SESSION_RESUME_GRACE", "15"))
+
+    # Seconds of silence before the server pings a client (and the sweep period); 0 disables heartbeats
+    heartbeat_interval: float = float(os.getenv("HEARTBEAT_INTERVAL", "15"))
+
+    # Seconds without any inbound frame before a connection is treated as dead and reaped
+    heartbeat_timeout: float = float(os.getenv("HEARTBEAT_TIMEOUT", "45"))
+
+    # "memory" keeps rooms in this process; "bus" shares them across workers via app.services.bus
+    room_backend: str = os.getenv("ROOM_BACKEND", "memory").lower()
+    room_bus_url: str = os.getenv("ROOM_BUS_URL", "unix:///tmp/voice-chat-bus.sock")
+
+    # Selective forwarding (needs aiortc): "off", "auto" (rooms at or above SFU_THRESHOLD) or "always"
+    sfu_mode: str = os.getenv("SFU_MODE", "off").lower()
+    sfu_threshold: int = int(os.getenv("SFU_THRESHOLD", "6"))
+    # Rooms that always use the SFU, comma separated
+    sfu_rooms: list[str] = [r for r in os.getenv("SFU_ROOMS", "").split(",") if r]
+
+    # Upload budget per client (kbps) that the media policy splits across the streams it sends
+    media_uplink_kbps: int = int(os.getenv("MEDIA_UPLINK_KBPS", "2000"))
+    # Mesh rooms at or above this many participants go audio-only (0 never does)
+    media_audio_only_at: int = int(os.getenv("MEDIA_AUDIO_ONLY_AT", "12"))
+
+    # GET /rooms and /rooms/events list active rooms; set ROOM_DIRECTORY=false to hide them
+    room_directory: bool = os.getenv("ROOM_DIRECTORY", "true").lower() == "true"
+    room_directory_page_size: int = int(os.getenv("ROOM_DIRECTORY_PAGE_SIZE", "50"))
+    room_directory_max_page: int = int(os.getenv("ROOM_DIRECTORY_MAX_PAGE", "500"))
+    # Most directory change events per second on the SSE stream; changes in between are coalesced
+    room_directory_sse_hz: float = float(os.getenv("ROOM_DIRECTORY_SSE_HZ", "2"))
+
+    # Signaling trace for bench/replay.py (see app.services.trace): file to record to, empty for off.
+    # "{pid}" is replaced with the process id, so each worker gets its own file.
+    trace_file: str = os.getenv("TRACE_FILE", "")
+    # Recording stops once the file reaches this size
+    trace_max_mb: float = float(os.getenv("TRACE_MAX_MB", "256"))
+
+    # Default level for app logs, overridden per category ("ws=DEBUG,whop=WARNING")
+    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    log_levels: str = os.getenv("LOG_LEVELS", "")
+    # Fraction of records kept for high-frequency events ("ws.join=0.1,ws.rate-limited=0.01")
+    log_sampling: str = os.getenv("LOG_SAMPLING", "")
+    # "text" (key=value) or "json" (one object per line)
+    log_format: str = os.getenv("LOG_FORMAT", "text").lower()
+
 
 settings = Settings()
 
@@ -0,0 +1,184 @@
+"""Structured, non-blocking logging.
+
+Callers log an event name plus key/value fields:
+
+    log = get_logger("ws")
+    log.info("join", room=room_id, user=name)
+
+The calling coroutine only checks the level and sampling rate, redacts
+the fields and puts the record on a queue. A QueueListener thread
+formats it and writes it to stdout, so the event loop never blocks on
+I/O. Levels are set per category (LOG_LEVELS="ws=DEBUG,whop=WARNING"),
+and high-frequency events can be sampled (LOG_SAMPLING="ws.join=0.1").
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+import atexit
+import logging
+import queue
+import random
+import sys
+
+import orjson
+
+from app.core.config import settings
+
+
+ROOT_LOGGER = "voice"
+
+# Fields whose values are never written, only whether they were set
+SECRET_FIELDS = frozenset({
+    "token", "access_token", "refresh_token", "code", "client_secret", "authorization", "password", "secret",
+})
+# Fields that hold response bodies or other bulk data; only their size is written
+BODY_FIELDS = frozenset({"body", "response", "raw"})
+# Longer field values are truncated
+MAX_FIELD_CHARS = 200
+
+_listener: Optional[QueueListener] = None
+
+
+class _Handler(QueueHandler):
+    """Enqueue records as-is; formatting happens on the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_lines: bool = False) -> None:
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds")
+        category = record.name[len(ROOT_LOGGER) + 1:] or ROOT_LOGGER
+        fields: Dict[str, Any] = getattr(record, "fields", None) or {}
+        error = self.formatException(record.exc_info) if record.exc_info else None
+        if self.json_lines:
+            line = {"ts": timestamp, "level": record.levelname, "category": category, "event": record.getMessage()}
+            line.update(fields)
+            if error:
+                line["exception"] = error
+            return orjson.dumps(line, default=str).decode()
+        parts = [timestamp, record.levelname, category, record.getMessage()]
+        parts += [f"{key}={_text_value(value)}" for key, value in fields.items()]
+        text = " ".join(parts)
+        return f"{text}\n{error}" if error else text
+
+
+def _text_value(value: Any) -> str:
+    text = value if isinstance(value, str) else str(value)
+    if not text or any(c in text for c in ' "=\n'):
+        return orjson.dumps(text).decode()
+    return text
+
+
+def redact(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop secrets and bulk bodies from log fields, and truncate long values."""
+    clean = {}
+    for key, value in fields.items():
+        if key in SECRET_FIELDS:
+            value = "[redacted]" if value else ""
+        elif key in BODY_FIELDS and value is not None:
+            value = f"<{len(value) if isinstance(value, (str, bytes)) else len(str(value))} bytes>"
+        elif isinstance(value, str) and len(value) > MAX_FIELD_CHARS:
+            value = value[:MAX_FIELD_CHARS] + "..."
+        clean[key] = value
+    return clean
+
+
+class StructuredLogger:
+    """A category logger taking an event name and key/value fields."""
+
+    __slots__ = ("category", "logger", "_sampling")
+
+    def __init__(self, category: str, sampling: Dict[str, float]) -> None:
+        self.category = category
+        self.logger = logging.getLogger(f"{ROOT_LOGGER}.{category}")
+        # event -> fraction of records kept
+        self._sampling = sampling
+
+    def log(self, level: int, event: str, /, exc_info: Any = None, **fields: Any) -> None:
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = self._sampling.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        if rate is not None and rate < 1:
+            fields["sampled"] = rate
+        self.logger.log(level, event, exc_info=exc_info, extra={"fields": redact(fields)})
+
+    def debug(self, event: str, /, **fields: Any) -> None:
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, /, **fields: Any) -> None:
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, /, **fields: Any) -> None:
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, /, **fields: Any) -> None:
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, /, **fields: Any) -> None:
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """Parse "category=LEVEL,..." into logging levels."""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.strip().partition("=")
+        if name and level:
+            levels[name] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def parse_sampling(spec: str) -> Dict[str, Dict[str, float]]:
+    """Parse "category.event=rate,..." into {category: {event: rate}}."""
+    sampling: Dict[str, Dict[str, float]] = {}
+    for item in spec.split(","):
+        name, _, rate = item.strip().partition("=")
+        category, _, event = name.partition(".")
+        if category and event and rate:
+            sampling.setdefault(category, {})[event] = float(rate)
+    return sampling
+
+
+_sampling = parse_sampling(settings.log_sampling)
+
+
+def get_logger(category: str) -> StructuredLogger:
+    return StructuredLogger(category, _sampling.get(category, {}))
+
+
+def setup_logging() -> None:
+    """Route the "voice" loggers through a queue to a background writer thread. Idempotent."""
+    global _listener
+    if _listener is not None:
+        return
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter(json_lines=settings.log_format == "json"))
+    _listener = QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.handlers[:] = [_Handler(records)]
+    root.setLevel(logging.getLevelName(settings.log_level.upper()))
+    root.propagate = False
+    for category, level in parse_levels(settings.log_levels).items():
+        logging.getLogger(f"{ROOT_LOGGER}.{category}").setLevel(level)
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
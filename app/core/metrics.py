@@ -0,0 +1,246 @@
+"""Minimal Prometheus text-format metrics, with no client library dependency.
+
+Metrics are module-level objects created once at import. Hot paths only do
+arithmetic on preallocated slots: a label lookup is a dict get on a
+fixed set of labels, and a histogram observation is a bisect plus two
+additions. Values that are cheap to read on demand (rooms, connected
+clients, room sizes) come from collectors that run at scrape time.
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# Seconds; covers an in-memory enqueue (~µs) up to a stalled event loop
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5)
+HTTP_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROOM_SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 25, 50, 100)
+# Seconds from join to a connected peer connection, as reported by browsers
+CONNECT_BUCKETS = (0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 20.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name} {_format_value(self.value)}"]
+
+
+class LabeledCounter(_Metric):
+    """Counter with one label whose values are fixed up front; anything else counts as `other`."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label: str, values: Iterable[str]) -> None:
+        super().__init__(name, help_text)
+        self.label = label
+        self.values: Dict[str, float] = {v: 0.0 for v in values}
+        self.values.setdefault("other", 0.0)
+
+    def inc(self, value: Optional[str], amount: float = 1) -> None:
+        if value in self.values:
+            self.values[value] += amount
+        else:
+            self.values["other"] += amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for value, count in self.values.items():
+            lines.append(f"{self.name}{_format_labels((self.label,), (value,))} {_format_value(count)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name} {_format_value(self.value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+        # Per-bucket (non-cumulative) counts; the last slot is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> List[str]:
+        return self.header() + render_histogram(self.name, self.buckets, self.counts, self.sum, self.count)
+
+
+def render_histogram(
+    name: str,
+    buckets: Sequence[float],
+    counts: Sequence[int],
+    total: float,
+    count: int,
+    labels: Tuple[Tuple[str, str], ...] = (),
+) -> List[str]:
+    names = [n for n, _ in labels]
+    values = [v for _, v in labels]
+    lines = []
+    cumulative = 0
+    for bound, n in zip(list(buckets) + ["+Inf"], counts):
+        cumulative += n
+        le = bound if bound == "+Inf" else _format_value(bound)
+        lines.append(f"{name}_bucket{_format_labels(names + ['le'], values + [le])} {cumulative}")
+    suffix = _format_labels(names, values)
+    lines.append(f"{name}_sum{suffix} {_format_value(total)}")
+    lines.append(f"{name}_count{suffix} {count}")
+    return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[_Metric] = []
+        # Called at scrape time; each returns ready-made exposition lines
+        self.collectors: List[Callable[[], List[str]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for collector in self.collectors:
+            lines += collector()
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Inbound message types worth their own label; anything else is counted as "other"
+INBOUND_TYPES = (
+    "join", "leave", "chat", "history", "offer", "answer", "ice", "mute", "media-state",
+    "pitch", "vad", "batch", "roster-sync", "ping", "pong", "peer-connection",
+)
+
+ws_connections = registry.register(Gauge("voice_ws_connections", "Open /ws connections"))
+inbound_messages = registry.register(LabeledCounter(
+    "voice_inbound_messages_total", "Signaling messages received, by type", "type", INBOUND_TYPES
+))
+broadcast_seconds = registry.register(Histogram(
+    "voice_broadcast_seconds", "Time spent in RoomService.broadcast (encode + enqueue for the room)"
+))
+send_to_seconds = registry.register(Histogram(
+    "voice_send_to_seconds", "Time spent in RoomService.send_to"
+))
+outbound_frames = registry.register(Counter("voice_outbound_frames_total", "Frames written to WebSockets"))
+outbound_bytes = registry.register(Counter(
+    "voice_outbound_bytes_total", "Payload size of frames written to WebSockets (characters for text frames)"
+))
+send_failures = registry.register(Counter("voice_send_failures_total", "WebSocket writes that raised"))
+evictions = registry.register(Counter("voice_evictions_total", "Clients dropped for not keeping up"))
+heartbeat_timeouts = registry.register(Counter(
+    "voice_heartbeat_timeouts_total", "Connections reaped after missing heartbeats"
+))
+rate_limited = registry.register(LabeledCounter(
+    "voice_rate_limited_total", "Inbound messages dropped by the per-connection rate limiter, by type", "type",
+    INBOUND_TYPES,
+))
+rejected_joins = registry.register(LabeledCounter(
+    "voice_rejected_joins_total", "Joins refused by admission control or rate limiting, by reason", "reason",
+    ("room-full", "server-full", "rate-limited"),
+))
+whop_verifications = registry.register(LabeledCounter(
+    "voice_whop_verifications_total", "Whop token verifications by outcome", "outcome",
+    ("cache_hit", "coalesced", "valid", "invalid", "error"),
+))
+whop_verify_seconds = registry.register(Histogram(
+    "voice_whop_verify_seconds", "Latency of Whop token verification requests", HTTP_LATENCY_BUCKETS
+))
+whop_webhooks = registry.register(LabeledCounter(
+    "voice_whop_webhooks_total", "Whop webhook deliveries by outcome", "outcome",
+    ("unauthorized", "queued", "queue_full", "invalid", "ignored", "duplicate", "stale", "applied"),
+))
+entitlement_revocations = registry.register(Counter(
+    "voice_entitlement_revocations_total", "Live sessions disconnected because their Whop access was revoked"
+))
+peer_connections = registry.register(LabeledCounter(
+    "voice_peer_connections_total", "Browser peer connections by outcome, as reported by clients", "outcome",
+    ("connected", "failed"),
+))
+peer_connect_seconds = registry.register(Histogram(
+    "voice_peer_connect_seconds",
+    "Time from a client joining (or seeing a peer join) to the peer connection reaching connected",
+    CONNECT_BUCKETS,
+))
+
+
+def room_size_lines(sizes: Iterable[int]) -> List[str]:
+    """Exposition lines for a room-size histogram computed at scrape time."""
+    name = "voice_room_size"
+    counts = [0] * (len(ROOM_SIZE_BUCKETS) + 1)
+    total = count = 0
+    for size in sizes:
+        counts[bisect_left(ROOM_SIZE_BUCKETS, size)] += 1
+        total += size
+        count += 1
+    return [
+        f"# HELP {name} Members per room (local and remote)",
+        f"# TYPE {name} histogram",
+    ] + render_histogram(name, ROOM_SIZE_BUCKETS, counts, total, count)
@@ -0,0 +1,303 @@
+"""Whop webhook ingestion and the local entitlement index.
+
+/whop/webhook checks the delivery's signature (Standard Webhooks headers,
+keyed with WHOP_WEBHOOK_SECRET), puts the raw body on a bounded queue and
+returns; without a secret every delivery is refused.
+A background worker drops deliveries it has already seen (by event id),
+applies membership events to an in-memory index of user -> active
+products, and disconnects live sessions whose access was revoked. Joins
+are then authorized from the index with a dict lookup instead of a call
+to Whop.
+
+The index only knows users it has had an event for since startup; for
+anyone else authorize_join falls back to token validity unless
+WHOP_REQUIRE_ENTITLEMENT is set. With ROOM_BACKEND=bus each event is
+also relayed to the other workers, so their indexes and sessions follow.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, Mapping, NamedTuple, Optional, Set, Tuple
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import time
+
+import orjson
+
+from app.core import metrics
+from app.core.config import settings
+from app.core.logging import get_logger
+
+if TYPE_CHECKING:
+    from app.services.rooms import RoomService
+
+log = get_logger("whop")
+
+# Membership webhook actions that start or end access; other membership.*
+# events are applied when they carry an explicit valid/status field
+GRANT_ACTIONS = frozenset({"membership.went_valid", "membership.activated", "membership_went_valid"})
+REVOKE_ACTIONS = frozenset({
+    "membership.went_invalid", "membership.deactivated", "membership.expired", "membership_went_invalid",
+})
+ACTIVE_STATUSES = frozenset({"active", "trialing", "completed"})
+
+# Backend event kind used to relay applied events to other workers
+ENTITLEMENT_EVENT = "entitlement"
+
+REVOKED_CLOSE_CODE = 1008
+
+
+class MembershipEvent(NamedTuple):
+    event_id: str
+    user_id: str
+    product_id: str
+    active: bool
+    # Epoch seconds, when the event says when it happened
+    at: Optional[float]
+
+
+class EntitlementIndex:
+    """user_id -> ids of the products the user currently has access to."""
+
+    def __init__(self) -> None:
+        # A known user with no active product maps to an empty set
+        self.products: Dict[str, Set[str]] = {}
+        # (user_id, product_id) -> time of the newest event applied for the pair
+        self._updated: Dict[Tuple[str, str], float] = {}
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def has(self, user_id: Optional[str], product_id: str) -> Optional[bool]:
+        """Whether the user has the product; None if no event about the user was seen."""
+        products = self.products.get(user_id) if user_id else None
+        if products is None:
+            return None
+        return product_id in products
+
+    def apply(self, user_id: str, product_id: str, active: bool, at: Optional[float] = None) -> bool:
+        """Record a grant or revocation. Returns False for an event older than one already applied."""
+        key = (user_id, product_id)
+        if at is not None:
+            previous = self._updated.get(key)
+            if previous is not None and at < previous:
+                return False
+            self._updated[key] = at
+        products = self.products.setdefault(user_id, set())
+        if active:
+            products.add(product_id)
+        else:
+            products.discard(product_id)
+        return True
+
+    def clear(self) -> None:
+        self.products.clear()
+        self._updated.clear()
+
+
+entitlements = EntitlementIndex()
+
+
+def parse_membership_event(body: Any, delivery_id: Optional[str] = None, raw: bytes = b"") -> Optional[MembershipEvent]:
+    """Extract (user, product, active) from a Whop webhook payload; None if it is not a membership change."""
+    if not isinstance(body, dict):
+        return None
+    action = str(body.get("action") or body.get("type") or "")
+    data = body.get("data")
+    if not isinstance(data, dict) or not action.startswith("membership"):
+        return None
+    if action in GRANT_ACTIONS:
+        active = True
+    elif action in REVOKE_ACTIONS:
+        active = False
+    elif isinstance(data.get("valid"), bool):
+        active = data["valid"]
+    elif isinstance(data.get("status"), str):
+        active = data["status"] in ACTIVE_STATUSES
+    else:
+        return None
+    user_id = data.get("user_id") or _nested_id(data.get("user"))
+    product_id = data.get("product_id") or _nested_id(data.get("product")) or _nested_id(data.get("access_pass"))
+    if not user_id or not product_id:
+        return None
+    # Redeliveries repeat the body, so its digest identifies them when no id is given
+    event_id = delivery_id or body.get("id") or hashlib.sha256(raw).hexdigest()
+    at = _timestamp(body.get("timestamp") or data.get("updated_at") or body.get("created_at"))
+    return MembershipEvent(str(event_id), str(user_id), str(product_id), active, at)
+
+
+def _nested_id(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        return value.get("id")
+    return value if isinstance(value, str) else None
+
+
+def _timestamp(value: Any) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Milliseconds are told apart from seconds by magnitude
+        return value / 1000.0 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def verify_webhook_signature(
+    body: bytes, headers: Mapping[str, str], secret: Optional[str] = None, now: Optional[float] = None
+) -> bool:
+    """Check the webhook-signature header against the raw body (Standard Webhooks, as Whop signs them).
+
+    The signed content is "{webhook-id}.{webhook-timestamp}.{body}", HMAC-SHA256 keyed with the
+    secret: base64-decoded after a "whsec_" prefix, else its UTF-8 bytes. Deliveries older or newer
+    than WHOP_WEBHOOK_TOLERANCE seconds are refused, and so is everything when no secret is set.
+    """
+    secret = secret if secret is not None else settings.whop_webhook_secret
+    delivery_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not secret or not delivery_id or not timestamp or not signatures:
+        return False
+    try:
+        sent_at = int(timestamp)
+    except ValueError:
+        return False
+    now = time.time() if now is None else now
+    if abs(now - sent_at) > settings.whop_webhook_tolerance:
+        return False
+    if secret.startswith("whsec_"):
+        try:
+            key = base64.b64decode(secret[len("whsec_"):])
+        except binascii.Error:
+            return False
+    else:
+        key = secret.encode()
+    signed = b"%s.%s.%s" % (delivery_id.encode(), timestamp.encode(), body)
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    # Space-separated "v1,<base64>" entries; any one matching is enough (secret rotation)
+    for entry in signatures.split():
+        version, _, signature = entry.partition(",")
+        if version == "v1" and hmac.compare_digest(signature, expected):
+            return True
+    return False
+
+
+class WebhookIngest:
+    """Bounded webhook queue, its worker and event-id deduplication."""
+
+    def __init__(
+        self,
+        room_service: "RoomService",
+        index: Optional[EntitlementIndex] = None,
+        queue_size: Optional[int] = None,
+        dedup_size: Optional[int] = None,
+    ) -> None:
+        self.room_service = room_service
+        self.index = index if index is not None else entitlements
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size or settings.whop_webhook_queue_size)
+        self.dedup_size = dedup_size or settings.whop_webhook_dedup_size
+        # Recently applied event ids, oldest first
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._worker: Optional[asyncio.Task] = None
+        room_service.add_event_listener(self.on_remote_event)
+
+    def submit(self, body: bytes, delivery_id: Optional[str] = None) -> bool:
+        """Queue a delivery for the worker. Returns False when the queue is full (Whop will retry)."""
+        try:
+            self.queue.put_nowait((body, delivery_id))
+        except asyncio.QueueFull:
+            metrics.whop_webhooks.inc("queue_full")
+            return False
+        metrics.whop_webhooks.inc("queued")
+        return True
+
+    async def start(self) -> None:
+        if not settings.whop_webhook_secret:
+            # /whop/webhook refuses every delivery until one is configured
+            log.warning("webhook-secret-unset")
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        worker, self._worker = self._worker, None
+        if worker:
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            body, delivery_id = await self.queue.get()
+            try:
+                await self.process(body, delivery_id)
+            except Exception as e:
+                log.exception("webhook-error", error=str(e))
+
+    async def process(self, body: bytes, delivery_id: Optional[str] = None) -> None:
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            metrics.whop_webhooks.inc("invalid")
+            log.warning("webhook-invalid", body=body)
+            return
+        action = payload.get("action") or payload.get("type") if isinstance(payload, dict) else None
+        event = parse_membership_event(payload, delivery_id, body)
+        if event is None:
+            metrics.whop_webhooks.inc("ignored")
+            log.info("webhook-ignored", action=action)
+            return
+        if event.event_id in self._seen:
+            self._seen.move_to_end(event.event_id)
+            metrics.whop_webhooks.inc("duplicate")
+            log.debug("webhook-duplicate", id=event.event_id)
+            return
+        log.info("webhook", action=action, id=event.event_id, user=event.user_id, product=event.product_id,
+                 active=event.active)
+        applied = await self.apply(event)
+        # Only once applied, so a redelivery after a failure is not taken for a duplicate
+        self._remember(event.event_id)
+        if applied:
+            self.room_service.publish_event({"kind": ENTITLEMENT_EVENT, "event": list(event)})
+
+    async def on_remote_event(self, message: dict) -> None:
+        """Apply an event another worker received."""
+        if message.get("kind") != ENTITLEMENT_EVENT:
+            return
+        try:
+            event = MembershipEvent(*message["event"])
+        except (KeyError, TypeError):
+            return
+        if event.event_id not in self._seen:
+            await self.apply(event)
+            self._remember(event.event_id)
+
+    async def apply(self, event: MembershipEvent) -> bool:
+        """Update the index and disconnect sessions that lost access. False if the event was stale."""
+        if not self.index.apply(event.user_id, event.product_id, event.active, event.at):
+            metrics.whop_webhooks.inc("stale")
+            return False
+        metrics.whop_webhooks.inc("applied")
+        # Only the product that gates /ws joins can end a session
+        if not event.active and event.product_id == settings.whop_product_id:
+            closed = await self.room_service.disconnect_user(
+                event.user_id,
+                {"type": "error", "error": "revoked", "message": "Your access to this voice chat has ended."},
+                REVOKED_CLOSE_CODE,
+            )
+            if closed:
+                metrics.entitlement_revocations.inc(closed)
+                log.info("sessions-revoked", user=event.user_id, count=closed)
+        return True
+
+    def _remember(self, event_id: str) -> None:
+        self._seen[event_id] = None
+        self._seen.move_to_end(event_id)
+        while len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
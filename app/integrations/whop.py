@@ -1,30 +1,165 @@
-from typing import Optional, Dict
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple
+import asyncio
+import hashlib
+import time
 import httpx
+from app.core import metrics
 from app.core.config import settings
+from app.core.logging import get_logger
+from app.integrations.entitlements import entitlements
+
+log = get_logger("whop")
+
+
+# Shared connection pool for all Whop API calls, opened/closed with the app lifespan
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+async def open_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(
+                max_connections=settings.whop_http_max_connections,
+                max_keepalive_connections=settings.whop_http_max_connections,
+            ),
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    """Return the shared pool, opening it lazily if the lifespan hook has not run."""
+    if _http_client is None or _http_client.is_closed:
+        return await open_http_client()
+    return _http_client
+
+
+class TokenCache:
+    """TTL + LRU cache of token verification results, keyed by token digest.
+
+    A result of None (token rejected by Whop) is cached for the shorter
+    negative TTL so a bad token cannot hammer the userinfo endpoint.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Optional[Dict]]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Tuple[bool, Optional[Dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        if value is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, value
+
+    def set(self, key: str, value: Optional[Dict]) -> None:
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+token_cache = TokenCache(
+    maxsize=settings.whop_token_cache_size,
+    ttl=settings.whop_token_cache_ttl,
+    negative_ttl=settings.whop_token_cache_negative_ttl,
+)
+
+# In-flight verifications by token digest, so concurrent joins share one request
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
 async def verify_whop_token(token: Optional[str]) -> Optional[Dict]:
     if not token:
-        print("DEBUG: No token provided")
+        log.debug("verify-skipped", reason="no-token")
         return None
     if not settings.whop_userinfo_url:
-        print("DEBUG: WHOP_USERINFO_URL not configured")
+        log.debug("verify-skipped", reason="userinfo-url-not-configured")
         return None
-    
-    print(f"DEBUG: Verifying token with URL: {settings.whop_userinfo_url}")
-    
+
+    key = _token_key(token)
+    found, cached = token_cache.get(key)
+    if found:
+        metrics.whop_verifications.inc("cache_hit")
+        return cached
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_verify_uncached(key, token))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        token_cache.coalesced += 1
+        metrics.whop_verifications.inc("coalesced")
+    # Shielded so one cancelled join does not cancel the request for the others
+    return await asyncio.shield(task)
+
+
+async def _verify_uncached(key: str, token: str) -> Optional[Dict]:
+    started = time.perf_counter()
+    outcome = "error"
+
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            res = await client.get(
-                settings.whop_userinfo_url,
-                headers={"Authorization": f"Bearer {token}"},
-            )
-        
-        print(f"DEBUG: Whop API response status: {res.status_code}")
-        print(f"DEBUG: Whop API response body: {res.text}")
-        
+        client = await get_http_client()
+        res = await client.get(
+            settings.whop_userinfo_url,
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
         if res.status_code != 200:
-            print(f"DEBUG: Token verification failed with status {res.status_code}")
+            log.info("verify-failed", status=res.status_code, body=res.text)
+            # Only definitive rejections are cached; 429/5xx should be retried
+            if res.status_code in (401, 403):
+                outcome = "invalid"
+                token_cache.set(key, None)
             return None
             
         data = res.json()
@@ -33,18 +168,23 @@ async def verify_whop_token(token: Optional[str]) -> Optional[Dict]:
             "name": data.get("name") or data.get("username") or data.get("email") or "Whop User",
             "raw": data,
         }
-        print(f"DEBUG: Token verification successful: {user_data}")
+        log.debug("verified", user=user_data["id"], status=res.status_code, body=res.text)
+        outcome = "valid"
+        token_cache.set(key, user_data)
         return user_data
         
     except httpx.TimeoutException:
-        print("DEBUG: Whop API request timed out")
+        log.warning("verify-timeout", url=settings.whop_userinfo_url)
         return None
     except httpx.RequestError as e:
-        print(f"DEBUG: Whop API request error: {e}")
+        log.warning("verify-request-error", url=settings.whop_userinfo_url, error=str(e))
         return None
     except Exception as e:
-        print(f"DEBUG: Unexpected error during token verification: {e}")
+        log.exception("verify-error", error=str(e))
         return None
+    finally:
+        metrics.whop_verify_seconds.observe(time.perf_counter() - started)
+        metrics.whop_verifications.inc(outcome)
 
 async def check_product_access(token: Optional[str], product_id: Optional[str] = None) -> bool:
     """
@@ -52,32 +192,48 @@ async def check_product_access(token: Optional[str], product_id: Optional[str] =
     If product_id is provided, check specific product access.
     If not provided, assume any valid Whop user has access.
     """
+    allowed, _ = await authorize_join(token, product_id)
+    return allowed
+
+
+async def authorize_join(token: Optional[str], product_id: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+    """
+    Decide whether a token may join, returning (allowed, Whop user id).
+    Product access is read from the webhook-fed entitlement index, so no
+    Whop call is made beyond the (cached) token verification.
+    """
     # If no Whop configuration is available, allow access (development mode)
     if not settings.whop_userinfo_url or not settings.whop_client_id:
-        print("DEBUG: Whop configuration missing, allowing access (development mode)")
-        return True
+        log.debug("access-allowed", reason="whop-not-configured")
+        return True, None
     
     if not token:
-        print("DEBUG: No token provided for product access check")
         # If no specific product_id required, allow access even without token
         if not product_id:
-            print("DEBUG: No product_id required, allowing access without token")
-            return True
-        return False
+            log.debug("access-allowed", reason="no-token-no-product")
+            return True, None
+        log.debug("access-denied", reason="no-token", product=product_id)
+        return False, None
         
     # First verify the token is valid
     user_data = await verify_whop_token(token)
     if not user_data:
-        print("DEBUG: Token verification failed, denying access")
-        return False
+        log.debug("access-denied", reason="invalid-token", product=product_id)
+        return False, None
+    user_id = user_data.get("id")
     
     # If no specific product_id required, any valid user has access
     if not product_id:
-        print(f"DEBUG: No product_id required, allowing access for user {user_data.get('id')}")
-        return True
+        log.debug("access-allowed", reason="no-product", user=user_id)
+        return True, user_id
     
-    # TODO: Implement product-specific access check
-    # This would require calling Whop's products/entitlements API
-    # For now, return True if user is authenticated
-    print(f"DEBUG: Product access check for product_id={product_id}, user={user_data.get('id')}")
-    return True
+    entitled = entitlements.has(user_id, product_id)
+    if entitled is None and not settings.whop_require_entitlement:
+        # No membership webhook seen for this user since startup; trust the valid token
+        log.debug("access-allowed", reason="authenticated", product=product_id, user=user_id)
+        return True, user_id
+    if not entitled:
+        log.debug("access-denied", reason="not-entitled", product=product_id, user=user_id)
+        return False, user_id
+    log.debug("access-allowed", reason="entitled", product=product_id, user=user_id)
+    return True, user_id
@@ -1,27 +1,69 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, RedirectResponse, StreamingResponse
 from typing import Optional
+import asyncio
 import os
 import orjson
 import secrets
 import urllib.parse
 import httpx
 
+from app.core import metrics
 from app.core.config import settings
+from app.core.logging import get_logger, setup_logging, shutdown_logging
 from app.services.rooms import RoomService
-from app.integrations.whop import verify_whop_token, check_product_access
+from app.services.assets import AssetStore
+from app.services.bus import create_room_backend
+from app.services.directory import RoomDirectory, etag_matches
+from app.services.limits import RATE_LIMIT_CLOSE_CODE, ConnectionLimiter
+from app.services.media import MediaPolicyService
+from app.services.sfu import SFU_PEER_ID, SfuService
+from app.services.trace import FLAG_LEFT, FLAG_RESUMED, KIND_CLOSE, KIND_JOINED, tracer
+from app.services.wire import SUBPROTOCOL_BINARY, decode_binary, encode_json_frame, negotiate
+from app.integrations.entitlements import WebhookIngest, verify_webhook_signature
+from app.integrations.whop import (
+    verify_whop_token,
+    authorize_join,
+    open_http_client,
+    close_http_client,
+    get_http_client,
+    token_cache,
+)
+
+setup_logging()
+log = get_logger("app")
+http_log = get_logger("http")
+auth_log = get_logger("auth")
+ws_log = get_logger("ws")
 
 app = FastAPI(title="WHOP Voice Chat App", version="0.1.0")
 
 # Add startup logging
 @app.on_event("startup")
 async def startup_event():
-    print("WHOP Voice Chat App starting up...")
-    print(f"Host: {settings.host}, Port: {settings.port}")
-    print(f"Require Auth: {settings.require_auth}")
-    print(f"CORS Origins: {settings.cors_allow_origins}")
+    log.info(
+        "startup",
+        host=settings.host,
+        port=settings.port,
+        require_auth=settings.require_auth,
+        cors_origins=",".join(settings.cors_allow_origins),
+        room_backend=settings.room_backend,
+    )
+    await open_http_client()
+    await room_service.start()
+    await webhooks.start()
+    tracer.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await tracer.stop()
+    await webhooks.stop()
+    await sfu_service.stop()
+    await room_service.stop()
+    await close_http_client()
+    shutdown_logging()
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,21 +82,40 @@ async def csp_headers(request: Request, call_next):
     return resp
 
 public_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "public")
-print(f"Public directory: {public_dir}")
-print(f"Public directory exists: {os.path.exists(public_dir)}")
+log.info("public-dir", path=public_dir, exists=os.path.exists(public_dir))
 if os.path.exists(public_dir):
-    app.mount("/static", StaticFiles(directory=public_dir), name="static")
+    static_assets = AssetStore(public_dir)
 else:
-    print("WARNING: Public directory not found, static files may not work")
+    static_assets = None
+    log.warning("public-dir-missing", path=public_dir)
+
+room_service = RoomService(backend=create_room_backend())
+sfu_service = SfuService(room_service)
+media_policy = MediaPolicyService(room_service, sfu_service)
+webhooks = WebhookIngest(room_service)
+directory = RoomDirectory(room_service)
+room_service.add_leave_listener(tracer.on_leave)
 
-room_service = RoomService()
+
+def serve_index(request: Request) -> Response:
+    if not static_assets or not static_assets.index:
+        return Response(status_code=404)
+    return static_assets.response(static_assets.index, request)
 
 
 @app.get("/")
-async def root(token: Optional[str] = None):
+async def root(request: Request, token: Optional[str] = None):
     # If token is provided via query (?token=..), render index and let frontend stash it
-    index_path = os.path.join(public_dir, "index.html")
-    return FileResponse(index_path)
+    return serve_index(request)
+
+
+@app.get("/static/{name:path}")
+async def static_file(name: str, request: Request):
+    asset = static_assets.get(name) if static_assets else None
+    if not asset:
+        return Response(status_code=404)
+    # Only the hashed URL is safe to cache forever; plain names must revalidate
+    return static_assets.response(asset, request, immutable=name != asset.name)
 
 
 @app.get("/favicon.ico")
@@ -67,6 +128,51 @@ async def health():
     return {"status": "ok"}
 
 
+def room_metrics() -> list:
+    """Scrape-time gauges read straight from the room service."""
+    rooms = room_service.rooms.values()
+    return [
+        "# HELP voice_rooms Rooms with at least one client on this process",
+        "# TYPE voice_rooms gauge",
+        f"voice_rooms {len(room_service.rooms)}",
+        "# HELP voice_room_clients Clients joined to a room on this process",
+        "# TYPE voice_room_clients gauge",
+        f"voice_room_clients {sum(len(room.clients) for room in rooms)}",
+    ] + metrics.room_size_lines(len(room.clients) + len(room.remote) for room in rooms)
+
+
+metrics.registry.add_collector(room_metrics)
+
+
+@app.get("/rooms")
+async def list_rooms(request: Request, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Active rooms in id order, paged by cursor; poll with If-None-Match."""
+    if not settings.room_directory:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    etag = directory.etag()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(directory.page(cursor, limit), headers=headers)
+
+
+@app.get("/rooms/events")
+async def room_events():
+    """Server-Sent Events: a directory snapshot, then coalesced changes."""
+    if not settings.room_directory:
+        return JSONResponse({"detail": "Not Found"}, status_code=404)
+    return StreamingResponse(
+        directory.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/debug")
 async def debug():
     return {
@@ -77,7 +183,8 @@ async def debug():
         "token_url": settings.whop_token_url,
         "userinfo_url": settings.whop_userinfo_url,
         "client_secret_set": bool(settings.whop_client_secret),
-        "product_id": settings.whop_product_id
+        "product_id": settings.whop_product_id,
+        "token_cache": token_cache.stats(),
     }
 
 @app.get("/debug/token")
@@ -117,11 +224,10 @@ async def whop_app(request: Request):
     whop_company_id = request.headers.get("X-Whop-Company-Id")
     whop_subscription_id = request.headers.get("X-Whop-Subscription-Id")
     
-    print(f"DEBUG: Whop app request - User: {whop_user_id}, Company: {whop_company_id}, Subscription: {whop_subscription_id}")
+    http_log.debug("whop-app", user=whop_user_id, company=whop_company_id, subscription=whop_subscription_id)
     
     # Render the main app interface
-    index_path = os.path.join(public_dir, "index.html")
-    return FileResponse(index_path)
+    return serve_index(request)
 
 @app.get("/whop/install")
 async def whop_install():
@@ -135,31 +241,35 @@ async def whop_uninstall():
 
 @app.post("/whop/webhook")
 async def whop_webhook(request: Request):
-    """Handle Whop webhooks (subscription events, etc.)"""
-    try:
-        body = await request.json()
-        print(f"DEBUG: Whop webhook received: {body}")
-        return {"status": "received"}
-    except Exception as e:
-        print(f"ERROR: Failed to process Whop webhook: {e}")
-        return {"status": "error", "message": str(e)}
+    """Acknowledge a Whop webhook at once; the ingest worker applies it (app.integrations.entitlements)."""
+    body = await request.body()
+    if not verify_webhook_signature(body, request.headers):
+        metrics.whop_webhooks.inc("unauthorized")
+        http_log.warning("webhook-unauthorized", id=request.headers.get("webhook-id"))
+        return JSONResponse({"status": "unauthorized"}, status_code=401)
+    if not webhooks.submit(body, request.headers.get("webhook-id")):
+        http_log.warning("webhook-queue-full", size=webhooks.queue.maxsize)
+        return JSONResponse({"status": "busy"}, status_code=503, headers={"Retry-After": "5"})
+    return {"status": "received"}
         
 @app.get("/whop/manifest")
-async def whop_manifest():
+async def whop_manifest(request: Request):
     """Return the Whop app manifest"""
-    manifest_path = os.path.join(public_dir, "whop-manifest.json")
-    return FileResponse(manifest_path, media_type="application/json")
+    asset = static_assets.get("whop-manifest.json") if static_assets else None
+    if not asset:
+        return Response(status_code=404)
+    return static_assets.response(asset, request)
 
 @app.get("/app/")
 async def whop_app_redirect(request: Request):
     """Redirect from /app/ to /whop/app for Whop compatibility"""
-    print(f"DEBUG: Redirecting from /app/ to /whop/app")
+    http_log.debug("redirect", path="/app/", to="/whop/app")
     return RedirectResponse("/whop/app")
 
 @app.get("/app")
 async def whop_app_redirect_no_slash(request: Request):
     """Redirect from /app to /whop/app for Whop compatibility"""
-    print(f"DEBUG: Redirecting from /app to /whop/app")
+    http_log.debug("redirect", path="/app", to="/whop/app")
     return RedirectResponse("/whop/app")
 
 @app.get("/auth/login")
@@ -180,202 +290,416 @@ async def auth_login():
 
 @app.get("/auth/callback")
 async def auth_callback(request: Request, code: Optional[str] = None, state: Optional[str] = None):
-    print(f"DEBUG: OAuth callback received - Full URL: {request.url}")
-    print(f"DEBUG: OAuth callback received - code: {bool(code)}, state: {bool(state)}")
-    print(f"DEBUG: Expected redirect URI: {settings.oauth_redirect_url}")
+    # The query string carries the authorization code, so only the path is logged
+    auth_log.debug("callback", path=request.url.path, code=code, state=state, redirect_uri=settings.oauth_redirect_url)
     
     if not code:
-        print("DEBUG: No authorization code received - likely redirect URI mismatch")
-        print("DEBUG: Check that Whop OAuth app redirect URI exactly matches:")
-        print(f"DEBUG: Expected: {settings.oauth_redirect_url}")
+        # Usually the Whop OAuth app's redirect URI does not exactly match ours
+        auth_log.warning("callback-no-code", expected_redirect_uri=settings.oauth_redirect_url)
         return RedirectResponse("/?error=oauth_failed&reason=no_code")
         
     if not settings.whop_token_url or not settings.whop_client_id or not settings.whop_client_secret or not settings.oauth_redirect_url:
-        print("DEBUG: OAuth configuration missing")
+        auth_log.error("oauth-not-configured")
         return Response(status_code=500, content="OAuth not configured")
         
     try:
-        print(f"DEBUG: Exchanging code for token at {settings.whop_token_url}")
+        auth_log.debug("token-exchange", url=settings.whop_token_url)
         
-        async with httpx.AsyncClient(timeout=10) as client:
-            res = await client.post(
-                settings.whop_token_url,
-                data={
-                    "grant_type": "authorization_code",
-                    "code": code,
-                    "redirect_uri": settings.oauth_redirect_url,
-                    "client_id": settings.whop_client_id,
-                    "client_secret": settings.whop_client_secret,
-                },
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
+        client = await get_http_client()
+        res = await client.post(
+            settings.whop_token_url,
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": settings.oauth_redirect_url,
+                "client_id": settings.whop_client_id,
+                "client_secret": settings.whop_client_secret,
+            },
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
             
-        print(f"DEBUG: Token exchange response status: {res.status_code}")
-        print(f"DEBUG: Token exchange response body: {res.text}")
-        
         if res.status_code != 200:
-            print(f"ERROR: Token exchange failed with status {res.status_code}: {res.text}")
+            auth_log.error("token-exchange-failed", status=res.status_code, body=res.text)
             return RedirectResponse(f"/?error=oauth_failed&reason=token_exchange_failed&status={res.status_code}")
             
         token_data = res.json()
         access_token = token_data.get("access_token")
         
         if not access_token:
-            print("ERROR: No access_token in token exchange response")
+            auth_log.error("token-exchange-no-access-token", body=res.text)
             return RedirectResponse("/?error=oauth_failed&reason=no_access_token")
             
-        print(f"DEBUG: Successfully obtained access token: {access_token[:20]}...")
+        auth_log.info("token-exchanged", status=res.status_code)
         
         # Pass token to frontend via URL param; frontend will stash it to localStorage
         redirect_url = f"/?token={urllib.parse.quote(access_token)}"
-        print(f"DEBUG: Redirecting to: {redirect_url}")
         return RedirectResponse(redirect_url)
         
     except httpx.HTTPStatusError as e:
-        print(f"ERROR: HTTP Status Error during token exchange: {e.response.status_code} - {e.response.text}")
+        auth_log.error("token-exchange-failed", status=e.response.status_code, body=e.response.text)
         return RedirectResponse(f"/?error=oauth_failed&reason=http_error&status={e.response.status_code}")
     except httpx.RequestError as e:
-        print(f"ERROR: Request Error during token exchange: {e}")
+        auth_log.error("token-exchange-request-error", error=str(e))
         return RedirectResponse(f"/?error=oauth_failed&reason=request_error")
     except Exception as e:
-        print(f"ERROR: Unexpected error during OAuth callback: {e}")
+        auth_log.exception("callback-failed", error=str(e))
         return RedirectResponse(f"/?error=oauth_failed&reason=unexpected_error")
 
 
+# Upper bound on messages accepted in one inbound batch envelope
+MAX_BATCH_MESSAGES = 64
+
+
+async def handle_sfu_signal(room_id: str, client_id: str, msg_type: str, message: dict) -> None:
+    """Route offer/answer/ice addressed to the SFU instead of another peer."""
+    try:
+        if msg_type == "offer":
+            answer = await sfu_service.handle_offer(room_id, client_id, message.get("sdp") or "")
+            if answer:
+                await room_service.send_to(room_id, client_id, {"type": "answer", "from": SFU_PEER_ID, "sdp": answer})
+        elif msg_type == "answer":
+            await sfu_service.handle_answer(room_id, client_id, message.get("sdp") or "")
+        else:
+            await sfu_service.add_ice(room_id, client_id, message.get("candidate"))
+    except Exception as e:
+        ws_log.exception("sfu-signal-failed", type=msg_type, room=room_id, client=client_id, error=str(e))
+
+
+# Open /ws connections on this process, for admission control
+open_connections = 0
+
+# Close code for joins refused by admission control ("try again later")
+ADMISSION_CLOSE_CODE = 1013
+
+
+def admission_error(room_id: str) -> Optional[dict]:
+    """Structured error for a join that would exceed the room or process caps, else None."""
+    if settings.max_connections and open_connections > settings.max_connections:
+        return {"type": "error", "error": "server-full", "message": "The server is at capacity. Please try again shortly."}
+    if settings.max_room_participants and room_service.room_size(room_id) >= settings.max_room_participants:
+        return {"type": "error", "error": "room-full", "message": f"This room is full ({settings.max_room_participants} participants)."}
+    return None
+
+
+async def send_direct(websocket: WebSocket, binary: bool, message: dict) -> None:
+    """Send outside the room queues (e.g. before join), in the connection's wire format."""
+    if binary:
+        await websocket.send_bytes(encode_json_frame(message))
+    else:
+        await websocket.send_text(orjson.dumps(message).decode())
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+    subprotocol = negotiate(websocket.scope.get("subprotocols") or [])
+    await websocket.accept(subprotocol=subprotocol)
+    binary = subprotocol == SUBPROTOCOL_BINARY
+    global open_connections
+    open_connections += 1
+    metrics.ws_connections.inc()
+    limiter = ConnectionLimiter()
+    # This connection's number in the signaling trace, if one is being recorded
+    conn = tracer.connection(binary) if tracer.enabled else 0
 
     client_id: Optional[str] = None
     room_id: Optional[str] = None
     user_name: Optional[str] = None
+    left = False
 
     try:
         while True:
-            raw = await websocket.receive_text()
-            message = orjson.loads(raw)
-            msg_type = message.get("type")
-
-            if msg_type == "join":
-                room_id = message.get("roomId")
-                user_name = message.get("name") or "Guest"
-                token = message.get("token")
-
-                print(f"DEBUG: Join request - Room: {room_id}, User: {user_name}, Token: {bool(token)}, RequireAuth: {settings.require_auth}")
-
-                if settings.require_auth:
-                    # Check if user has access to the voice chat product
-                    has_access = await check_product_access(token, settings.whop_product_id)
-                    if not has_access:
-                        # Provide more helpful error message based on configuration
-                        if not settings.whop_userinfo_url or not settings.whop_client_id:
-                            error_message = "Authentication is required but Whop configuration is missing. Please contact the administrator."
-                        elif not token:
-                            error_message = "Authentication required. Please sign in with Whop first."
-                        else:
-                            error_message = "You need to purchase the Voice Chat product to access this feature"
-                        
-                        await websocket.send_text(orjson.dumps({
-                            "type": "error", 
-                            "error": "forbidden",
-                            "message": error_message
-                        }).decode())
-                        await websocket.close()
-                        return
-
-                client = room_service.join(room_id=room_id, websocket=websocket, name=user_name)
-                client_id = client.client_id
-
-                await websocket.send_text(orjson.dumps({
-                    "type": "joined",
-                    "clientId": client_id,
-                    "peers": room_service.list_peers(room_id, exclude_client_id=client_id)
-                }).decode())
-
-                await room_service.broadcast(room_id, {
-                    "type": "peer-joined",
-                    "clientId": client_id,
-                    "name": user_name,
-                }, exclude_client_id=client_id)
-
-            elif msg_type == "chat":
-                if not room_id or not client_id:
-                    continue
-                text = message.get("message", "")
-                await room_service.broadcast(room_id, {
-                    "type": "chat",
-                    "fromClientId": client_id,
-                    "fromName": user_name,
-                    "message": text,
-                })
-
-            elif msg_type in ("offer", "answer", "ice"):
-                if not room_id or not client_id:
-                    continue
-                target_id = message.get("to")
-                payload = {"type": msg_type, "from": client_id}
-                if msg_type in ("offer", "answer"):
-                    payload["sdp"] = message.get("sdp")
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            # A frame that does not decode is dropped; the session carries on
+            try:
+                if frame.get("bytes") is not None:
+                    message = decode_binary(frame["bytes"], room_service.handle_table(room_id))
                 else:
-                    payload["candidate"] = message.get("candidate")
-                await room_service.send_to(room_id, target_id, payload)
-
-            elif msg_type == "mute":
-                if not room_id or not client_id:
+                    message = orjson.loads(frame["text"])
+            except ValueError as e:
+                ws_log.debug("malformed-frame", room=room_id, client=client_id, error=str(e))
+                continue
+            if not isinstance(message, dict):
+                continue
+            if client_id:
+                room_service.touch(room_id, client_id)
+
+            # A batch envelope carries several messages in one frame; nested batches are ignored
+            if message.get("type") == "batch":
+                metrics.inbound_messages.inc("batch")
+                if not limiter.allow("batch"):
+                    metrics.rate_limited.inc("batch")
                     continue
-                await room_service.broadcast(room_id, {
-                    "type": "mute",
-                    "clientId": client_id,
-                    "muted": bool(message.get("muted", False)),
-                }, exclude_client_id=client_id)
-
-            elif msg_type == "media-state":
-                if not room_id or not client_id:
+                batch = [m for m in (message.get("messages") or [])[:MAX_BATCH_MESSAGES]
+                         if isinstance(m, dict) and m.get("type") != "batch"]
+            else:
+                batch = (message,)
+            if tracer.enabled:
+                tracer.inbound(conn, client_id, room_id, frame, message, batch)
+
+            for message in batch:
+                msg_type = message.get("type")
+                # Non-string types are unhashable or meaningless; count and limit them as unknown
+                if not isinstance(msg_type, str):
+                    msg_type = None
+                metrics.inbound_messages.inc(msg_type)
+
+                if not limiter.allow(msg_type):
+                    metrics.rate_limited.inc(msg_type)
+                    if msg_type == "join":
+                        metrics.rejected_joins.inc("rate-limited")
+                    if limiter.exhausted:
+                        ws_log.warning("rate-limit-disconnect", room=room_id, client=client_id, strikes=int(limiter.strikes))
+                        # Bypass the outbound backlog; the client is about to be removed with it
+                        await send_direct(websocket, binary, {
+                            "type": "error", "error": "rate-limited", "message": "Too many messages; disconnected.",
+                        })
+                        # Not resumable: announce the leave now rather than after the close handshake,
+                        # which can stall behind the unread frames the client flooded us with
+                        left = True
+                        if room_id and client_id:
+                            await room_service.connection_closed(room_id, client_id, websocket, resumable=False)
+                        try:
+                            await asyncio.wait_for(websocket.close(code=RATE_LIMIT_CLOSE_CODE), timeout=1.0)
+                        except Exception:
+                            pass
+                        return
+                    # Telemetry is dropped silently; other types get at most one notice per window
+                    if limiter.should_notify(msg_type):
+                        error = {
+                            "type": "error",
+                            "error": "rate-limited",
+                            "message": f"Too many {msg_type} messages; some were dropped.",
+                            "messageType": msg_type,
+                        }
+                        if client_id:
+                            await room_service.send_to(room_id, client_id, error)
+                        else:
+                            await send_direct(websocket, binary, error)
                     continue
-                await room_service.broadcast(room_id, {
-                    "type": "media-state",
-                    "clientId": client_id,
-                    "hasAudio": bool(message.get("hasAudio", False)),
-                    "hasVideo": bool(message.get("hasVideo", False)),
-                }, exclude_client_id=client_id)
-
-            elif msg_type == "pitch":
-                if not room_id or not client_id:
+
+                if msg_type == "join":
+                    room_id = message.get("roomId")
+                    user_name = message.get("name") or "Guest"
+                    token = message.get("token")
+
+                    ws_log.info("join", room=room_id, user=user_name, token=token, require_auth=settings.require_auth)
+
+                    whop_user_id = None
+                    if settings.require_auth:
+                        # Check if user has access to the voice chat product
+                        has_access, whop_user_id = await authorize_join(token, settings.whop_product_id)
+                        if not has_access:
+                            # Provide more helpful error message based on configuration
+                            if not settings.whop_userinfo_url or not settings.whop_client_id:
+                                error_message = "Authentication is required but Whop configuration is missing. Please contact the administrator."
+                            elif not token:
+                                error_message = "Authentication required. Please sign in with Whop first."
+                            else:
+                                error_message = "You need to purchase the Voice Chat product to access this feature"
+                        
+                            await send_direct(websocket, binary, {
+                                "type": "error", 
+                                "error": "forbidden",
+                                "message": error_message
+                            })
+                            await websocket.close()
+                            return
+
+                    # A resumed session keeps its identity, so peers see no leave/join churn
+                    resume_token = message.get("resumeToken")
+                    client = None
+                    if resume_token:
+                        client = await room_service.resume(room_id, resume_token, websocket, binary=binary)
+                    resumed = client is not None
+                    if client is None:
+                        refusal = admission_error(room_id)
+                        if refusal:
+                            metrics.rejected_joins.inc(refusal["error"])
+                            await send_direct(websocket, binary, refusal)
+                            await websocket.close(code=ADMISSION_CLOSE_CODE)
+                            return
+                        client = await room_service.join(
+                            room_id=room_id, websocket=websocket, name=user_name, binary=binary, user_id=whop_user_id,
+                        )
+                    client_id = client.client_id
+                    user_name = client.name
+                    if not resumed:
+                        await room_service.announce_join(room_id, client_id)
+                    # Snapshot and version are read together; later changes arrive as versioned deltas
+                    peers, roster_version = room_service.roster(room_id, exclude_client_id=client_id)
+                    switched = not resumed and sfu_service.update_mode(room_id, len(peers) + 1)
+                    if switched:
+                        # One upload to the SFU instead of one per peer: the policy loosens
+                        await media_policy.update(room_id, client_id)
+                    history, has_more = room_service.chat_history(room_id, limit=settings.chat_history_on_join)
+
+                    # A resumed client must see `joined` before the signaling buffered while it was away
+                    send_joined = room_service.send_first if resumed else room_service.send_to
+                    await send_joined(room_id, client_id, {
+                        "type": "joined",
+                        "clientId": client_id,
+                        "handle": client.handle,
+                        "joinSeq": room_service.join_seq(room_id, client_id),
+                        "peers": peers,
+                        "rosterVersion": roster_version,
+                        "media": "sfu" if sfu_service.is_active(room_id) else "mesh",
+                        "history": history,
+                        "hasMoreHistory": has_more,
+                        "resumeToken": client.resume_token or None,
+                        "resumed": resumed,
+                        "heartbeat": {"interval": settings.heartbeat_interval, "timeout": settings.heartbeat_timeout},
+                        # Clients send pitch at most this often; faster updates would only be coalesced
+                        "telemetryHz": settings.telemetry_hz,
+                        "mediaPolicy": media_policy.current(room_id),
+                    })
+                    if tracer.enabled:
+                        tracer.event(KIND_JOINED, conn, client_id, room_id, FLAG_RESUMED if resumed else 0)
+
+                    if switched and peers:
+                        # Existing mesh clients drop their peer connections and publish to the SFU
+                        await room_service.broadcast(room_id, {
+                            "type": "media-mode",
+                            "mode": "sfu",
+                        }, exclude_client_id=client_id)
+
+                elif msg_type == "chat":
+                    if not room_id or not client_id:
+                        continue
+                    await room_service.post_chat(room_id, client_id, user_name, message.get("message", ""))
+
+                elif msg_type == "history":
+                    if not room_id or not client_id:
+                        continue
+                    before = message.get("before")
+                    limit = message.get("limit")
+                    history, has_more = room_service.chat_history(
+                        room_id,
+                        before=before if isinstance(before, int) else None,
+                        limit=min(limit, settings.chat_history_page) if isinstance(limit, int) else settings.chat_history_page,
+                    )
+                    await room_service.send_to(room_id, client_id, {
+                        "type": "history",
+                        "messages": history,
+                        "hasMore": has_more,
+                    })
+
+                elif msg_type == "roster-sync":
+                    if not room_id or not client_id:
+                        continue
+                    since = message.get("since")
+                    await room_service.send_to(
+                        room_id, client_id, room_service.roster_sync(room_id, client_id, since if isinstance(since, int) else -1)
+                    )
+
+                elif msg_type in ("offer", "answer", "ice"):
+                    if not room_id or not client_id:
+                        continue
+                    target_id = message.get("to")
+                    if not isinstance(target_id, str):
+                        # Also keeps unhashable ids out of room lookups and the ICE bundle keys
+                        continue
+                    if target_id == SFU_PEER_ID:
+                        await handle_sfu_signal(room_id, client_id, msg_type, message)
+                        continue
+                    if msg_type == "ice":
+                        # Bundled with other candidates for the same pair over a short window
+                        room_service.send_ice(room_id, client_id, target_id, message.get("candidate"))
+                        continue
+                    await room_service.send_to(room_id, target_id, {
+                        "type": msg_type,
+                        "from": client_id,
+                        "sdp": message.get("sdp"),
+                    })
+
+                elif msg_type == "mute":
+                    if not room_id or not client_id:
+                        continue
+                    await room_service.broadcast(room_id, {
+                        "type": "mute",
+                        "clientId": client_id,
+                        "muted": bool(message.get("muted", False)),
+                    }, exclude_client_id=client_id)
+
+                elif msg_type == "media-state":
+                    if not room_id or not client_id:
+                        continue
+                    await room_service.broadcast(room_id, {
+                        "type": "media-state",
+                        "clientId": client_id,
+                        "hasAudio": bool(message.get("hasAudio", False)),
+                        "hasVideo": bool(message.get("hasVideo", False)),
+                    }, exclude_client_id=client_id)
+
+                elif msg_type == "pitch":
+                    if not room_id or not client_id:
+                        continue
+                    # Aggregated and sent on the room's telemetry tick
+                    room_service.update_telemetry(room_id, client_id, hz=message.get("hz"))
+
+                elif msg_type == "vad":
+                    if not room_id or not client_id:
+                        continue
+                    room_service.update_telemetry(room_id, client_id, speaking=bool(message.get("speaking", False)))
+
+                elif msg_type == "peer-connection":
+                    # A browser's report on one peer connection: time from joining (or from the
+                    # peer joining) to ICE connected, or that it failed
+                    if not room_id or not client_id:
+                        continue
+                    outcome = message.get("state")
+                    if outcome not in ("connected", "failed"):
+                        continue
+                    metrics.peer_connections.inc(outcome)
+                    elapsed = message.get("ms")
+                    if outcome == "connected" and isinstance(elapsed, (int, float)) and 0 <= elapsed <= 600000:
+                        metrics.peer_connect_seconds.observe(elapsed / 1000)
+
+                elif msg_type == "ping":
+                    # Clients probe a quiet server the same way it probes them
+                    if client_id:
+                        await room_service.send_to(room_id, client_id, {"type": "pong"})
+                    else:
+                        await send_direct(websocket, binary, {"type": "pong"})
+
+                elif msg_type == "pong":
+                    # Receiving the frame already counted as a heartbeat
                     continue
-                await room_service.broadcast(room_id, {
-                    "type": "pitch",
-                    "clientId": client_id,
-                    "hz": message.get("hz"),
-                }, exclude_client_id=client_id)
 
-            elif msg_type == "leave":
-                break
+                elif msg_type == "leave":
+                    left = True
+                    return
 
     except WebSocketDisconnect:
         pass
     finally:
+        open_connections -= 1
+        metrics.ws_connections.dec()
+        if tracer.enabled:
+            tracer.event(KIND_CLOSE, conn, client_id, room_id, FLAG_LEFT if left else 0)
         if room_id and client_id:
-            name = room_service.get_name(room_id, client_id)
-            room_service.leave(room_id, client_id)
-            await room_service.broadcast(room_id, {"type": "peer-left", "clientId": client_id, "name": name})
+            # Dropped connections are held for resumption; explicit leaves end the session.
+            # No-op if the client was already evicted or resumed on another connection.
+            await room_service.connection_closed(room_id, client_id, websocket, resumable=not left)
 
 
 # Additional Whop app endpoints for different URL patterns
 @app.get("/voice-chat-v-1-{app_id}/app/")
 async def whop_app_dynamic_redirect(request: Request, app_id: str):
     """Handle any Whop app URL pattern with dynamic app ID"""
-    print(f"DEBUG: Handling Whop app URL pattern with app_id: {app_id}")
+    http_log.debug("redirect", path=f"/voice-chat-v-1-{app_id}/app/", to="/whop/app")
     return RedirectResponse("/whop/app")
 
 # General pattern for any app ending with /app/
 @app.get("/{app_name}/app/")
 async def whop_app_general_redirect(request: Request, app_name: str):
     """Handle any app name ending with /app/"""
-    print(f"DEBUG: Handling general Whop app URL pattern: {app_name}/app/")
+    http_log.debug("redirect", path=f"/{app_name}/app/", to="/whop/app")
     return RedirectResponse("/whop/app")
 
 
 if __name__ == "__main__":
     import uvicorn
-    print(f"Starting app on {settings.host}:{settings.port}")
+    log.info("run", host=settings.host, port=settings.port)
     uvicorn.run("app.main:app", host=settings.host, port=settings.port, reload=True)
@@ -0,0 +1,159 @@
+"""In-memory static assets: content-hashed URLs, precompressed variants and ETags.
+
+At startup every file under public/ is read once. It gets a content hash,
+a hashed URL (app.js -> app.3f9c2a1b7d04.js) that is safe to cache
+forever, and gzip (and brotli, when installed) variants. index.html is
+rewritten to reference the hashed URLs and is then served from memory
+too, revalidated with its ETag on every load.
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, Optional, Tuple
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from app.core.logging import get_logger
+
+# Optional: brotli is preferred over gzip when the client accepts it
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the deployment
+    brotli = None
+
+log = get_logger("assets")
+
+INDEX_NAME = "index.html"
+
+# Hashed URLs never change content, so they can be cached for a year
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# Unhashed URLs (the index, the manifest, old links) must be revalidated
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Below this, compression saves less than the header overhead
+MIN_COMPRESS_BYTES = 256
+HASH_LENGTH = 12
+
+
+class Asset:
+    __slots__ = ("name", "hashed_name", "content_type", "etag", "variants")
+
+    def __init__(self, name: str, body: bytes, content_type: str, hashed: bool = True) -> None:
+        digest = hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+        self.name = name
+        root, ext = os.path.splitext(name)
+        self.hashed_name = f"{root}.{digest}{ext}" if hashed else name
+        self.content_type = content_type
+        self.etag = f'"{digest}"'
+        # Content-Encoding -> (body, strong ETag of that representation)
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, self.etag)}
+        if content_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= MIN_COMPRESS_BYTES:
+            self._add_variant("gzip", gzip.compress(body, compresslevel=9, mtime=0), digest)
+            if brotli is not None:
+                self._add_variant("br", brotli.compress(body, quality=11), digest)
+
+    def _add_variant(self, encoding: str, data: bytes, digest: str) -> None:
+        if len(data) < len(self.variants["identity"][0]):
+            self.variants[encoding] = (data, f'"{digest}-{encoding}"')
+
+    def etags(self) -> Iterable[str]:
+        return (etag for _, etag in self.variants.values())
+
+
+class AssetStore:
+    """Static files loaded and compressed once, served from memory."""
+
+    def __init__(self, directory: str, url_prefix: str = "/static/") -> None:
+        self.directory = directory
+        self.url_prefix = url_prefix
+        # Both the plain and the hashed name map to the asset
+        self.assets: Dict[str, Asset] = {}
+        self.index: Optional[Asset] = None
+        self.load()
+
+    def load(self) -> None:
+        assets: Dict[str, Asset] = {}
+        index_body: Optional[bytes] = None
+        for root, _, files in os.walk(self.directory):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    body = f.read()
+                if name == INDEX_NAME:
+                    index_body = body
+                asset = Asset(name, body, content_type_for(name))
+                assets[name] = assets[asset.hashed_name] = asset
+        self.assets = assets
+        if index_body is not None:
+            self.index = Asset(INDEX_NAME, self.rewrite(index_body), content_type_for(INDEX_NAME), hashed=False)
+        log.info("loaded", count=len({id(a) for a in assets.values()}), directory=self.directory, brotli=brotli is not None)
+
+    def rewrite(self, html: bytes) -> bytes:
+        """Point /static/<name> references at the hashed URLs."""
+        text = html.decode()
+        for name, asset in self.assets.items():
+            if name == asset.name and name != INDEX_NAME:
+                for quote in ('"', "'"):
+                    text = text.replace(
+                        f"{quote}{self.url_prefix}{name}{quote}",
+                        f"{quote}{self.url_prefix}{asset.hashed_name}{quote}",
+                    )
+        return text.encode()
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self.assets.get(name)
+
+    def url(self, name: str) -> str:
+        asset = self.assets.get(name)
+        return self.url_prefix + (asset.hashed_name if asset else name)
+
+    def response(self, asset: Asset, request: Request, immutable: bool = False) -> Response:
+        """Serve an asset with the best accepted encoding, answering 304 to a matching If-None-Match."""
+        cache_control = IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""), asset.variants)
+        body, etag = asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if etag_matches(request.headers.get("if-none-match"), asset):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=asset.content_type, headers=headers)
+
+
+def content_type_for(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def negotiate_encoding(accept_encoding: str, variants: Dict[str, Tuple[bytes, str]]) -> str:
+    """Pick br, then gzip, then identity, honouring q=0 exclusions."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(token.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in variants and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def etag_matches(if_none_match: Optional[str], asset: Asset) -> bool:
+    # Any representation's tag matches: they all carry the same content
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return any(etag in tags for etag in asset.etags())
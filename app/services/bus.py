@@ -0,0 +1,404 @@
+"""Cross-process room bus.
+
+A small broker process tracks which worker owns which room member and
+routes broadcast, targeted and telemetry frames between workers. Each
+uvicorn worker connects with BusRoomBackend, so peers on different
+workers (or different hosts, over TCP) share rooms without any change to
+the /ws protocol.
+
+Run the broker next to the workers:
+
+    python -m app.services.bus --listen unix:///tmp/voice-chat-bus.sock
+"""
+from __future__ import annotations
+
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import os
+import struct
+import orjson
+
+from app.core.config import settings
+from app.core.logging import get_logger, setup_logging
+from app.services.rooms import PRIORITY_CHAT, LocalRoomBackend, RoomBackend, RoomService, allocate_handle
+from app.services.wire import Payload
+
+
+log = get_logger("bus")
+
+_HEADER = struct.Struct("!I")
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def encode_frame(message: dict) -> bytes:
+    data = orjson.dumps(message)
+    return _HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    header = await reader.readexactly(_HEADER.size)
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"bus frame too large: {length} bytes")
+    return await reader.readexactly(length)
+
+
+def parse_address(url: str) -> Tuple[str, str, int]:
+    """Split unix:///path or tcp://host:port into (scheme, host_or_path, port)."""
+    if url.startswith("unix://"):
+        return "unix", url[len("unix://"):], 0
+    if url.startswith("tcp://"):
+        host, _, port = url[len("tcp://"):].rpartition(":")
+        return "tcp", host or "127.0.0.1", int(port)
+    raise ValueError(f"unsupported room bus address: {url}")
+
+
+async def open_connection(url: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    scheme, host, port = parse_address(url)
+    if scheme == "unix":
+        return await asyncio.open_unix_connection(host)
+    return await asyncio.open_connection(host, port)
+
+
+class _Worker:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        # room_id -> client_ids owned by this worker
+        self.rooms: Dict[str, Set[str]] = {}
+
+    def send(self, data: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+
+class RoomBus:
+    """Broker: owns global room membership and routes frames between workers."""
+
+    def __init__(self) -> None:
+        # room_id -> client_id -> (name, owning worker)
+        self.members: Dict[str, Dict[str, Tuple[str, _Worker]]] = {}
+        # room_id -> client_id -> wire handle, and the reverse, so handles are unique room-wide
+        self.handles: Dict[str, Dict[str, int]] = {}
+        self.by_handle: Dict[str, Dict[int, str]] = {}
+        # room_id -> client_id -> join sequence number, and the next number to hand out,
+        # so every worker orders a room's members (and so its offerers) the same way
+        self.join_seqs: Dict[str, Dict[str, int]] = {}
+        self.next_join_seq: Dict[str, int] = {}
+        # room_id -> workers with at least one member in the room
+        self.subscribers: Dict[str, Set[_Worker]] = {}
+        # Every connected worker, for process-wide events
+        self.workers: Set[_Worker] = set()
+
+    async def serve(self, url: str) -> asyncio.AbstractServer:
+        scheme, host, port = parse_address(url)
+        if scheme == "unix":
+            return await asyncio.start_unix_server(self.handle, path=host)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker = _Worker(writer)
+        self.workers.add(worker)
+        try:
+            while True:
+                data = await read_frame(reader)
+                self.dispatch(worker, data, orjson.loads(data))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.workers.discard(worker)
+            self.drop(worker)
+            writer.close()
+
+    def dispatch(self, worker: _Worker, data: bytes, message: dict) -> None:
+        op = message.get("op")
+        room_id = message.get("room")
+        frame = _HEADER.pack(len(data)) + data
+
+        if op == "join":
+            client_id = message["cid"]
+            name = message.get("name") or "Guest"
+            members = self.members.setdefault(room_id, {})
+            handles = self.handles.setdefault(room_id, {})
+            by_handle = self.by_handle.setdefault(room_id, {})
+            join_seqs = self.join_seqs.setdefault(room_id, {})
+            peers = {cid: [n, handles.get(cid, 0), join_seqs.get(cid, 0)] for cid, (n, _) in members.items()}
+            handle = message.get("handle")
+            if client_id in handles:
+                handle = handles[client_id]
+            elif not handle or handle in by_handle:
+                handle = allocate_handle(by_handle)
+            # A worker re-announcing after a broker restart keeps its members' numbers
+            join_seq = join_seqs.get(client_id) or message.get("seq") or self.next_join_seq.get(room_id, 1)
+            self.next_join_seq[room_id] = max(self.next_join_seq.get(room_id, 1), join_seq + 1)
+            members[client_id] = (name, worker)
+            handles[client_id] = handle
+            by_handle[handle] = client_id
+            join_seqs[client_id] = join_seq
+            worker.rooms.setdefault(room_id, set()).add(client_id)
+            announce = {
+                "op": "join", "room": room_id, "cid": client_id, "name": name, "handle": handle, "seq": join_seq,
+            }
+            self._forward(room_id, encode_frame(announce), worker)
+            self.subscribers.setdefault(room_id, set()).add(worker)
+            worker.send(encode_frame({
+                "op": "joined", "ref": message.get("ref"), "handle": handle, "seq": join_seq, "peers": peers,
+            }))
+
+        elif op == "leave":
+            self._remove(worker, room_id, message["cid"], frame)
+
+        elif op in ("bcast", "tele"):
+            self._forward(room_id, frame, worker)
+
+        elif op == "send":
+            member = self.members.get(room_id, {}).get(message.get("cid"))
+            if member:
+                member[1].send(frame)
+
+        elif op == "event":
+            for other in self.workers:
+                if other is not worker:
+                    other.send(frame)
+
+    def drop(self, worker: _Worker) -> None:
+        """Remove every member of a worker that went away and tell the others."""
+        for room_id, client_ids in list(worker.rooms.items()):
+            for client_id in list(client_ids):
+                notice = encode_frame({"op": "leave", "room": room_id, "cid": client_id})
+                self._remove(worker, room_id, client_id, notice)
+
+    def _remove(self, worker: _Worker, room_id: str, client_id: str, frame: bytes) -> None:
+        members = self.members.get(room_id)
+        if not members or client_id not in members or members[client_id][1] is not worker:
+            return
+        del members[client_id]
+        handle = self.handles.get(room_id, {}).pop(client_id, None)
+        self.by_handle.get(room_id, {}).pop(handle, None)
+        self.join_seqs.get(room_id, {}).pop(client_id, None)
+        owned = worker.rooms.get(room_id)
+        if owned is not None:
+            owned.discard(client_id)
+            if not owned:
+                del worker.rooms[room_id]
+                self.subscribers.get(room_id, set()).discard(worker)
+        if not members:
+            del self.members[room_id]
+            self.handles.pop(room_id, None)
+            self.by_handle.pop(room_id, None)
+            self.join_seqs.pop(room_id, None)
+            self.next_join_seq.pop(room_id, None)
+            self.subscribers.pop(room_id, None)
+        self._forward(room_id, frame, worker)
+
+    def _forward(self, room_id: str, frame: bytes, origin: _Worker) -> None:
+        for worker in self.subscribers.get(room_id, ()):
+            if worker is not origin:
+                worker.send(frame)
+
+
+class BusRoomBackend(RoomBackend):
+    """Worker-side connection to a RoomBus broker.
+
+    If the broker is unreachable the worker keeps serving its own clients
+    and reconnects in the background, re-announcing its members.
+    """
+
+    def __init__(self, url: str, connect_timeout: float = 5.0) -> None:
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self._service: Optional[RoomService] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_ref = 0
+
+    async def start(self, service: RoomService) -> None:
+        self._service = service
+        self._runner = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=self.connect_timeout)
+        except asyncio.TimeoutError:
+            log.warning("unreachable", url=self.url, note="serving local rooms only until it is")
+
+    async def stop(self) -> None:
+        runner, self._runner = self._runner, None
+        if runner:
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+
+    async def join(
+        self, room_id: str, client_id: str, name: str, handle: Optional[int] = None, join_seq: Optional[int] = None
+    ) -> Tuple[Optional[int], Optional[int], Dict[str, Tuple[str, int, int]]]:
+        if not self._connected.is_set():
+            return None, None, {}
+        return await self._announce(room_id, client_id, name, handle, join_seq)
+
+    def leave(self, room_id: str, client_id: str) -> None:
+        self._send({"op": "leave", "room": room_id, "cid": client_id})
+
+    def publish(
+        self, room_id: str, payload: Payload, priority: int, key: Optional[Hashable], exclude_client_id: Optional[str]
+    ) -> None:
+        self._send({"op": "bcast", "room": room_id, "text": payload.text(), "prio": priority, "key": key,
+                    "exclude": exclude_client_id})
+
+    def publish_to(
+        self, room_id: str, client_id: str, payload: Payload, priority: int, key: Optional[Hashable]
+    ) -> None:
+        self._send({"op": "send", "room": room_id, "cid": client_id, "text": payload.text(), "prio": priority,
+                    "key": key})
+
+    def publish_telemetry(self, room_id: str, entries: List[list]) -> None:
+        self._send({"op": "tele", "room": room_id, "entries": entries})
+
+    def publish_event(self, event: dict) -> None:
+        self._send({"op": "event", "event": event})
+
+    def _send(self, message: dict) -> None:
+        writer = self._writer
+        if writer is not None and self._connected.is_set() and not writer.is_closing():
+            writer.write(encode_frame(message))
+
+    async def _announce(
+        self, room_id: str, client_id: str, name: str, handle: Optional[int], join_seq: Optional[int] = None
+    ) -> Tuple[Optional[int], Optional[int], Dict[str, Tuple[str, int, int]]]:
+        self._next_ref += 1
+        ref = self._next_ref
+        future = asyncio.get_running_loop().create_future()
+        self._pending[ref] = future
+        self._send({
+            "op": "join", "room": room_id, "cid": client_id, "name": name, "handle": handle, "seq": join_seq,
+            "ref": ref,
+        })
+        try:
+            reply = await asyncio.wait_for(future, timeout=self.connect_timeout)
+        except asyncio.TimeoutError:
+            return None, None, {}
+        finally:
+            self._pending.pop(ref, None)
+        if not reply:
+            return None, None, {}
+        peers = {
+            cid: (name, peer_handle, peer_seq)
+            for cid, (name, peer_handle, peer_seq) in (reply.get("peers") or {}).items()
+        }
+        return reply.get("handle"), reply.get("seq"), peers
+
+    async def _run(self) -> None:
+        delay = 0.5
+        while True:
+            try:
+                reader, writer = await open_connection(self.url)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10.0)
+                continue
+            delay = 0.5
+            self._writer = writer
+            self._connected.set()
+            resync = asyncio.create_task(self._resync())
+            try:
+                while True:
+                    message = orjson.loads(await read_frame(reader))
+                    # One bad event must not stop the runner; the stream itself is still in sync
+                    try:
+                        await self._handle(message)
+                    except Exception as e:
+                        log.exception("event-failed", url=self.url, error=str(e))
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                log.warning("connection-lost", url=self.url)
+            finally:
+                resync.cancel()
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_result(None)
+                if self._service:
+                    self._service.reset_remote()
+
+    async def _resync(self) -> None:
+        """Re-announce local members after (re)connecting to the broker."""
+        service = self._service
+        if not service:
+            return
+        for room_id, room in list(service.rooms.items()):
+            for client_id, client in list(room.clients.items()):
+                # Ask to keep the current handle and join order so connected browsers need not remap them
+                _, _, remote = await self._announce(
+                    room_id, client_id, client.name, client.handle, room.join_seqs.get(client_id)
+                )
+                for cid, (name, handle, join_seq) in remote.items():
+                    service.on_remote_join(room_id, cid, name, handle, join_seq)
+
+    async def _handle(self, message: dict) -> None:
+        service = self._service
+        op = message.get("op")
+        if op == "joined":
+            future = self._pending.get(message.get("ref"))
+            if future and not future.done():
+                future.set_result(message)
+            return
+        if not service:
+            return
+        room_id = message.get("room")
+        if op == "bcast":
+            key = tuple(message["key"]) if message.get("key") else None
+            payload = Payload(text=message["text"])
+            if message["prio"] == PRIORITY_CHAT:
+                # Every worker keeps its own copy of the room's chat history, and its clients
+                # get the seq of that copy so live messages line up with history pages
+                entry = service.record_chat(room_id, payload.message)
+                if entry is not None:
+                    payload = Payload(entry)
+            await service.deliver(room_id, payload, message["prio"], key, message.get("exclude"))
+        elif op == "send":
+            key = tuple(message["key"]) if message.get("key") else None
+            await service.deliver_to(room_id, message["cid"], Payload(text=message["text"]), message["prio"], key)
+        elif op == "join":
+            # Each worker stamps presence changes with its own roster version
+            service.on_remote_join(
+                room_id, message["cid"], message.get("name") or "Guest", message.get("handle") or 0,
+                message.get("seq") or 0,
+            )
+            await service.announce_join(room_id, message["cid"])
+        elif op == "leave":
+            await service.on_remote_leave(room_id, message["cid"])
+        elif op == "tele":
+            service.on_remote_telemetry(room_id, message.get("entries") or [])
+        elif op == "event":
+            await service.on_remote_event(message.get("event") or {})
+
+
+def create_room_backend() -> RoomBackend:
+    if settings.room_backend == "bus":
+        return BusRoomBackend(settings.room_bus_url)
+    return LocalRoomBackend()
+
+
+async def _serve_forever(url: str) -> None:
+    server = await RoomBus().serve(url)
+    log.info("listening", url=url)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Room bus broker for multi-worker deployments")
+    parser.add_argument("--listen", default=settings.room_bus_url, help="unix:///path or tcp://host:port")
+    args = parser.parse_args()
+    setup_logging()
+    scheme, path, _ = parse_address(args.listen)
+    if scheme == "unix" and os.path.exists(path):
+        os.unlink(path)
+    asyncio.run(_serve_forever(args.listen))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Live room directory: GET /rooms and a Server-Sent Events stream of changes.
+
+Entries are kept current from RoomService's presence and leave
+listeners, so listing a page never walks the rooms: counts and
+timestamps are read from the entries, and room ids are kept sorted for
+cursor pagination. Every change bumps a version that doubles as the
+ETag. Changes for the stream are coalesced and pushed at most
+ROOM_DIRECTORY_SSE_HZ times a second, one event carrying every room that
+changed since the last.
+
+The directory is per process. With ROOM_BACKEND=bus a room is listed by
+each worker that has members in it, with the room-wide count.
+"""
+from __future__ import annotations
+
+from bisect import bisect_right, insort
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Set
+import asyncio
+import secrets
+import time
+
+import orjson
+
+from app.core.config import settings
+
+if TYPE_CHECKING:
+    from app.services.rooms import RoomService
+
+
+# Events a slow stream subscriber may fall behind by before it is sent a fresh snapshot instead
+SUBSCRIBER_BACKLOG = 32
+# Seconds between comment lines that keep idle streams open through proxies
+KEEPALIVE_INTERVAL = 15.0
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class DirectoryEntry:
+    __slots__ = ("room_id", "participants", "created_at", "active_at")
+
+    def __init__(self, room_id: str, now: int) -> None:
+        self.room_id = room_id
+        self.participants = 0
+        self.created_at = now
+        # Last join or leave
+        self.active_at = now
+
+    def to_dict(self) -> dict:
+        return {
+            "roomId": self.room_id,
+            "participants": self.participants,
+            "createdAt": self.created_at,
+            "activeAt": self.active_at,
+        }
+
+
+class RoomDirectory:
+    def __init__(
+        self, room_service: "RoomService", max_hz: Optional[float] = None, page_size: Optional[int] = None
+    ) -> None:
+        self.room_service = room_service
+        self.entries: Dict[str, DirectoryEntry] = {}
+        # Room ids in order, for cursor pagination
+        self._ids: List[str] = []
+        self.participants = 0
+        self.version = 0
+        # Keeps ETags from a previous run from matching after a restart
+        self.epoch = secrets.token_hex(4)
+        self.flush_interval = 1.0 / (max_hz or settings.room_directory_sse_hz)
+        self.page_size = page_size or settings.room_directory_page_size
+        # Rooms changed since the last stream event
+        self._changed: Set[str] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._last_flush = 0.0
+        self._subscribers: Set[asyncio.Queue] = set()
+        room_service.add_presence_listener(self.on_presence)
+        room_service.add_leave_listener(self.on_leave)
+
+    async def on_presence(self, room_id: str, client_id: Optional[str] = None) -> None:
+        self.update(room_id)
+
+    def on_leave(self, room_id: str, client_id: str, room_empty: bool) -> None:
+        if room_empty:
+            self.remove(room_id)
+
+    def update(self, room_id: str) -> None:
+        """Refresh a room's count after a join or leave."""
+        size = self.room_service.room_size(room_id)
+        if not size:
+            self.remove(room_id)
+            return
+        now = _now_ms()
+        entry = self.entries.get(room_id)
+        if entry is None:
+            entry = self.entries[room_id] = DirectoryEntry(room_id, now)
+            insort(self._ids, room_id)
+        self.participants += size - entry.participants
+        entry.participants = size
+        entry.active_at = now
+        self._changed_room(room_id)
+
+    def remove(self, room_id: str) -> None:
+        entry = self.entries.pop(room_id, None)
+        if entry is None:
+            return
+        self.participants -= entry.participants
+        index = bisect_right(self._ids, room_id) - 1
+        if index >= 0 and self._ids[index] == room_id:
+            del self._ids[index]
+        self._changed_room(room_id)
+
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def page(self, cursor: Optional[str] = None, limit: Optional[int] = None) -> dict:
+        """Rooms after `cursor` in id order; `next` is the cursor for the following page."""
+        limit = max(1, min(limit or self.page_size, settings.room_directory_max_page))
+        start = bisect_right(self._ids, cursor) if cursor else 0
+        ids = self._ids[start:start + limit]
+        more = start + limit < len(self._ids)
+        return {
+            "rooms": [self.entries[room_id].to_dict() for room_id in ids],
+            "total": len(self._ids),
+            "participants": self.participants,
+            "version": self.version,
+            "next": ids[-1] if more else None,
+        }
+
+    async def stream(self) -> AsyncIterator[str]:
+        """SSE frames for one subscriber: a snapshot, then coalesced changes."""
+        queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_BACKLOG)
+        self._subscribers.add(queue)
+        try:
+            yield self._snapshot_frame()
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                # None means the subscriber fell behind and lost events
+                yield self._snapshot_frame() if frame is None else frame
+        finally:
+            self._subscribers.discard(queue)
+
+    def _changed_room(self, room_id: str) -> None:
+        self.version += 1
+        if not self._subscribers:
+            return
+        self._changed.add(room_id)
+        if self._flush_handle is None:
+            delay = max(0.0, self._last_flush + self.flush_interval - time.monotonic())
+            self._flush_handle = asyncio.get_running_loop().call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        self._last_flush = time.monotonic()
+        changed, self._changed = self._changed, set()
+        rooms = []
+        for room_id in sorted(changed):
+            entry = self.entries.get(room_id)
+            rooms.append(entry.to_dict() if entry else {"roomId": room_id, "participants": 0, "removed": True})
+        frame = _sse("rooms", self.version, {"version": self.version, "participants": self.participants, "rooms": rooms})
+        for queue in self._subscribers:
+            if queue.full():
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(frame)
+
+    def _snapshot_frame(self) -> str:
+        return _sse("snapshot", self.version, {
+            "version": self.version,
+            "participants": self.participants,
+            "rooms": [self.entries[room_id].to_dict() for room_id in self._ids],
+        })
+
+
+def _sse(event: str, event_id: int, data: dict) -> str:
+    return f"event: {event}\nid: {event_id}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
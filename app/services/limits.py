@@ -0,0 +1,101 @@
+"""Per-connection inbound rate limiting for the /ws endpoint.
+
+Each connection gets a token bucket per message type, with rates from
+settings.rate_limits. A message over its budget is dropped and counts
+as a strike. Strikes decay over RATE_LIMIT_STRIKE_WINDOW, and a
+connection that collects RATE_LIMIT_MAX_STRIKES inside the window is
+disconnected.
+"""
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+import time
+
+from app.core.config import settings
+
+
+# High-rate, loss-tolerant types: over-limit frames are dropped without telling the client
+SILENT_TYPES = frozenset({"pitch", "vad"})
+
+# Bucket for message types without their own entry in settings.rate_limits
+DEFAULT_BUCKET = "other"
+
+# Close code for connections dropped for flooding (policy violation)
+RATE_LIMIT_CLOSE_CODE = 1008
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ConnectionLimiter:
+    """Token buckets and strike count for one WebSocket connection."""
+
+    __slots__ = ("limits", "max_strikes", "strike_window", "buckets", "strikes", "_strikes_updated", "_notified_at")
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[float, float]]] = None,
+        max_strikes: Optional[int] = None,
+        strike_window: Optional[float] = None,
+    ) -> None:
+        self.limits = limits if limits is not None else settings.rate_limits
+        self.max_strikes = max_strikes if max_strikes is not None else settings.rate_limit_max_strikes
+        self.strike_window = strike_window if strike_window is not None else settings.rate_limit_strike_window
+        # Created on first use, so idle types cost nothing
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.strikes = 0.0
+        self._strikes_updated = time.monotonic()
+        self._notified_at = 0.0
+
+    def allow(self, msg_type: Optional[str]) -> bool:
+        """Spend a token for this message type. Returns False if the message must be dropped."""
+        name = msg_type if msg_type in self.limits else DEFAULT_BUCKET
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            limit = self.limits.get(name)
+            if limit is None:
+                return True
+            bucket = self.buckets[name] = TokenBucket(*limit)
+        now = time.monotonic()
+        if bucket.take(now):
+            return True
+        self._strike(now)
+        return False
+
+    @property
+    def exhausted(self) -> bool:
+        """True once the connection has earned enough strikes to be disconnected."""
+        return self.max_strikes > 0 and self.strikes >= self.max_strikes
+
+    def should_notify(self, msg_type: Optional[str]) -> bool:
+        """Whether to tell the client about a dropped message; at most once per strike window."""
+        if msg_type in SILENT_TYPES:
+            return False
+        now = time.monotonic()
+        if now - self._notified_at < self.strike_window:
+            return False
+        self._notified_at = now
+        return True
+
+    def _strike(self, now: float) -> None:
+        # Strikes leak away linearly, so only sustained abuse reaches the limit
+        if self.strike_window > 0 and self.max_strikes > 0:
+            leaked = (now - self._strikes_updated) * self.max_strikes / self.strike_window
+            self.strikes = max(0.0, self.strikes - leaked)
+        self._strikes_updated = now
+        self.strikes += 1
@@ -0,0 +1,127 @@
+"""Server-computed media policy: how much each client should send, by room size.
+
+In a full mesh every participant uploads one copy of its media per peer,
+so a fixed 640x480@24 stream saturates typical uplinks as rooms grow.
+The policy splits an uplink budget over the streams a client has to send
+(one per peer in mesh mode, one in SFU mode), picks the best video tier
+that fits, and turns video off at MEDIA_AUDIO_ONLY_AT participants in mesh
+rooms. Clients apply it with RTCRtpSender.setParameters, so nothing is
+renegotiated. It is recomputed on every join and leave and sent only
+when it changes.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional
+
+from app.core.config import settings
+from app.services.rooms import PRIORITY_SIGNALING
+from app.services.wire import Payload
+
+if TYPE_CHECKING:
+    from app.services.rooms import RoomService
+    from app.services.sfu import SfuService
+
+
+@dataclass(frozen=True)
+class VideoTier:
+    name: str
+    width: int
+    height: int
+    fps: int
+    kbps: int
+
+
+# Best first; a tier is used when its bitrate fits the per-stream budget
+VIDEO_TIERS = (
+    VideoTier("high", 640, 480, 24, 800),
+    VideoTier("medium", 480, 360, 20, 450),
+    VideoTier("low", 320, 240, 15, 250),
+    VideoTier("minimal", 160, 120, 10, 120),
+)
+
+AUDIO_KBPS = 32
+# Audio-only rooms can afford less per voice
+AUDIO_ONLY_KBPS = 24
+
+# Coalesce key: a client only needs the newest pending policy
+MEDIA_POLICY_KEY = ("media-policy",)
+
+
+def compute_policy(
+    participants: int,
+    sfu: bool = False,
+    uplink_kbps: Optional[int] = None,
+    audio_only_at: Optional[int] = None,
+) -> dict:
+    """The media-policy message for a room of this size and topology."""
+    uplink_kbps = uplink_kbps or settings.media_uplink_kbps
+    audio_only_at = audio_only_at if audio_only_at is not None else settings.media_audio_only_at
+    streams = 1 if sfu else max(1, participants - 1)
+    budget = uplink_kbps / streams - AUDIO_KBPS
+    tier = None
+    if sfu or not audio_only_at or participants < audio_only_at:
+        tier = next((t for t in VIDEO_TIERS if t.kbps <= budget), None)
+    policy = {
+        "type": "media-policy",
+        "participants": participants,
+        "video": tier is not None,
+        "tier": tier.name if tier else "audio-only",
+        "audioMaxBitrate": (AUDIO_KBPS if tier else AUDIO_ONLY_KBPS) * 1000,
+    }
+    if tier:
+        policy.update({
+            "maxBitrate": tier.kbps * 1000,
+            "maxWidth": tier.width,
+            "maxHeight": tier.height,
+            "maxFramerate": tier.fps,
+        })
+    return policy
+
+
+class MediaPolicyService:
+    """Keeps each room's policy current and pushes changes to this process's clients."""
+
+    def __init__(self, room_service: "RoomService", sfu_service: Optional["SfuService"] = None) -> None:
+        self.room_service = room_service
+        self.sfu_service = sfu_service
+        # room_id -> last policy sent to the room
+        self.policies: Dict[str, dict] = {}
+        room_service.add_presence_listener(self.update)
+        room_service.add_leave_listener(self.on_leave)
+
+    def compute(self, room_id: str) -> dict:
+        sfu = bool(self.sfu_service and self.sfu_service.is_active(room_id))
+        return compute_policy(self.room_service.room_size(room_id), sfu=sfu)
+
+    def current(self, room_id: str) -> dict:
+        policy = self.policies.get(room_id)
+        if policy is None:
+            policy = self.policies[room_id] = self.compute(room_id)
+        return policy
+
+    async def update(self, room_id: str, joining_client_id: Optional[str] = None) -> None:
+        """Recompute after a join, leave or topology switch; tell the room only if the policy changed.
+
+        A joining client is left out: the policy reaches it in its joined message.
+        """
+        if room_id not in self.room_service.rooms:
+            return
+        policy = self.compute(room_id)
+        previous = self.policies.get(room_id)
+        self.policies[room_id] = policy
+        # The first local client gets the room's policy in its joined message
+        if previous is None or _same_limits(previous, policy):
+            return
+        await self.room_service.deliver(
+            room_id, Payload(policy), PRIORITY_SIGNALING, MEDIA_POLICY_KEY, exclude_client_id=joining_client_id
+        )
+
+    def on_leave(self, room_id: str, client_id: str, room_empty: bool) -> None:
+        if room_empty:
+            self.policies.pop(room_id, None)
+
+
+def _same_limits(a: dict, b: dict) -> bool:
+    # The participant count alone does not warrant a message
+    return {k: v for k, v in a.items() if k != "participants"} == {k: v for k, v in b.items() if k != "participants"}
@@ -1,93 +1,1176 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
 from fastapi import WebSocket
-from typing import Dict, Optional, List
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, List, Set, Tuple
+import asyncio
+import secrets
+import time
 import uuid
-import orjson
 
+from app.core import metrics
+from app.core.config import settings
+from app.core.logging import get_logger
+from app.services.trace import KIND_EVICT, tracer
+from app.services.wire import Frame, Payload
 
-@dataclass
+log = get_logger("rooms")
+
+
+# Outbound priority classes, drained strictly in this order.
+PRIORITY_SIGNALING = 0
+PRIORITY_CHAT = 1
+PRIORITY_PRESENCE = 2
+PRIORITY_TELEMETRY = 3
+
+MESSAGE_PRIORITY: Dict[str, int] = {
+    "joined": PRIORITY_SIGNALING,
+    "error": PRIORITY_SIGNALING,
+    "offer": PRIORITY_SIGNALING,
+    "answer": PRIORITY_SIGNALING,
+    "ice": PRIORITY_SIGNALING,
+    "media-mode": PRIORITY_SIGNALING,
+    "media-policy": PRIORITY_SIGNALING,
+    "ping": PRIORITY_SIGNALING,
+    "pong": PRIORITY_SIGNALING,
+    "chat": PRIORITY_CHAT,
+    "history": PRIORITY_CHAT,
+    "peer-joined": PRIORITY_PRESENCE,
+    "peer-left": PRIORITY_PRESENCE,
+    "mute": PRIORITY_PRESENCE,
+    "media-state": PRIORITY_PRESENCE,
+    "telemetry": PRIORITY_TELEMETRY,
+}
+
+# Replaceable message types: only the latest pending frame per sender is kept.
+COALESCE_FIELDS: Dict[str, str] = {
+    "media-state": "clientId",
+}
+
+# Coalesce key for the per-room telemetry frame; a client only ever needs the newest one.
+TELEMETRY_KEY = ("telemetry",)
+
+# Close code used when a client is dropped for not keeping up.
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
+# Close code used when a client is reaped for missing heartbeats.
+HEARTBEAT_CLOSE_CODE = 1001
+
+# Sent to clients that have been silent for a heartbeat interval; any reply counts as a pong.
+PING_MESSAGE = {"type": "ping"}
+
+# Peer handles are u16 on the binary wire protocol; 0 means "unknown".
+MAX_HANDLE = 0xFFFF
+
+
+def allocate_handle(used: Dict[int, str]) -> int:
+    """Smallest free peer handle, so handles stay short for the life of a room."""
+    handle = len(used) + 1
+    if handle not in used and handle <= MAX_HANDLE:
+        return handle
+    for handle in range(1, MAX_HANDLE + 1):
+        if handle not in used:
+            return handle
+    raise RuntimeError("room has no free peer handles")
+
+
+def negotiation_roles(own: Tuple[int, str], peer: Tuple[int, str]) -> dict:
+    """A member's WebRTC roles toward one peer, from their (join_seq, client_id) keys.
+
+    The later joiner makes the offer and is the impolite side of perfect
+    negotiation; the earlier one answers and yields on glare. Both sides
+    compute the same answer, so exactly one of each pair offers.
+    """
+    offerer = own > peer
+    return {"offerer": offerer, "polite": not offerer}
+
+
+class OutboundQueue:
+    """Bounded, priority-ordered queue of serialized frames for one client.
+
+    Frames enqueued with a coalesce key replace any pending frame with the
+    same key in place, so the queue never holds stale telemetry. Lanes are
+    allocated on first use and released when the queue drains, so an idle
+    client's queue is a handful of pointers.
+    """
+
+    __slots__ = ("maxsize", "high_water", "over_since", "_lanes", "_latest", "_size")
+
+    def __init__(self, maxsize: int, high_water: int) -> None:
+        self.maxsize = maxsize
+        self.high_water = high_water
+        self.over_since: Optional[float] = None
+        self._lanes: Optional[List[Deque[Tuple[Optional[Hashable], Optional[Frame]]]]] = None
+        self._latest: Optional[Dict[Hashable, Frame]] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def put(self, frame: Frame, priority: int, key: Optional[Hashable] = None) -> bool:
+        """Enqueue a frame. Returns False if the queue is full."""
+        latest = self._latest
+        if key is not None and latest is not None and key in latest:
+            latest[key] = frame
+            return True
+        if self._size >= self.maxsize:
+            return False
+        lanes = self._lanes
+        if lanes is None:
+            lanes = self._lanes = [deque() for _ in range(PRIORITY_TELEMETRY + 1)]
+        if key is not None:
+            if latest is None:
+                latest = self._latest = {}
+            latest[key] = frame
+            lanes[priority].append((key, None))
+        else:
+            lanes[priority].append((None, frame))
+        self._size += 1
+        if self._size >= self.high_water and self.over_since is None:
+            self.over_since = time.monotonic()
+        return True
+
+    def pop(self) -> Optional[Frame]:
+        """Take the next frame in priority order, or None if the queue is empty."""
+        if not self._size:
+            return None
+        for lane in self._lanes:
+            if lane:
+                key, frame = lane.popleft()
+                if key is not None:
+                    frame = self._latest.pop(key)
+                self._size -= 1
+                if self._size < self.high_water:
+                    self.over_since = None
+                if not self._size:
+                    self._lanes = self._latest = None
+                return frame
+        raise RuntimeError("outbound queue size out of sync")
+
+    def push_front(self, frame: Frame) -> None:
+        """Put back a frame that could not be sent so it goes out first next time."""
+        if self._lanes is None:
+            self._lanes = [deque() for _ in range(PRIORITY_TELEMETRY + 1)]
+        self._lanes[PRIORITY_SIGNALING].appendleft((None, frame))
+        self._size += 1
+
+    def clear(self) -> None:
+        self._lanes = self._latest = None
+        self._size = 0
+        self.over_since = None
+
+
+class ChatHistory:
+    """Ring buffer of recent chat messages, capped by message count and bytes.
+
+    Entries carry consecutive sequence numbers, so paging backwards from a
+    sequence number is an index computation rather than a search.
+    """
+
+    # Rough per-entry overhead (dict, ids, timestamps) on top of the text itself
+    ENTRY_OVERHEAD = 128
+
+    def __init__(self, max_messages: int, max_bytes: int) -> None:
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.next_seq = 1
+        self._entries: Deque[Tuple[dict, int]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def append(self, message: dict) -> Optional[dict]:
+        """Store a chat message stamped with its seq, evicting the oldest ones to stay within both caps.
+
+        Returns the stamped entry, or None if the message is not kept.
+        """
+        size = (
+            self.ENTRY_OVERHEAD
+            + len(str(message.get("message", "")).encode())
+            + len(str(message.get("fromName") or "").encode())
+        )
+        if self.max_messages <= 0 or size > self.max_bytes:
+            return None
+        entry = dict(message, seq=self.next_seq)
+        self.next_seq += 1
+        self._entries.append((entry, size))
+        self.bytes += size
+        while len(self._entries) > self.max_messages or self.bytes > self.max_bytes:
+            _, dropped = self._entries.popleft()
+            self.bytes -= dropped
+        return entry
+
+    def before(self, seq: Optional[int], limit: int) -> Tuple[List[dict], bool]:
+        """Up to `limit` messages older than `seq` (newest if None), oldest first, plus whether more exist."""
+        if not self._entries or limit <= 0:
+            return [], False
+        first_seq = self._entries[0][0]["seq"]
+        end = len(self._entries) if seq is None else max(0, min(seq - first_seq, len(self._entries)))
+        start = max(0, end - limit)
+        return [self._entries[i][0] for i in range(start, end)], start > 0
+
+
+@dataclass(slots=True)
 class Client:
     client_id: str
+    room_id: str
     name: str
     websocket: WebSocket
+    queue: OutboundQueue
+    handle: int = 0
+    binary: bool = False
+    # Runs only while the queue has frames to send
+    writer: Optional[asyncio.Task] = field(default=None, repr=False)
+    resume_token: str = ""
+    # Whop user behind the session, for revoking access
+    user_id: Optional[str] = None
+    # Set while the connection is gone and the session waits to be resumed
+    expiry: Optional[asyncio.TimerHandle] = field(default=None, repr=False)
+    # time.monotonic() of the last inbound frame, for the heartbeat sweep
+    last_seen: float = field(default_factory=time.monotonic, repr=False)
+
+    @property
+    def suspended(self) -> bool:
+        return self.expiry is not None
+
+
+class RoomBackend:
+    """Carries room membership and fan-out between server processes.
+
+    RoomService always delivers to the clients connected to this process;
+    the backend forwards everything else. Incoming traffic from other
+    processes is handed back through RoomService.deliver/deliver_to and the
+    on_remote_* hooks.
+    """
+
+    async def start(self, service: "RoomService") -> None:
+        raise NotImplementedError
+
+    async def stop(self) -> None:
+        raise NotImplementedError
+
+    async def join(
+        self, room_id: str, client_id: str, name: str, handle: Optional[int] = None, join_seq: Optional[int] = None
+    ) -> Tuple[Optional[int], Optional[int], Dict[str, Tuple[str, int, int]]]:
+        """Announce a local member.
+
+        Returns the member's room-wide handle and join sequence number (None
+        to allocate locally) and the room's remote members as
+        client_id -> (name, handle, join_seq).
+        """
+        raise NotImplementedError
+
+    def leave(self, room_id: str, client_id: str) -> None:
+        raise NotImplementedError
+
+    def publish(
+        self, room_id: str, payload: Payload, priority: int, key: Optional[Hashable], exclude_client_id: Optional[str]
+    ) -> None:
+        raise NotImplementedError
+
+    def publish_to(
+        self, room_id: str, client_id: str, payload: Payload, priority: int, key: Optional[Hashable]
+    ) -> None:
+        raise NotImplementedError
+
+    def publish_telemetry(self, room_id: str, entries: List[list]) -> None:
+        raise NotImplementedError
+
+    def publish_event(self, event: dict) -> None:
+        """Hand a process-wide event (not tied to a room) to every other process."""
+        raise NotImplementedError
+
+
+class LocalRoomBackend(RoomBackend):
+    """Single-process backend: every member is local, so there is nothing to forward."""
+
+    async def start(self, service: "RoomService") -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def join(
+        self, room_id: str, client_id: str, name: str, handle: Optional[int] = None, join_seq: Optional[int] = None
+    ) -> Tuple[Optional[int], Optional[int], Dict[str, Tuple[str, int, int]]]:
+        return None, None, {}
+
+    def leave(self, room_id: str, client_id: str) -> None:
+        pass
+
+    def publish(
+        self, room_id: str, payload: Payload, priority: int, key: Optional[Hashable], exclude_client_id: Optional[str]
+    ) -> None:
+        pass
+
+    def publish_to(
+        self, room_id: str, client_id: str, payload: Payload, priority: int, key: Optional[Hashable]
+    ) -> None:
+        pass
+
+    def publish_telemetry(self, room_id: str, entries: List[list]) -> None:
+        pass
+
+    def publish_event(self, event: dict) -> None:
+        pass
 
 
 class Room:
-    def __init__(self, room_id: str) -> None:
+    """One room's members and state.
+
+    The chat history, the telemetry map and the roster log are allocated
+    on first use, and the telemetry map is released again once no member
+    has any. Roster log entries are tuples rather than the message dicts
+    they were sent as.
+    """
+
+    __slots__ = (
+        "room_id", "clients", "roster_version", "_roster_log", "_roster_log_size", "_chat",
+        "_chat_limits", "remote", "handles", "by_handle", "join_seqs", "next_join_seq", "_telemetry",
+    )
+
+    def __init__(
+        self,
+        room_id: str,
+        chat: Optional[ChatHistory] = None,
+        roster_log_size: Optional[int] = None,
+        chat_limits: Optional[Tuple[int, int]] = None,
+    ) -> None:
         self.room_id = room_id
         self.clients: Dict[str, Client] = {}
+        # Bumped on every presence change; the log holds the recent peer-joined/peer-left deltas
+        # as (type, client_id, name, handle, join_seq, version)
+        self.roster_version = 0
+        self._roster_log: Optional[Deque[tuple]] = None
+        self._roster_log_size = roster_log_size or settings.roster_log_size
+        # Allocated with the first chat message; most rooms never see one
+        self._chat = chat
+        self._chat_limits = chat_limits or (settings.chat_history_messages, settings.chat_history_bytes)
+        # Members connected to other processes (client_id -> name), mirrored from the backend
+        self.remote: Dict[str, str] = {}
+        # Short wire handles for every member, local and remote
+        self.handles: Dict[str, int] = {}
+        self.by_handle: Dict[int, str] = {}
+        # Room-wide join order of every member; it decides who offers to whom (see negotiation_roles)
+        self.join_seqs: Dict[str, int] = {}
+        self.next_join_seq = 1
+        # client_id -> [pitch_hz, speaking], flushed by RoomService's telemetry tick
+        self._telemetry: Optional[Dict[str, List[int]]] = None
+
+    @property
+    def chat(self) -> ChatHistory:
+        if self._chat is None:
+            self._chat = ChatHistory(*self._chat_limits)
+        return self._chat
+
+    @property
+    def has_chat(self) -> bool:
+        return self._chat is not None
+
+    @property
+    def telemetry(self) -> Dict[str, List[int]]:
+        if self._telemetry is None:
+            self._telemetry = {}
+        return self._telemetry
+
+    @property
+    def has_telemetry(self) -> bool:
+        return bool(self._telemetry)
+
+    def drop_telemetry(self, client_id: str) -> bool:
+        """Forget a member's telemetry; returns whether it had any."""
+        telemetry = self._telemetry
+        if not telemetry or telemetry.pop(client_id, None) is None:
+            return False
+        if not telemetry:
+            self._telemetry = None
+        return True
 
     def add_client(self, client: Client) -> None:
         self.clients[client.client_id] = client
 
-    def remove_client(self, client_id: str) -> None:
-        if client_id in self.clients:
-            del self.clients[client_id]
+    def remove_client(self, client_id: str) -> Optional[Client]:
+        self.drop_telemetry(client_id)
+        self.forget(client_id)
+        return self.clients.pop(client_id, None)
+
+    def roster(self) -> List[dict]:
+        """Every member (local and remote) as new peer dicts.
+
+        Built per call rather than cached: every join changes the roster
+        before the joiner asks for it, and a cache would keep a dict per
+        member alive in every idle room.
+        """
+        return [
+            {
+                "clientId": cid,
+                "name": client.name,
+                "handle": self.handles.get(cid, client.handle),
+                "joinSeq": self.join_seqs.get(cid, 0),
+            }
+            for cid, client in self.clients.items()
+        ] + [
+            {
+                "clientId": cid,
+                "name": name,
+                "handle": self.handles.get(cid, 0),
+                "joinSeq": self.join_seqs.get(cid, 0),
+            }
+            for cid, name in self.remote.items()
+        ]
+
+    def record_roster_change(self, message: dict) -> dict:
+        """Stamp a peer-joined/peer-left message with the next roster version and log it."""
+        self.roster_version += 1
+        message["rosterVersion"] = self.roster_version
+        if self._roster_log is None:
+            self._roster_log = deque(maxlen=self._roster_log_size)
+        self._roster_log.append((
+            message["type"], message["clientId"], message.get("name"), message.get("handle", 0),
+            message.get("joinSeq"), self.roster_version,
+        ))
+        return message
+
+    def roster_since(self, version: int) -> Optional[List[dict]]:
+        """Deltas after `version`, or None if the log no longer reaches back that far."""
+        if version >= self.roster_version:
+            return []
+        log = self._roster_log
+        if not log or version + 1 < log[0][5]:
+            return None
+        deltas = []
+        for i in range(version + 1 - log[0][5], len(log)):
+            msg_type, client_id, name, handle, join_seq, entry_version = log[i]
+            delta = {"type": msg_type, "clientId": client_id, "name": name, "handle": handle}
+            if join_seq is not None:
+                delta["joinSeq"] = join_seq
+            delta["rosterVersion"] = entry_version
+            deltas.append(delta)
+        return deltas
+
+    def assign_handle(self, client_id: str, handle: Optional[int] = None) -> int:
+        if not handle or self.by_handle.get(handle, client_id) != client_id:
+            handle = self.handles.get(client_id) or allocate_handle(self.by_handle)
+        self.release_handle(client_id)
+        self.handles[client_id] = handle
+        self.by_handle[handle] = client_id
+        return handle
+
+    def release_handle(self, client_id: str) -> None:
+        handle = self.handles.pop(client_id, None)
+        if handle is not None and self.by_handle.get(handle) == client_id:
+            del self.by_handle[handle]
+
+    def assign_join_seq(self, client_id: str, join_seq: Optional[int] = None) -> int:
+        """Keep the backend's room-wide sequence number, or allocate the next local one."""
+        join_seq = join_seq or self.join_seqs.get(client_id) or self.next_join_seq
+        self.next_join_seq = max(self.next_join_seq, join_seq + 1)
+        self.join_seqs[client_id] = join_seq
+        return join_seq
+
+    def forget(self, client_id: str) -> None:
+        """Release a departed member's handle and join sequence number."""
+        self.release_handle(client_id)
+        self.join_seqs.pop(client_id, None)
 
 
 class RoomService:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        send_queue_max: Optional[int] = None,
+        send_queue_high_water: Optional[int] = None,
+        slow_consumer_timeout: Optional[float] = None,
+        telemetry_hz: Optional[float] = None,
+        backend: Optional[RoomBackend] = None,
+        ice_bundle_window_ms: Optional[float] = None,
+        chat_history_messages: Optional[int] = None,
+        chat_history_bytes: Optional[int] = None,
+        session_resume_grace: Optional[float] = None,
+        roster_log_size: Optional[int] = None,
+        heartbeat_interval: Optional[float] = None,
+        heartbeat_timeout: Optional[float] = None,
+    ) -> None:
         self.rooms: Dict[str, Room] = {}
+        self.backend = backend or LocalRoomBackend()
+        self.send_queue_max = send_queue_max or settings.send_queue_max
+        self.send_queue_high_water = send_queue_high_water or settings.send_queue_high_water
+        self.slow_consumer_timeout = (
+            slow_consumer_timeout if slow_consumer_timeout is not None else settings.slow_consumer_timeout
+        )
+        self.telemetry_hz = telemetry_hz or settings.telemetry_hz
+        self._telemetry_dirty: Set[str] = set()
+        # Rooms whose local clients' telemetry must be published to other processes
+        self._telemetry_publish: Set[str] = set()
+        self._telemetry_task: Optional[asyncio.Task] = None
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else settings.heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout if heartbeat_timeout is not None else settings.heartbeat_timeout
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.ice_bundle_window = (
+            ice_bundle_window_ms if ice_bundle_window_ms is not None else settings.ice_bundle_window_ms
+        ) / 1000.0
+        # (room_id, from, to) -> candidates waiting for the bundle window to close
+        self._ice_pending: Dict[Tuple[str, str, str], List] = {}
+        self.chat_history_messages = (
+            chat_history_messages if chat_history_messages is not None else settings.chat_history_messages
+        )
+        self.chat_history_bytes = chat_history_bytes or settings.chat_history_bytes
+        self.roster_log_size = roster_log_size or settings.roster_log_size
+        self.session_resume_grace = (
+            session_resume_grace if session_resume_grace is not None else settings.session_resume_grace
+        )
+        # resume token -> (room_id, client_id)
+        self._sessions: Dict[str, Tuple[str, str]] = {}
+        # Whop user id -> that user's local sessions as (room_id, client_id)
+        self._users: Dict[str, Set[Tuple[str, str]]] = {}
+        # Called as (room_id, client_id, room_empty) whenever a local client leaves for good
+        self._leave_listeners: List[Callable[[str, str, bool], None]] = []
+        # Awaited as (room_id, client_id) after this process announces a peer-joined (client_id is
+        # the member that joined, who has not been sent joined yet) or a peer-left (client_id is None)
+        self._presence_listeners: List[Callable[[str, Optional[str]], Awaitable[None]]] = []
+        # Awaited with each event another process sent through RoomBackend.publish_event
+        self._event_listeners: List[Callable[[dict], Awaitable[None]]] = []
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        await self.backend.start(self)
+        if self._telemetry_task is None:
+            self._telemetry_task = asyncio.create_task(self._telemetry_loop())
+        if self._heartbeat_task is None and self.heartbeat_interval > 0 and self.heartbeat_timeout > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self) -> None:
+        tasks = [self._telemetry_task, self._heartbeat_task]
+        self._telemetry_task = self._heartbeat_task = None
+        for task in tasks:
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        await self.backend.stop()
+
+    def add_leave_listener(self, listener: Callable[[str, str, bool], None]) -> None:
+        self._leave_listeners.append(listener)
+
+    def add_presence_listener(self, listener: Callable[[str, Optional[str]], Awaitable[None]]) -> None:
+        self._presence_listeners.append(listener)
+
+    def add_event_listener(self, listener: Callable[[dict], Awaitable[None]]) -> None:
+        self._event_listeners.append(listener)
+
+    def publish_event(self, event: dict) -> None:
+        """Send an event to the other processes' event listeners (not to this process's)."""
+        self.backend.publish_event(event)
+
+    async def on_remote_event(self, event: dict) -> None:
+        for listener in self._event_listeners:
+            await listener(event)
 
     def get_or_create(self, room_id: str) -> Room:
         room = self.rooms.get(room_id)
         if not room:
-            room = Room(room_id)
+            room = Room(room_id, roster_log_size=self.roster_log_size,
+                        chat_limits=(self.chat_history_messages, self.chat_history_bytes))
             self.rooms[room_id] = room
         return room
 
-    def join(self, room_id: str, websocket: WebSocket, name: str) -> Client:
+    async def join(
+        self, room_id: str, websocket: WebSocket, name: str, binary: bool = False, user_id: Optional[str] = None
+    ) -> Client:
         room = self.get_or_create(room_id)
-        client = Client(client_id=str(uuid.uuid4()), name=name, websocket=websocket)
+        client = Client(
+            client_id=str(uuid.uuid4()),
+            room_id=room_id,
+            name=name,
+            websocket=websocket,
+            queue=OutboundQueue(self.send_queue_max, self.send_queue_high_water),
+            binary=binary,
+            user_id=user_id,
+        )
+        if self.session_resume_grace > 0:
+            client.resume_token = secrets.token_urlsafe(18)
+            self._sessions[client.resume_token] = (room_id, client.client_id)
+        if user_id:
+            self._users.setdefault(user_id, set()).add((room_id, client.client_id))
         room.add_client(client)
+        handle, join_seq, remote = await self.backend.join(room_id, client.client_id, name)
+        if self.rooms.get(room_id) is room:
+            client.handle = room.assign_handle(client.client_id, handle)
+            room.assign_join_seq(client.client_id, join_seq)
+            self.set_remote_members(room_id, remote)
         return client
 
-    def leave(self, room_id: str, client_id: str) -> None:
+    def leave(self, room_id: str, client_id: str) -> Optional[Client]:
+        """Remove a client and stop its writer. Returns the removed client, if any."""
         room = self.rooms.get(room_id)
         if not room:
-            return
-        room.remove_client(client_id)
+            return None
+        client = room.remove_client(client_id)
         if not room.clients:
             del self.rooms[room_id]
+        if client:
+            self.backend.leave(room_id, client_id)
+            client.queue.clear()
+            self._sessions.pop(client.resume_token, None)
+            if client.user_id:
+                sessions = self._users.get(client.user_id)
+                if sessions is not None:
+                    sessions.discard((room_id, client_id))
+                    if not sessions:
+                        del self._users[client.user_id]
+            if client.expiry:
+                client.expiry.cancel()
+                client.expiry = None
+            if client.writer and client.writer is not asyncio.current_task():
+                client.writer.cancel()
+            for listener in self._leave_listeners:
+                listener(room_id, client_id, room_id not in self.rooms)
+        return client
 
-    async def broadcast(self, room_id: str, message: dict, exclude_client_id: Optional[str] = None) -> None:
+    async def resume(self, room_id: str, token: str, websocket: WebSocket, binary: bool = False) -> Optional[Client]:
+        """Reattach a session to a new connection and replay what was buffered for it.
+
+        The writer is not restarted here: the caller sends `joined` with
+        send_first, which puts it ahead of the buffered frames and starts
+        the writer. Returns None if the token is unknown or expired, in
+        which case the caller falls back to a fresh join.
+        """
+        session = self._sessions.get(token)
+        if not session or session[0] != room_id:
+            return None
         room = self.rooms.get(room_id)
-        if not room:
+        client = room.clients.get(session[1]) if room else None
+        if not client:
+            return None
+        if client.binary != binary:
+            # Buffered frames are encoded for the old protocol
+            await self.disconnect(room_id, client.client_id)
+            return None
+        if client.expiry:
+            client.expiry.cancel()
+            client.expiry = None
+        if client.writer:
+            client.writer.cancel()
+            client.writer = None
+        if client.websocket is not websocket:
+            # The old connection may not have noticed it is dead yet
+            self._spawn(self._close(client.websocket))
+        client.websocket = websocket
+        client.queue.over_since = None
+        client.last_seen = time.monotonic()
+        return client
+
+    def suspend(self, room_id: str, client_id: str) -> bool:
+        """Hold a client whose connection dropped; its messages queue up until resume or expiry."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if not client or not client.resume_token or self.session_resume_grace <= 0:
+            return False
+        if client.suspended:
+            return True
+        if client.writer and client.writer is not asyncio.current_task():
+            client.writer.cancel()
+        client.writer = None
+        client.expiry = asyncio.get_running_loop().call_later(
+            self.session_resume_grace, self._expire, room_id, client_id, client.resume_token
+        )
+        return True
+
+    async def connection_closed(self, room_id: str, client_id: str, websocket: WebSocket, resumable: bool = True) -> None:
+        """Handle the end of a client's connection: suspend it for resumption or disconnect it."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if not client or client.websocket is not websocket:
+            # Already evicted, or resumed on another connection
             return
-        text = orjson.dumps(message).decode()
-        for cid, client in list(room.clients.items()):
-            if exclude_client_id and cid == exclude_client_id:
+        if not (resumable and self.suspend(room_id, client_id)):
+            await self.disconnect(room_id, client_id)
+
+    def _expire(self, room_id: str, client_id: str, token: str) -> None:
+        if self._sessions.get(token) == (room_id, client_id):
+            self._spawn(self.disconnect(room_id, client_id))
+
+    def touch(self, room_id: str, client_id: str) -> None:
+        """Record inbound traffic from a client; any frame counts as a heartbeat."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if client:
+            client.last_seen = time.monotonic()
+
+    async def sweep(self) -> None:
+        """Ping clients idle for a heartbeat interval and reap those silent past the timeout.
+
+        One pass over every room replaces per-connection timers. Reaped
+        clients are suspended for resumption like any dropped connection,
+        so peers get their peer-left when the grace period ends (or at
+        once when resumption is disabled).
+        """
+        now = time.monotonic()
+        ping = Payload(PING_MESSAGE)
+        stale: List[Tuple[str, str]] = []
+        lagging: List[Tuple[str, str]] = []
+        for room_id, room in self.rooms.items():
+            for cid, client in room.clients.items():
+                if client.suspended:
+                    continue
+                idle = now - client.last_seen
+                if idle >= self.heartbeat_timeout:
+                    stale.append((room_id, cid))
+                elif idle >= self.heartbeat_interval:
+                    if not self._enqueue(client, ping.encode(client.binary, room.handles), PRIORITY_SIGNALING, None):
+                        lagging.append((room_id, cid))
+        for room_id, cid in stale:
+            await self.reap(room_id, cid)
+        for room_id, cid in lagging:
+            await self.evict(room_id, cid)
+
+    async def reap(self, room_id: str, client_id: str) -> None:
+        """Drop a connection that stopped answering heartbeats."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if not client or client.suspended:
+            return
+        log.info("heartbeat-timeout", room=room_id, client=client_id)
+        metrics.heartbeat_timeouts.inc()
+        websocket = client.websocket
+        if not self.suspend(room_id, client_id):
+            await self.disconnect(room_id, client_id)
+        self._spawn(self._close(websocket, HEARTBEAT_CLOSE_CODE))
+
+    async def disconnect(self, room_id: str, client_id: str) -> None:
+        """Remove a client and tell the rest of the room it left."""
+        client = self.leave(room_id, client_id)
+        if client:
+            # Other processes announce it themselves when the backend reports the leave
+            await self.announce_leave(room_id, client_id, client.name, client.handle)
+
+    async def disconnect_user(self, user_id: str, message: dict, code: int = SLOW_CONSUMER_CLOSE_CODE) -> int:
+        """End every local session of a user, suspended ones included, telling each connection why.
+
+        Returns the number of sessions ended. The notice bypasses the
+        outbound queue, which is dropped with the client.
+        """
+        ended = 0
+        payload = Payload(message)
+        for room_id, client_id in list(self._users.get(user_id, ())):
+            room = self.rooms.get(room_id)
+            client = room.clients.get(client_id) if room else None
+            if not client:
                 continue
-            try:
-                await client.websocket.send_text(text)
-            except Exception:
-                self.leave(room_id, cid)
+            websocket, suspended = client.websocket, client.suspended
+            frame = payload.encode(client.binary, room.handles)
+            await self.disconnect(room_id, client_id)
+            ended += 1
+            if not suspended:
+                self._spawn(self._notify_and_close(websocket, frame, code))
+        return ended
 
-    async def send_to(self, room_id: str, client_id: str, message: dict) -> None:
+    async def announce_join(self, room_id: str, client_id: str) -> None:
+        """Send a versioned peer-joined for a (local or remote) member to this process's clients."""
         room = self.rooms.get(room_id)
         if not room:
             return
         client = room.clients.get(client_id)
+        message = room.record_roster_change({
+            "type": "peer-joined",
+            "clientId": client_id,
+            "name": client.name if client else room.remote.get(client_id),
+            "handle": room.handles.get(client_id, 0),
+            # One payload goes to every member, so each works out its roles from this (see negotiation_roles)
+            "joinSeq": room.join_seqs.get(client_id, 0),
+        })
+        await self.deliver(room_id, Payload(message), PRIORITY_PRESENCE, exclude_client_id=client_id)
+        for listener in self._presence_listeners:
+            await listener(room_id, client_id)
+
+    async def announce_leave(self, room_id: str, client_id: str, name: Optional[str], handle: int) -> None:
+        """Send a versioned peer-left to this process's clients; the leaver's handle is already released."""
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        message = room.record_roster_change({
+            "type": "peer-left",
+            "clientId": client_id,
+            "name": name,
+            "handle": handle,
+        })
+        await self.deliver(room_id, Payload(message), PRIORITY_PRESENCE)
+        for listener in self._presence_listeners:
+            await listener(room_id, None)
+
+    def roster(self, room_id: str, exclude_client_id: Optional[str] = None) -> Tuple[List[dict], int]:
+        """Snapshot of the room's members and the roster version it corresponds to.
+
+        With exclude_client_id, the snapshot is for that member: each peer
+        also carries the member's offerer/polite roles toward it.
+        """
+        room = self.rooms.get(room_id)
+        if not room:
+            return [], 0
+        peers = room.roster()
+        if exclude_client_id:
+            own = (room.join_seqs.get(exclude_client_id, 0), exclude_client_id)
+            peers = [p for p in peers if p["clientId"] != exclude_client_id]
+            for peer in peers:
+                peer.update(negotiation_roles(own, (peer["joinSeq"], peer["clientId"])))
+        return peers, room.roster_version
+
+    def join_seq(self, room_id: str, client_id: str) -> int:
+        room = self.rooms.get(room_id)
+        return room.join_seqs.get(client_id, 0) if room else 0
+
+    def roster_sync(self, room_id: str, client_id: str, since: int) -> dict:
+        """Reply to a client that saw a roster version gap: the missing deltas, or a snapshot."""
+        room = self.rooms.get(room_id)
+        deltas = room.roster_since(since) if room and since >= 0 else None
+        if deltas is not None:
+            return {"type": "roster", "version": room.roster_version, "deltas": deltas}
+        peers, version = self.roster(room_id, exclude_client_id=client_id)
+        return {"type": "roster", "version": version, "peers": peers}
+
+    async def broadcast(self, room_id: str, message: dict, exclude_client_id: Optional[str] = None) -> None:
+        started = time.perf_counter()
+        payload = Payload(message)
+        priority, key = self._classify(message)
+        # Published even if the last local client just left, so other processes still hear about it
+        self.backend.publish(room_id, payload, priority, key, exclude_client_id)
+        await self.deliver(room_id, payload, priority, key, exclude_client_id)
+        metrics.broadcast_seconds.observe(time.perf_counter() - started)
+
+    async def send_to(self, room_id: str, client_id: str, message: dict) -> None:
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        started = time.perf_counter()
+        priority, key = self._classify(message)
+        if client_id in room.clients:
+            await self.deliver_to(room_id, client_id, Payload(message), priority, key)
+        elif client_id in room.remote:
+            self.backend.publish_to(room_id, client_id, Payload(message), priority, key)
+        metrics.send_to_seconds.observe(time.perf_counter() - started)
+
+    async def send_first(self, room_id: str, client_id: str, message: dict) -> None:
+        """Queue a message for a local client ahead of everything already buffered for it."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
         if not client:
             return
-        await client.websocket.send_text(orjson.dumps(message).decode())
+        frame = Payload(message).encode(client.binary, room.handles)
+        client.queue.push_front(frame)
+        self._start_writer(client)
+        if tracer.enabled:
+            tracer.outbound(client, room_id, message, len(frame))
 
-    def list_peers(self, room_id: str, exclude_client_id: Optional[str] = None) -> List[dict]:
+    async def deliver(
+        self,
+        room_id: str,
+        payload: Payload,
+        priority: int,
+        key: Optional[Hashable] = None,
+        exclude_client_id: Optional[str] = None,
+    ) -> None:
+        """Queue a payload for every local client in a room, encoding it once per protocol."""
         room = self.rooms.get(room_id)
         if not room:
-            return []
-        peers = []
+            return
+        handles = room.handles
+        lagging = []
         for cid, client in room.clients.items():
             if exclude_client_id and cid == exclude_client_id:
                 continue
-            peers.append({"clientId": cid, "name": client.name})
-        return peers
+            frame = payload.encode(client.binary, handles)
+            if not self._enqueue(client, frame, priority, key):
+                lagging.append(cid)
+            elif tracer.enabled:
+                tracer.outbound(client, room_id, payload.message, len(frame))
+        for cid in lagging:
+            await self.evict(room_id, cid)
+
+    async def deliver_to(
+        self, room_id: str, client_id: str, payload: Payload, priority: int, key: Optional[Hashable] = None
+    ) -> None:
+        """Queue a payload for one local client."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if not client:
+            return
+        frame = payload.encode(client.binary, room.handles)
+        if not self._enqueue(client, frame, priority, key):
+            await self.evict(room_id, client_id)
+        elif tracer.enabled:
+            tracer.outbound(client, room_id, payload.message, len(frame))
+
+    def set_remote_members(self, room_id: str, members: Dict[str, Tuple[str, int, int]]) -> None:
+        """Add the remote members a backend reported for a join.
+
+        Members announced while the join was in flight arrive before the
+        reply is handled, so the ones already known are kept, not replaced.
+        """
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        for cid, (name, handle, join_seq) in members.items():
+            self.on_remote_join(room_id, cid, name, handle, join_seq)
+
+    def on_remote_join(self, room_id: str, client_id: str, name: str, handle: int, join_seq: int = 0) -> None:
+        room = self.rooms.get(room_id)
+        if room and client_id not in room.clients:
+            room.remote[client_id] = name
+            room.assign_handle(client_id, handle)
+            room.assign_join_seq(client_id, join_seq)
+
+    def handle_table(self, room_id: str) -> Dict[int, str]:
+        """handle -> client_id for decoding binary frames from a room's clients."""
+        room = self.rooms.get(room_id)
+        return room.by_handle if room else {}
+
+    async def on_remote_leave(self, room_id: str, client_id: str) -> None:
+        """Forget a member of another process and announce it to this process's clients."""
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        name = room.remote.pop(client_id, None)
+        if room.drop_telemetry(client_id):
+            self._telemetry_dirty.add(room_id)
+        handle = room.handles.get(client_id, 0)
+        room.forget(client_id)
+        if name is not None:
+            await self.announce_leave(room_id, client_id, name, handle)
+
+    def on_remote_telemetry(self, room_id: str, entries: List[list]) -> None:
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        for cid, hz, speaking in entries:
+            if cid in room.remote:
+                room.telemetry[cid] = [hz, speaking]
+        self._telemetry_dirty.add(room_id)
+
+    def reset_remote(self) -> None:
+        """Drop every remote member, e.g. after losing the backend connection."""
+        for room in self.rooms.values():
+            for cid in room.remote:
+                room.drop_telemetry(cid)
+                room.forget(cid)
+            room.remote.clear()
+
+    async def evict(self, room_id: str, client_id: str) -> None:
+        """Drop a client that cannot keep up, announcing it as having left."""
+        room = self.rooms.get(room_id)
+        client = room.clients.get(client_id) if room else None
+        if not client:
+            return
+        metrics.evictions.inc()
+        if tracer.enabled:
+            tracer.event(KIND_EVICT, 0, client_id, room_id)
+        await self.disconnect(room_id, client_id)
+        self._spawn(self._close(client.websocket))
+
+    async def post_chat(self, room_id: str, client_id: str, name: Optional[str], text: str) -> None:
+        """Keep a chat message in the room's history and broadcast it with its seq."""
+        message = {
+            "type": "chat",
+            "fromClientId": client_id,
+            "fromName": name,
+            "message": text,
+            "ts": int(time.time() * 1000),
+        }
+        await self.broadcast(room_id, self.record_chat(room_id, message) or message)
+
+    def record_chat(self, room_id: str, message: dict) -> Optional[dict]:
+        """Add a message to the room's history; returns it stamped with its seq, or None if not kept."""
+        room = self.rooms.get(room_id)
+        return room.chat.append(message) if room else None
+
+    def chat_history(self, room_id: str, before: Optional[int] = None, limit: int = 50) -> Tuple[List[dict], bool]:
+        room = self.rooms.get(room_id)
+        if not room or not room.has_chat:
+            return [], False
+        return room.chat.before(before, limit)
+
+    def send_ice(self, room_id: str, from_client_id: str, to_client_id: Optional[str], candidate) -> None:
+        """Queue an ICE candidate; candidates for the same pair within the window go out as one frame."""
+        if not to_client_id:
+            return
+        if self.ice_bundle_window <= 0:
+            self._spawn(self.send_to(room_id, to_client_id, {
+                "type": "ice", "from": from_client_id, "candidate": candidate,
+            }))
+            return
+        key = (room_id, from_client_id, to_client_id)
+        pending = self._ice_pending.get(key)
+        if pending is None:
+            self._ice_pending[key] = [candidate]
+            asyncio.get_running_loop().call_later(self.ice_bundle_window, self._flush_ice, key)
+        else:
+            pending.append(candidate)
+
+    def _flush_ice(self, key: Tuple[str, str, str]) -> None:
+        candidates = self._ice_pending.pop(key, None)
+        if not candidates:
+            return
+        room_id, from_client_id, to_client_id = key
+        message = {"type": "ice", "from": from_client_id}
+        if len(candidates) == 1:
+            message["candidate"] = candidates[0]
+        else:
+            message["candidates"] = candidates
+        self._spawn(self.send_to(room_id, to_client_id, message))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def update_telemetry(
+        self,
+        room_id: str,
+        client_id: str,
+        hz: Optional[float] = None,
+        speaking: Optional[bool] = None,
+    ) -> None:
+        """Record a client's latest pitch and/or VAD value for the next telemetry tick."""
+        room = self.rooms.get(room_id)
+        if not room or client_id not in room.clients:
+            return
+        entry = room.telemetry.get(client_id)
+        if entry is None:
+            entry = room.telemetry[client_id] = [0, 0]
+        if hz is not None:
+            entry[0] = round(hz) if isinstance(hz, (int, float)) and 0 < hz < 2000 else 0
+        if speaking is not None:
+            entry[1] = 1 if speaking else 0
+        self._telemetry_dirty.add(room_id)
+        self._telemetry_publish.add(room_id)
+
+    async def flush_telemetry(self) -> None:
+        """Send one telemetry frame per recipient in every room whose values changed."""
+        publish, self._telemetry_publish = self._telemetry_publish, set()
+        for room_id in publish:
+            room = self.rooms.get(room_id)
+            if room and room.has_telemetry:
+                telemetry = room.telemetry
+                self.backend.publish_telemetry(room_id, [
+                    [cid, *telemetry[cid]] for cid in room.clients if cid in telemetry
+                ])
+        dirty, self._telemetry_dirty = self._telemetry_dirty, set()
+        for room_id in dirty:
+            room = self.rooms.get(room_id)
+            if not room or not room.has_telemetry:
+                continue
+            payload = Payload({
+                "type": "telemetry",
+                "peers": [[cid, hz, speaking] for cid, (hz, speaking) in room.telemetry.items()],
+            })
+            await self.deliver(room_id, payload, PRIORITY_TELEMETRY, TELEMETRY_KEY)
+
+    def list_peers(self, room_id: str, exclude_client_id: Optional[str] = None) -> List[dict]:
+        return self.roster(room_id, exclude_client_id)[0]
+
+    def room_size(self, room_id: str) -> int:
+        """Members of a room across all processes."""
+        room = self.rooms.get(room_id)
+        return len(room.clients) + len(room.remote) if room else 0
 
     def get_name(self, room_id: str, client_id: str) -> Optional[str]:
         room = self.rooms.get(room_id)
         if not room:
             return None
         client = room.clients.get(client_id)
-        return client.name if client else None
+        return client.name if client else room.remote.get(client_id)
+
+    @staticmethod
+    def _classify(message: dict) -> Tuple[int, Optional[Hashable]]:
+        msg_type = message.get("type")
+        priority = MESSAGE_PRIORITY.get(msg_type, PRIORITY_PRESENCE)
+        coalesce_field = COALESCE_FIELDS.get(msg_type)
+        key = (msg_type, message.get(coalesce_field)) if coalesce_field else None
+        return priority, key
+
+    def _enqueue(self, client: Client, frame: Frame, priority: int, key: Optional[Hashable]) -> bool:
+        """Queue a frame for a client. Returns False if the client should be evicted."""
+        queue = client.queue
+        if not queue.put(frame, priority, key):
+            return False
+        if client.suspended:
+            # Nothing drains the queue until resume; only overflowing it ends the session early
+            return True
+        over_since = queue.over_since
+        if over_since is not None and time.monotonic() - over_since >= self.slow_consumer_timeout:
+            return False
+        if client.writer is None:
+            self._start_writer(client)
+        return True
+
+    def _start_writer(self, client: Client) -> None:
+        """Drain a client's queue in a task that exits once it is empty; idle clients hold no task."""
+        if client.writer is None and len(client.queue) and not client.suspended:
+            client.writer = asyncio.create_task(self._write_loop(client))
+
+    async def _telemetry_loop(self) -> None:
+        interval = 1.0 / self.telemetry_hz
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_telemetry()
+            except Exception as e:
+                log.exception("telemetry-flush-failed", error=str(e))
+
+    async def _heartbeat_loop(self) -> None:
+        # A dead connection is reaped within heartbeat_timeout + heartbeat_interval
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                log.exception("heartbeat-sweep-failed", error=str(e))
+
+    async def _write_loop(self, client: Client) -> None:
+        websocket = client.websocket
+        try:
+            while True:
+                frame = client.queue.pop()
+                if frame is None:
+                    return
+                try:
+                    if isinstance(frame, bytes):
+                        await websocket.send_bytes(frame)
+                    else:
+                        await websocket.send_text(frame)
+                except BaseException as e:
+                    # Also when cancelled by resume or suspend mid-send, so the frame is not lost
+                    if not isinstance(e, asyncio.CancelledError):
+                        metrics.send_failures.inc()
+                    client.queue.push_front(frame)
+                    raise
+                metrics.outbound_frames.inc()
+                metrics.outbound_bytes.inc(len(frame))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if client.websocket is websocket and not self.suspend(client.room_id, client.client_id):
+                await self.evict(client.room_id, client.client_id)
+        finally:
+            if client.writer is asyncio.current_task():
+                client.writer = None
+
+    @classmethod
+    async def _notify_and_close(cls, websocket: WebSocket, frame: Frame, code: int) -> None:
+        try:
+            if isinstance(frame, bytes):
+                await asyncio.wait_for(websocket.send_bytes(frame), timeout=1.0)
+            else:
+                await asyncio.wait_for(websocket.send_text(frame), timeout=1.0)
+        except Exception:
+            pass
+        await cls._close(websocket, code)
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int = SLOW_CONSUMER_CLOSE_CODE) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=1.0)
+        except Exception:
+            pass
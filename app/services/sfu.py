@@ -0,0 +1,236 @@
+"""Optional selective forwarding unit for large rooms.
+
+In mesh mode every participant sends its media to every other participant.
+In SFU mode each client keeps a single RTCPeerConnection with the server:
+it publishes its own tracks once, and the server forwards every other
+publisher's tracks to it. aiortc provides the WebRTC stack; without it
+installed, rooms always stay in mesh mode.
+
+Signaling reuses the offer/answer/ice messages with the reserved peer id
+``SFU_PEER_ID``. The client sends the first offer and the server answers it.
+After that the server re-offers whenever the set of forwarded tracks
+changes. Server offers include ``tracks`` (transceiver mid -> publisher
+clientId) so the client can attach each incoming track to the right
+tile. The server is the impolite side: a client offer that collides with
+an outstanding server offer is ignored and the client rolls back.
+
+Media is forwarded only between clients connected to this process. With
+ROOM_BACKEND=bus a room can span workers, so SFU mode is disabled there.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+import asyncio
+
+from app.core.config import settings
+from app.core.logging import get_logger
+
+try:
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.contrib.media import MediaRelay
+    from aiortc.sdp import candidate_from_sdp
+except ImportError:  # optional dependency
+    RTCPeerConnection = None
+
+if TYPE_CHECKING:
+    from app.services.rooms import RoomService
+
+
+log = get_logger("sfu")
+
+SFU_PEER_ID = "sfu"
+
+SFU_AVAILABLE = RTCPeerConnection is not None
+
+
+@dataclass
+class SfuPeer:
+    client_id: str
+    pc: "RTCPeerConnection"
+    # Forwarded track id -> (publisher client_id, sender)
+    forwarded: Dict[str, Tuple[str, object]] = field(default_factory=dict)
+    # A server offer is waiting for the client's answer
+    negotiating: bool = False
+    # Tracks changed while negotiating; offer again once the answer arrives
+    pending: bool = False
+
+
+@dataclass
+class SfuRoom:
+    peers: Dict[str, SfuPeer] = field(default_factory=dict)
+    # Publisher client_id -> tracks it sends to the server
+    tracks: Dict[str, List[object]] = field(default_factory=dict)
+
+
+class SfuService:
+    """Per-process SFU; decides which rooms use it and relays their media."""
+
+    def __init__(
+        self,
+        room_service: "RoomService",
+        mode: Optional[str] = None,
+        threshold: Optional[int] = None,
+        rooms: Optional[List[str]] = None,
+    ) -> None:
+        self.room_service = room_service
+        mode = mode or settings.sfu_mode
+        if mode != "off" and not SFU_AVAILABLE:
+            log.warning("disabled", reason="aiortc-not-installed", mode=mode)
+            mode = "off"
+        if mode != "off" and settings.room_backend != "memory":
+            log.warning("disabled", reason="needs-memory-backend", backend=settings.room_backend)
+            mode = "off"
+        self.mode = mode
+        self.threshold = threshold or settings.sfu_threshold
+        self.forced_rooms: Set[str] = set(rooms if rooms is not None else settings.sfu_rooms)
+        self.rooms: Dict[str, SfuRoom] = {}
+        # Rooms switched to SFU mode; sticky until the room empties so it never flaps
+        self.active: Set[str] = set()
+        self.relay = MediaRelay() if SFU_AVAILABLE else None
+        self._tasks: Set[asyncio.Task] = set()
+        room_service.add_leave_listener(self.on_leave)
+
+    def is_active(self, room_id: str) -> bool:
+        return room_id in self.active
+
+    def update_mode(self, room_id: str, participants: int) -> bool:
+        """Re-evaluate a room's mode after a join. Returns True if it just switched to SFU."""
+        if self.mode == "off" or room_id in self.active:
+            return False
+        if self.mode == "always" or room_id in self.forced_rooms or participants >= self.threshold:
+            self.active.add(room_id)
+            return True
+        return False
+
+    async def handle_offer(self, room_id: str, client_id: str, sdp: str) -> Optional[str]:
+        """Answer a client's publish/renegotiation offer. Returns None if it collided with ours."""
+        if room_id not in self.active:
+            return None
+        room = self.rooms.setdefault(room_id, SfuRoom())
+        peer = room.peers.get(client_id)
+        if peer is None:
+            peer = SfuPeer(client_id=client_id, pc=self._create_pc(room_id, client_id))
+            room.peers[client_id] = peer
+        if peer.negotiating or peer.pc.signalingState != "stable":
+            # Impolite side of perfect negotiation: the client rolls back and answers ours
+            return None
+        await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="offer"))
+        await peer.pc.setLocalDescription(await peer.pc.createAnswer())
+        # Other publishers' tracks go out on server-created transceivers, in a follow-up offer
+        self._spawn(self._renegotiate(room_id, peer))
+        return peer.pc.localDescription.sdp
+
+    async def handle_answer(self, room_id: str, client_id: str, sdp: str) -> None:
+        room = self.rooms.get(room_id)
+        peer = room.peers.get(client_id) if room else None
+        if not peer or peer.pc.signalingState != "have-local-offer":
+            return
+        await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="answer"))
+        peer.negotiating = False
+        if peer.pending:
+            peer.pending = False
+            await self._renegotiate(room_id, peer)
+
+    async def add_ice(self, room_id: str, client_id: str, candidate: Optional[dict]) -> None:
+        room = self.rooms.get(room_id)
+        peer = room.peers.get(client_id) if room else None
+        if not peer or not candidate or not candidate.get("candidate"):
+            return
+        parsed = candidate_from_sdp(candidate["candidate"].split(":", 1)[-1])
+        parsed.sdpMid = candidate.get("sdpMid")
+        parsed.sdpMLineIndex = candidate.get("sdpMLineIndex")
+        await peer.pc.addIceCandidate(parsed)
+
+    async def remove(self, room_id: str, client_id: str) -> None:
+        """Drop a client's connection and stop forwarding its tracks."""
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        peer = room.peers.pop(client_id, None)
+        published = room.tracks.pop(client_id, None)
+        if peer:
+            await peer.pc.close()
+        if published:
+            for other in list(room.peers.values()):
+                await self._renegotiate(room_id, other)
+        if not room.peers:
+            del self.rooms[room_id]
+
+    def on_leave(self, room_id: str, client_id: str, room_empty: bool) -> None:
+        """RoomService leave listener; an emptied room starts in mesh mode again."""
+        if room_empty:
+            self.active.discard(room_id)
+        if room_id in self.rooms:
+            self._spawn(self.remove(room_id, client_id))
+
+    async def stop(self) -> None:
+        for room_id in list(self.rooms):
+            for client_id in list(self.rooms[room_id].peers):
+                await self.remove(room_id, client_id)
+
+    def _create_pc(self, room_id: str, client_id: str) -> "RTCPeerConnection":
+        pc = RTCPeerConnection()
+
+        @pc.on("track")
+        def on_track(track) -> None:
+            room = self.rooms.get(room_id)
+            if not room:
+                return
+            room.tracks.setdefault(client_id, []).append(track)
+            for other in room.peers.values():
+                if other.client_id != client_id:
+                    self._spawn(self._renegotiate(room_id, other))
+
+        @pc.on("connectionstatechange")
+        async def on_state() -> None:
+            if pc.connectionState == "failed":
+                log.info("connection-failed", room=room_id, client=client_id)
+                await self.remove(room_id, client_id)
+
+        return pc
+
+    async def _renegotiate(self, room_id: str, peer: SfuPeer) -> None:
+        """Bring a subscriber's forwarded tracks in line with the room's publishers and offer the change."""
+        room = self.rooms.get(room_id)
+        if not room or peer.client_id not in room.peers:
+            return
+        if peer.negotiating or peer.pc.signalingState != "stable":
+            peer.pending = True
+            return
+        changed = False
+        live: Set[str] = set()
+        for publisher_id, tracks in room.tracks.items():
+            if publisher_id == peer.client_id:
+                continue
+            for track in tracks:
+                live.add(track.id)
+                if track.id not in peer.forwarded:
+                    sender = peer.pc.addTrack(self.relay.subscribe(track))
+                    peer.forwarded[track.id] = (publisher_id, sender)
+                    changed = True
+        for track_id in [t for t in peer.forwarded if t not in live]:
+            _, sender = peer.forwarded.pop(track_id)
+            await sender.replaceTrack(None)
+            changed = True
+        if not changed:
+            return
+        peer.negotiating = True
+        await peer.pc.setLocalDescription(await peer.pc.createOffer())
+        owners = {id(sender): publisher_id for publisher_id, sender in peer.forwarded.values()}
+        tracks = {
+            t.mid: owners[id(t.sender)]
+            for t in peer.pc.getTransceivers()
+            if t.mid is not None and id(t.sender) in owners
+        }
+        await self.room_service.send_to(room_id, peer.client_id, {
+            "type": "offer",
+            "from": SFU_PEER_ID,
+            "sdp": peer.pc.localDescription.sdp,
+            "tracks": tracks,
+        })
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
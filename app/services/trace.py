@@ -0,0 +1,337 @@
+"""Opt-in signaling trace: a compact record of /ws traffic for replaying incidents.
+
+With TRACE_FILE set, websocket_endpoint and RoomService append one
+fixed-width record per event: connections opening, joining and closing,
+every inbound message (batches are recorded with each message they
+carry), every message queued for a client, and evictions. A record holds
+a timestamp, the message type and size, and anonymized connection,
+client, room and peer numbers; payloads are not kept. bench/replay.py
+turns a trace back into traffic against a local server.
+
+Layout (little-endian): a header of HEADER_ALIGN-byte blocks, then
+RECORD.size-byte records, so the file can be mmapped and read with
+struct.iter_unpack.
+
+    header  magic, u16 version, u16 record size, u32 header size,
+            u64 wall-clock start (ns), JSON metadata (type names), zero padding
+    record  u64 ns since start, u8 kind, u8 type, u16 flags,
+            u32 connection, u32 client, u32 room, u32 peer, u32 size
+
+Numbers start at 1 in each trace and are never reused; 0 means none or
+unknown. Clients and rooms are numbered when first seen and forgotten
+when they leave for good; peers ("to", "from") are only named if they
+are numbered already. Each table holds at most MAX_NUMBERED ids.
+Records are buffered and handed to a writer thread every FLUSH_INTERVAL
+seconds or FLUSH_BYTES, and recording stops at TRACE_MAX_MB. Each
+process writes its own file; "{pid}" in TRACE_FILE is replaced with the
+process id.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Union
+import asyncio
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import orjson
+
+from app.core.config import settings
+from app.core.logging import get_logger
+from app.core.metrics import INBOUND_TYPES
+
+if TYPE_CHECKING:
+    from app.services.rooms import Client
+
+log = get_logger("trace")
+
+
+MAGIC = b"VCTRACE1"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sHHIQ")
+RECORD = struct.Struct("<QBBHIIIII")
+# The header is padded to a whole number of records
+HEADER_ALIGN = RECORD.size
+
+# Record kinds
+KIND_IN = 0
+KIND_OUT = 1
+KIND_OPEN = 2
+KIND_JOINED = 3
+KIND_CLOSE = 4
+KIND_EVICT = 5
+KIND_NAMES = ("in", "out", "open", "joined", "close", "evict")
+
+# Flags by kind
+FLAG_BINARY = 1        # in, open: the connection uses the binary subprotocol
+FLAG_BATCHED = 2       # in: the message came inside a batch envelope
+FLAG_RESUMED = 1       # joined: an existing session was resumed
+FLAG_LEFT = 1          # close: the client sent leave (not resumable)
+# out: flags hold the client's queue length after the message, capped here
+MAX_FLAGS = 0xFFFF
+
+# Type 0 is "none" (lifecycle records), 1 is any type not listed here
+MESSAGE_TYPES = ("", "other") + INBOUND_TYPES + (
+    "joined", "peer-joined", "peer-left", "roster", "error", "telemetry", "media-policy", "media-mode",
+)
+
+FLUSH_INTERVAL = 1.0
+FLUSH_BYTES = 64 * 1024
+# Ids held per numbering; past this the table starts over (later records get fresh numbers)
+MAX_NUMBERED = 100_000
+
+
+class _Numbering:
+    """Stable small numbers for ids, without reuse."""
+
+    __slots__ = ("numbers", "last")
+
+    def __init__(self) -> None:
+        self.numbers: Dict[str, int] = {}
+        self.last = 0
+
+    def number(self, value: Optional[str]) -> int:
+        if not value:
+            return 0
+        number = self.numbers.get(value)
+        if number is None:
+            if len(self.numbers) >= MAX_NUMBERED:
+                self.numbers.clear()
+            self.last += 1
+            number = self.numbers[value] = self.last
+        return number
+
+    def lookup(self, value: Any) -> int:
+        return self.numbers.get(value, 0) if isinstance(value, str) else 0
+
+    def forget(self, value: str) -> None:
+        self.numbers.pop(value, None)
+
+
+class TraceRecorder:
+    """Appends trace records for this process; does nothing unless started with a path."""
+
+    def __init__(self, path: Optional[str] = None, max_bytes: Optional[int] = None) -> None:
+        self.path = path if path is not None else settings.trace_file
+        self.max_bytes = max_bytes if max_bytes is not None else int(settings.trace_max_mb * 1024 * 1024)
+        # Checked by the hooks before building a record
+        self.enabled = False
+        self.type_codes = {name: code for code, name in enumerate(MESSAGE_TYPES) if name}
+        self._clients = _Numbering()
+        self._rooms = _Numbering()
+        self._connections = 0
+        # Filled chunks for the writer thread; None tells it to close the file
+        self._chunks: Optional[queue.SimpleQueue] = None
+        self._writer: Optional[threading.Thread] = None
+        self._buffer = bytearray()
+        self._written = 0
+        self._started = 0
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not self.path or self._writer is not None:
+            return
+        path = self.path.replace("{pid}", str(os.getpid()))
+        file = open(path, "wb")
+        meta = orjson.dumps({"types": MESSAGE_TYPES, "kinds": KIND_NAMES, "pid": os.getpid()})
+        size = HEADER.size + len(meta)
+        size += -size % HEADER_ALIGN
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size, size, time.time_ns()) + meta
+        file.write(header.ljust(size, b"\0"))
+        self._written = size
+        self._chunks = queue.SimpleQueue()
+        self._writer = threading.Thread(
+            target=self._write_loop, args=(file, self._chunks), name="trace-writer", daemon=True
+        )
+        self._writer.start()
+        self._started = time.monotonic_ns()
+        self.enabled = True
+        self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+        log.info("trace-started", path=path, max_mb=self.max_bytes // (1024 * 1024))
+
+    async def stop(self) -> None:
+        flusher, self._flusher = self._flusher, None
+        if flusher:
+            flusher.cancel()
+            try:
+                await flusher
+            except asyncio.CancelledError:
+                pass
+        self._close()
+        writer, self._writer = self._writer, None
+        if writer:
+            await asyncio.to_thread(writer.join)
+
+    def on_leave(self, room_id: str, client_id: str, room_empty: bool) -> None:
+        """RoomService leave listener: a client that left for good (and an emptied room) is not seen again."""
+        self._clients.forget(client_id)
+        if room_empty:
+            self._rooms.forget(room_id)
+
+    def connection(self, binary: bool) -> int:
+        """Number a new /ws connection and record it opening."""
+        self._connections += 1
+        self._record(KIND_OPEN, 0, FLAG_BINARY if binary else 0, self._connections, 0, 0, 0, 0)
+        return self._connections
+
+    def inbound(
+        self,
+        conn: int,
+        client_id: Optional[str],
+        room_id: Optional[str],
+        frame: Dict[str, Any],
+        message: dict,
+        batch: Sequence[dict],
+    ) -> None:
+        """Record one received frame: the message, or a batch envelope followed by what it carries."""
+        data: Union[str, bytes, None] = frame.get("bytes")
+        flags = 0
+        if data is None:
+            data = frame.get("text") or ""
+        else:
+            flags = FLAG_BINARY
+        client = self._clients.number(client_id)
+        self._inbound(conn, client, room_id, message, len(data), flags)
+        if message.get("type") == "batch":
+            for inner in batch:
+                self._inbound(conn, client, room_id, inner, len(orjson.dumps(inner)), flags | FLAG_BATCHED)
+
+    def _inbound(self, conn: int, client: int, room_id: Optional[str], message: dict, size: int, flags: int) -> None:
+        msg_type = message.get("type")
+        if msg_type == "join":
+            room_id = message.get("roomId") if isinstance(message.get("roomId"), str) else None
+        self._record(
+            KIND_IN, self._type_code(msg_type), flags, conn, client, self._rooms.number(room_id),
+            self._clients.lookup(message.get("to")), size,
+        )
+
+    def outbound(self, client: "Client", room_id: str, message: dict, size: int) -> None:
+        """Record a message queued for a client; flags carry the queue length after it."""
+        sender = message.get("from") or message.get("clientId") or message.get("fromClientId")
+        self._record(
+            KIND_OUT, self._type_code(message.get("type")), min(len(client.queue), MAX_FLAGS), 0,
+            self._clients.number(client.client_id), self._rooms.number(room_id), self._clients.lookup(sender), size,
+        )
+
+    def event(self, kind: int, conn: int, client_id: Optional[str], room_id: Optional[str], flags: int = 0) -> None:
+        if kind == KIND_JOINED:
+            client, room = self._clients.number(client_id), self._rooms.number(room_id)
+        else:
+            # After a leave the client (and an emptied room) is already forgotten
+            client, room = self._clients.lookup(client_id), self._rooms.lookup(room_id)
+        self._record(kind, 0, flags, conn, client, room, 0, 0)
+
+    def _type_code(self, msg_type: Any) -> int:
+        return self.type_codes.get(msg_type, 1) if isinstance(msg_type, str) else 1
+
+    def _record(
+        self, kind: int, msg_type: int, flags: int, conn: int, client: int, room: int, peer: int, size: int
+    ) -> None:
+        if not self.enabled:
+            return
+        if self._written + len(self._buffer) + RECORD.size > self.max_bytes:
+            log.warning("trace-full", path=self.path, bytes=self._written + len(self._buffer))
+            self._close()
+            return
+        self._buffer += RECORD.pack(
+            time.monotonic_ns() - self._started, kind, msg_type, flags, conn, client, room, peer, size
+        )
+        if len(self._buffer) >= FLUSH_BYTES:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hand the buffered records to the writer thread."""
+        if self._chunks is None or not self._buffer:
+            return
+        self._chunks.put(bytes(self._buffer))
+        self._written += len(self._buffer)
+        self._buffer.clear()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def _write_loop(self, file: BinaryIO, chunks: queue.SimpleQueue) -> None:
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                file.write(chunk)
+                file.flush()
+        except OSError as e:
+            log.error("trace-write-failed", error=str(e))
+            self.enabled = False
+        finally:
+            file.close()
+
+    def _close(self) -> None:
+        self.flush()
+        self.enabled = False
+        if self._chunks is not None:
+            self._chunks.put(None)
+            self._chunks = None
+
+
+tracer = TraceRecorder()
+
+
+class TraceRecord(NamedTuple):
+    t_ns: int
+    kind: int
+    type: int
+    flags: int
+    conn: int
+    client: int
+    room: int
+    peer: int
+    size: int
+
+
+class TraceReader:
+    """Memory-maps a trace file; use as a context manager."""
+
+    def __init__(self, path: str) -> None:
+        self._fh = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fh.close()
+            raise ValueError(f"{path}: empty trace file") from None
+        magic, version, record_size, header_size, self.started_ns = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{path}: not a version {FORMAT_VERSION} signaling trace")
+        self.header_size = header_size
+        self.meta = orjson.loads(bytes(self._map[HEADER.size:header_size]).rstrip(b"\0"))
+        self.types: List[str] = self.meta["types"]
+
+    def __len__(self) -> int:
+        # A record cut short by a crash is ignored
+        return (len(self._map) - self.header_size) // RECORD.size
+
+    def __enter__(self) -> "TraceReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def records(self) -> Iterator[TraceRecord]:
+        end = self.header_size + len(self) * RECORD.size
+        view = memoryview(self._map)[self.header_size:end]
+        try:
+            for fields in RECORD.iter_unpack(view):
+                yield TraceRecord(*fields)
+        finally:
+            view.release()
+
+    def type_name(self, code: int) -> str:
+        return self.types[code] if code < len(self.types) else "other"
+
+    def close(self) -> None:
+        self._map.close()
+        self._fh.close()
@@ -0,0 +1,244 @@
+"""Wire encodings for the /ws signaling protocol.
+
+Two subprotocols are offered through Sec-WebSocket-Protocol:
+
+- ``vc.json.1`` (and clients that ask for nothing): JSON text frames.
+- ``vc.bin.1``: binary frames starting with a one-byte type tag. Peers are
+  addressed by the small per-room ``handle`` announced in joined and
+  peer-joined instead of their UUID. Message types without a compact
+  layout are sent as ``TAG_JSON`` followed by the JSON text.
+
+All integers are unsigned big-endian. Layouts (server -> client / client -> server):
+
+    offer, answer   tag, u16 peer, utf-8 sdp           peer = from / to
+    ice             tag, u16 peer, utf-8 JSON candidate (or array of candidates, server -> client)
+    chat            tag, u16 from, u32 seq (0 if not in history), u16 name length, name, text / tag, text
+    mute            tag, u16 client, u8 muted          / tag, u8 muted
+    media-state     tag, u16 client, u8 flags          / tag, u8 flags
+    telemetry       tag, u16 count, count x (u16 handle, u16 hz, u8 speaking)
+    peer-left       tag, u16 handle, u32 roster version
+    pitch           client -> server only: tag, u16 hz
+    vad             client -> server only: tag, u8 speaking
+    batch           client -> server only: tag, then repeated (u16 length, frame)
+
+Signaling to or from a peer without a handle (the SFU) uses TAG_JSON.
+
+public/wire.js implements the matching client codec.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Union
+import struct
+import orjson
+
+
+SUBPROTOCOL_JSON = "vc.json.1"
+SUBPROTOCOL_BINARY = "vc.bin.1"
+
+TAG_JSON = 0
+TAG_OFFER = 1
+TAG_ANSWER = 2
+TAG_ICE = 3
+TAG_CHAT = 4
+TAG_MUTE = 5
+TAG_MEDIA_STATE = 6
+TAG_TELEMETRY = 7
+TAG_PEER_LEFT = 8
+TAG_PITCH = 9
+TAG_VAD = 10
+TAG_BATCH = 11
+
+FLAG_AUDIO = 1
+FLAG_VIDEO = 2
+
+_TAG = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_TAG_U8 = struct.Struct("!BB")
+_TAG_U16 = struct.Struct("!BH")
+_TAG_U16_U8 = struct.Struct("!BHB")
+_TAG_U16_U32 = struct.Struct("!BHI")
+_TAG_U16_U32_U16 = struct.Struct("!BHIH")
+_TELEMETRY_ENTRY = struct.Struct("!HHB")
+_JSON_TAG = _TAG.pack(TAG_JSON)
+
+_SIGNAL_TAGS = {"offer": TAG_OFFER, "answer": TAG_ANSWER}
+
+Frame = Union[str, bytes]
+
+
+def negotiate(offered: List[str]) -> Optional[str]:
+    """Pick the subprotocol to accept from the client's offer, preferring binary."""
+    if SUBPROTOCOL_BINARY in offered:
+        return SUBPROTOCOL_BINARY
+    if SUBPROTOCOL_JSON in offered:
+        return SUBPROTOCOL_JSON
+    return None
+
+
+def _encode_signal(message: dict, handles: Dict[str, int]) -> Optional[bytes]:
+    handle = handles.get(message.get("from"))
+    # Signaling from a non-member (e.g. the SFU) has no handle; send it as JSON
+    if handle is None or "tracks" in message:
+        return None
+    return _TAG_U16.pack(_SIGNAL_TAGS[message["type"]], handle) + (message.get("sdp") or "").encode()
+
+
+def _encode_ice(message: dict, handles: Dict[str, int]) -> Optional[bytes]:
+    handle = handles.get(message.get("from"))
+    if handle is None or "tracks" in message:
+        return None
+    candidates = message.get("candidates")
+    return _TAG_U16.pack(TAG_ICE, handle) + orjson.dumps(
+        candidates if candidates is not None else message.get("candidate")
+    )
+
+
+def _encode_chat(message: dict, handles: Dict[str, int]) -> bytes:
+    name = (message.get("fromName") or "").encode()
+    header = _TAG_U16_U32_U16.pack(
+        TAG_CHAT, handles.get(message.get("fromClientId"), 0), message.get("seq") or 0, len(name)
+    )
+    return b"".join((header, name, str(message.get("message", "")).encode()))
+
+
+def _encode_mute(message: dict, handles: Dict[str, int]) -> bytes:
+    return _TAG_U16_U8.pack(TAG_MUTE, handles.get(message.get("clientId"), 0), 1 if message.get("muted") else 0)
+
+
+def _encode_media_state(message: dict, handles: Dict[str, int]) -> bytes:
+    flags = (FLAG_AUDIO if message.get("hasAudio") else 0) | (FLAG_VIDEO if message.get("hasVideo") else 0)
+    return _TAG_U16_U8.pack(TAG_MEDIA_STATE, handles.get(message.get("clientId"), 0), flags)
+
+
+def _encode_telemetry(message: dict, handles: Dict[str, int]) -> bytes:
+    peers = message.get("peers") or []
+    parts = [_TAG_U16.pack(TAG_TELEMETRY, len(peers))]
+    for client_id, hz, speaking in peers:
+        parts.append(_TELEMETRY_ENTRY.pack(handles.get(client_id, 0), min(int(hz), 0xFFFF), 1 if speaking else 0))
+    return b"".join(parts)
+
+
+def _encode_peer_left(message: dict, handles: Dict[str, int]) -> bytes:
+    # The leaver's handle is already released by the time peer-left is encoded
+    return _TAG_U16_U32.pack(
+        TAG_PEER_LEFT,
+        message.get("handle") or handles.get(message.get("clientId"), 0),
+        message.get("rosterVersion") or 0,
+    )
+
+
+# Message type -> compact encoder; a type not listed here goes out as TAG_JSON
+_ENCODERS = {
+    "offer": _encode_signal,
+    "answer": _encode_signal,
+    "ice": _encode_ice,
+    "chat": _encode_chat,
+    "mute": _encode_mute,
+    "media-state": _encode_media_state,
+    "telemetry": _encode_telemetry,
+    "peer-left": _encode_peer_left,
+}
+
+
+def encode_binary(message: dict, handles: Dict[str, int]) -> Optional[bytes]:
+    """Encode a server -> client message, or return None if it has no compact layout."""
+    encoder = _ENCODERS.get(message.get("type"))
+    return encoder(message, handles) if encoder else None
+
+
+def decode_binary(data: bytes, clients: Dict[int, str]) -> dict:
+    """Decode a client -> server frame into the same dict the JSON protocol produces.
+
+    Raises ValueError on malformed frames.
+    """
+    try:
+        tag = data[0]
+        if tag == TAG_JSON:
+            return orjson.loads(data[1:])
+        if tag in (TAG_OFFER, TAG_ANSWER):
+            _, peer = _TAG_U16.unpack_from(data)
+            return {
+                "type": "offer" if tag == TAG_OFFER else "answer",
+                "to": clients.get(peer),
+                "sdp": data[_TAG_U16.size:].decode(),
+            }
+        if tag == TAG_ICE:
+            _, peer = _TAG_U16.unpack_from(data)
+            return {"type": "ice", "to": clients.get(peer), "candidate": orjson.loads(data[_TAG_U16.size:])}
+        if tag == TAG_CHAT:
+            return {"type": "chat", "message": data[_TAG.size:].decode()}
+        if tag == TAG_MUTE:
+            return {"type": "mute", "muted": bool(_TAG_U8.unpack_from(data)[1])}
+        if tag == TAG_MEDIA_STATE:
+            flags = _TAG_U8.unpack_from(data)[1]
+            return {"type": "media-state", "hasAudio": bool(flags & FLAG_AUDIO), "hasVideo": bool(flags & FLAG_VIDEO)}
+        if tag == TAG_PITCH:
+            return {"type": "pitch", "hz": _TAG_U16.unpack_from(data)[1]}
+        if tag == TAG_VAD:
+            return {"type": "vad", "speaking": bool(_TAG_U8.unpack_from(data)[1])}
+        if tag == TAG_BATCH:
+            messages = []
+            offset = _TAG.size
+            while offset < len(data):
+                (length,) = _U16.unpack_from(data, offset)
+                offset += _U16.size
+                if offset + length > len(data):
+                    raise ValueError("truncated batch entry")
+                entry = data[offset:offset + length]
+                offset += length
+                # Nested batches are not allowed
+                if entry and entry[0] != TAG_BATCH:
+                    messages.append(decode_binary(entry, clients))
+            return {"type": "batch", "messages": messages}
+    except (IndexError, struct.error, UnicodeDecodeError, orjson.JSONDecodeError) as e:
+        raise ValueError(f"malformed binary frame: {e}") from e
+    raise ValueError(f"unknown binary frame tag: {tag}")
+
+
+def encode_json_frame(message: dict) -> bytes:
+    """TAG_JSON frame, for messages sent to binary clients outside a room (e.g. join errors)."""
+    return _JSON_TAG + orjson.dumps(message)
+
+
+class Payload:
+    """One outbound message, serialized at most once per encoding.
+
+    Built from a dict (local broadcast) or from JSON text (frames relayed
+    by the room bus); the binary form is derived on first use. The JSON
+    body is serialized once, and a binary client without a compact layout
+    for the message reuses those bytes behind TAG_JSON.
+    """
+
+    __slots__ = ("_message", "_text", "_json", "_binary")
+
+    def __init__(self, message: Optional[dict] = None, text: Optional[str] = None) -> None:
+        self._message = message
+        self._text = text
+        # orjson output, kept so the text and TAG_JSON frames share one serialization
+        self._json: Optional[bytes] = None
+        self._binary: Optional[bytes] = None
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = orjson.loads(self._text)
+        return self._message
+
+    def _json_bytes(self) -> bytes:
+        if self._json is None:
+            self._json = orjson.dumps(self._message) if self._text is None else self._text.encode()
+        return self._json
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._json_bytes().decode()
+        return self._text
+
+    def binary(self, handles: Dict[str, int]) -> bytes:
+        if self._binary is None:
+            encoded = encode_binary(self.message, handles)
+            self._binary = encoded if encoded is not None else _JSON_TAG + self._json_bytes()
+        return self._binary
+
+    def encode(self, binary: bool, handles: Dict[str, int]) -> Frame:
+        return self.binary(handles) if binary else self.text()
@@ -0,0 +1,417 @@
+"""Load generator for the /ws signaling server.
+
+Opens many synthetic clients across rooms and replays browser-like traffic:
+join, an offer/answer plus an ICE burst per peer pair, 3 Hz pitch, VAD
+flips and chat. It reports delivery latency (p50/p99) for chat and
+signaling, how long a newcomer takes to get answers from every peer it
+offers to, received messages per second, and the server's CPU and RSS.
+
+The server is either started here (a subprocess by default, or
+in-process with --in-process) or reached with --url. Scenarios are named
+and seeded, so the same command produces the same traffic on every commit.
+
+    python -m bench.loadgen --scenario small-rooms --json > before.json
+    python -m bench.loadgen --scenario large-rooms --duration 30
+    python -m bench.loadgen --url ws://staging:8000/ws --rooms 50 --room-size 8
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import dataclasses
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+import orjson
+import websockets
+
+
+@dataclass
+class Scenario:
+    rooms: int
+    room_size: int
+    duration: float = 20.0
+    pitch_hz: float = 3.0
+    # Mean seconds between chat messages per client (exponentially distributed)
+    chat_interval: float = 10.0
+    # Mean seconds between VAD flips per client
+    vad_interval: float = 2.0
+    ice_burst: int = 8
+    # Concurrent connection attempts while ramping up
+    connect_concurrency: int = 100
+    seed: int = 1
+
+
+SCENARIOS: Dict[str, Scenario] = {
+    "smoke": Scenario(rooms=4, room_size=3, duration=5),
+    "small-rooms": Scenario(rooms=250, room_size=4),
+    "medium-rooms": Scenario(rooms=100, room_size=10),
+    "large-rooms": Scenario(rooms=20, room_size=50),
+    "chat-storm": Scenario(rooms=50, room_size=10, chat_interval=0.5),
+}
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latency: Dict[str, List[float]] = {"chat": [], "signaling": [], "negotiation": []}
+        self.sent = 0
+        self.received = 0
+        self.received_by_type: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.connected = 0
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def stamp() -> str:
+    return str(time.perf_counter_ns())
+
+
+def elapsed_ms(marker: str) -> Optional[float]:
+    try:
+        return (time.perf_counter_ns() - int(marker)) / 1e6
+    except (TypeError, ValueError):
+        return None
+
+
+class SyntheticClient:
+    def __init__(self, url: str, room_id: str, index: int, scenario: Scenario, stats: Stats, rng: random.Random) -> None:
+        self.url = url
+        self.room_id = room_id
+        self.index = index
+        self.scenario = scenario
+        self.stats = stats
+        self.rng = rng
+        self.ws = None
+        self.client_id: Optional[str] = None
+        self.peers: List[str] = []
+        # Peers the server made this client the offerer for, and those yet to answer
+        self.offer_to: List[str] = []
+        self.unanswered: Set[str] = set()
+        self.negotiation_started = 0
+        self.joined = asyncio.Event()
+
+    async def send(self, message: dict) -> None:
+        await self.ws.send(orjson.dumps(message).decode())
+        self.stats.sent += 1
+
+    async def connect(self) -> None:
+        self.ws = await websockets.connect(self.url, subprotocols=["vc.json.1"], max_size=None, open_timeout=30)
+        self.stats.connected += 1
+        await self.send({"type": "join", "roomId": self.room_id, "name": f"load-{self.index}"})
+
+    async def read_loop(self) -> None:
+        stats = self.stats
+        try:
+            async for raw in self.ws:
+                message = orjson.loads(raw)
+                msg_type = message.get("type")
+                stats.received += 1
+                stats.received_by_type[msg_type] = stats.received_by_type.get(msg_type, 0) + 1
+                if msg_type == "joined":
+                    self.client_id = message["clientId"]
+                    self.peers = [p["clientId"] for p in message.get("peers", [])]
+                    self.offer_to = [p["clientId"] for p in message.get("peers", []) if p.get("offerer", True)]
+                    self.joined.set()
+                elif msg_type == "chat":
+                    if message.get("fromClientId") != self.client_id:
+                        self._record("chat", message.get("message", "").partition(":")[2])
+                elif msg_type == "offer":
+                    self._record("signaling", message.get("sdp"))
+                    await self.send({"type": "answer", "to": message["from"], "sdp": stamp()})
+                    await self.ice_burst(message["from"])
+                elif msg_type == "answer":
+                    self._record("signaling", message.get("sdp"))
+                    if message.get("from") in self.unanswered:
+                        self.unanswered.discard(message["from"])
+                        if not self.unanswered:
+                            elapsed = (time.perf_counter_ns() - self.negotiation_started) / 1e6
+                            stats.latency["negotiation"].append(elapsed)
+                elif msg_type == "ice":
+                    for candidate in message.get("candidates") or [message.get("candidate")]:
+                        self._record("signaling", (candidate or {}).get("usernameFragment"))
+                elif msg_type == "error":
+                    stats.error(message.get("error") or "error")
+        except websockets.ConnectionClosed:
+            pass
+
+    def _record(self, kind: str, marker: Optional[str]) -> None:
+        latency = elapsed_ms(marker)
+        if latency is not None:
+            self.stats.latency[kind].append(latency)
+
+    async def ice_burst(self, peer_id: str) -> None:
+        for i in range(self.scenario.ice_burst):
+            await self.send({
+                "type": "ice",
+                "to": peer_id,
+                "candidate": {
+                    "candidate": f"candidate:{i} 1 udp 2122260223 10.0.0.{self.index % 250} {50000 + i} typ host",
+                    "sdpMid": "0",
+                    "sdpMLineIndex": 0,
+                    # Latency marker; browsers put the ICE ufrag here
+                    "usernameFragment": stamp(),
+                },
+            })
+
+    async def negotiate(self) -> None:
+        """Like the browser, offer to every peer the server made us the offerer for at once, then trickle ICE."""
+        self.unanswered = set(self.offer_to)
+        self.negotiation_started = time.perf_counter_ns()
+        for peer_id in self.offer_to:
+            await self.send({"type": "offer", "to": peer_id, "sdp": stamp()})
+        for peer_id in self.offer_to:
+            await self.ice_burst(peer_id)
+
+    async def steady_state(self, until: float) -> None:
+        scenario, rng = self.scenario, self.rng
+        loop = asyncio.get_running_loop()
+        pitch_period = 1.0 / scenario.pitch_hz if scenario.pitch_hz > 0 else None
+        next_pitch = loop.time() + rng.random() * (pitch_period or 1)
+        next_chat = loop.time() + rng.expovariate(1.0 / scenario.chat_interval)
+        next_vad = loop.time() + rng.expovariate(1.0 / scenario.vad_interval)
+        speaking = False
+        while True:
+            now = loop.time()
+            if now >= until:
+                return
+            if pitch_period and now >= next_pitch:
+                await self.send({"type": "pitch", "hz": rng.randint(90, 300)})
+                next_pitch += pitch_period
+            if now >= next_chat:
+                await self.send({"type": "chat", "message": f"hello:{stamp()}"})
+                next_chat += rng.expovariate(1.0 / scenario.chat_interval)
+            if now >= next_vad:
+                speaking = not speaking
+                await self.send({"type": "vad", "speaking": speaking})
+                next_vad += rng.expovariate(1.0 / scenario.vad_interval)
+            wake = min(next_chat, next_vad, next_pitch if pitch_period else until, until)
+            await asyncio.sleep(max(0.0, wake - loop.time()))
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            try:
+                await self.send({"type": "leave"})
+                await self.ws.close()
+            except Exception:
+                pass
+
+
+class ServerProcess:
+    """Reads CPU time and RSS of the server, from /proc for a child process or getrusage in-process."""
+
+    def __init__(self, pid: Optional[int]) -> None:
+        self.pid = pid
+
+    def cpu_seconds(self) -> Optional[float]:
+        if self.pid is None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self) -> Optional[float]:
+        pid = "self" if self.pid is None else self.pid
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"server did not start on port {port}")
+
+
+def start_subprocess_server(port: int) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return proc
+
+
+def start_inprocess_server(port: int):
+    import uvicorn
+
+    from app.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_for_port(port)
+    return server
+
+
+async def run(url: str, scenario: Scenario, server: Optional[ServerProcess]) -> dict:
+    stats = Stats()
+    rng = random.Random(scenario.seed)
+    clients = [
+        SyntheticClient(url, f"load-{r}", r * scenario.room_size + i, scenario, stats, random.Random(rng.random()))
+        for r in range(scenario.rooms)
+        for i in range(scenario.room_size)
+    ]
+    readers: List[asyncio.Task] = []
+    gate = asyncio.Semaphore(scenario.connect_concurrency)
+
+    async def join(client: SyntheticClient) -> None:
+        async with gate:
+            try:
+                await client.connect()
+            except Exception:
+                stats.error("connect")
+                return
+        readers.append(asyncio.create_task(client.read_loop()))
+        try:
+            await asyncio.wait_for(client.joined.wait(), timeout=30)
+        except asyncio.TimeoutError:
+            stats.error("join-timeout")
+
+    started = time.perf_counter()
+    # Rooms fill in order, so each newcomer offers to the peers already there
+    for i in range(scenario.room_size):
+        await asyncio.gather(*(join(c) for c in clients[i::scenario.room_size]))
+        await asyncio.gather(*(c.negotiate() for c in clients[i::scenario.room_size] if c.joined.is_set()))
+    ramp_seconds = time.perf_counter() - started
+
+    cpu_before = server.cpu_seconds() if server else None
+    received_before = stats.received
+    own_cpu_before = time.process_time()
+    measure_start = time.perf_counter()
+    until = asyncio.get_running_loop().time() + scenario.duration
+    await asyncio.gather(*(c.steady_state(until) for c in clients if c.joined.is_set()))
+    measured = time.perf_counter() - measure_start
+    cpu_after = server.cpu_seconds() if server else None
+    rss = server.rss_mb() if server else None
+    received = stats.received - received_before
+
+    await asyncio.gather(*(c.close() for c in clients))
+    for task in readers:
+        task.cancel()
+
+    def summary(values: List[float]) -> dict:
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50),
+            "p99_ms": percentile(values, 0.99),
+            "max_ms": max(values) if values else None,
+        }
+
+    server_cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        "scenario": dataclasses.asdict(scenario),
+        "clients": len(clients),
+        "connected": stats.connected,
+        "ramp_seconds": round(ramp_seconds, 3),
+        "measured_seconds": round(measured, 3),
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "received_per_second": round(received / measured, 1) if measured else None,
+        "received_by_type": stats.received_by_type,
+        "latency": {kind: summary(values) for kind, values in stats.latency.items()},
+        "server": {
+            "cpu_seconds": round(server_cpu, 3) if server_cpu is not None else None,
+            "cpu_percent": round(100 * server_cpu / measured, 1) if server_cpu is not None and measured else None,
+            "rss_mb": round(rss, 1) if rss is not None else None,
+        },
+        "loadgen_cpu_seconds": round(time.process_time() - own_cpu_before, 3),
+        "errors": stats.errors,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="smoke")
+    parser.add_argument("--url", help="target ws:// URL; default starts the app locally")
+    parser.add_argument("--in-process", action="store_true", help="run the app in this process instead of a subprocess")
+    parser.add_argument("--rooms", type=int)
+    parser.add_argument("--room-size", type=int)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args()
+
+    overrides = {
+        k: v for k, v in (("rooms", args.rooms), ("room_size", args.room_size), ("duration", args.duration),
+                          ("seed", args.seed)) if v is not None
+    }
+    scenario = dataclasses.replace(SCENARIOS[args.scenario], **overrides)
+
+    proc = None
+    if args.url:
+        # Remote server: CPU and RSS are not observable from here
+        url, server = args.url, None
+    else:
+        port = free_port()
+        url = f"ws://127.0.0.1:{port}/ws"
+        if args.in_process:
+            start_inprocess_server(port)
+            # CPU and RSS then include the load generator itself
+            server = ServerProcess(pid=None)
+        else:
+            proc = start_subprocess_server(port)
+            server = ServerProcess(pid=proc.pid)
+    try:
+        result = asyncio.run(run(url, scenario, server))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+    result["target"] = args.url or ("in-process" if args.in_process else "subprocess")
+
+    if args.json:
+        print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+        return
+
+    print(f"{result['clients']} clients in {scenario.rooms} rooms of {scenario.room_size} "
+          f"({result['connected']} connected, ramp {result['ramp_seconds']} s)")
+    print(f"received {result['received_per_second']} msg/s over {result['measured_seconds']} s")
+    for kind, lat in result["latency"].items():
+        if lat["count"]:
+            print(f"{kind:<10} p50 {lat['p50_ms']:.2f} ms  p99 {lat['p99_ms']:.2f} ms  (n={lat['count']})")
+    srv = result["server"]
+    print(f"server cpu {srv['cpu_percent']}%  rss {srv['rss_mb']} MB")
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
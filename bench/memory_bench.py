@@ -0,0 +1,289 @@
+"""Server memory per idle connection and per room.
+
+Starts the app in a subprocess for each level, opens that many idle
+clients that join rooms and then stay silent, and reads the server's RSS
+before and after. A second step adds one-person rooms (at least
+MIN_SOLO_ROOMS, so small levels are not lost in RSS noise) to price a
+room on top of its connection. Results are checked against per-connection
+and per-room budgets; the exit status is 1 if either is exceeded.
+
+    python -m bench.memory_bench                      # 1k, 10k and 50k connections
+    python -m bench.memory_bench --levels 1000 --json
+
+The clients are raw sockets that speak just enough WebSocket to send one
+join and answer pings, so tens of thousands fit in the benchmark process. Localhost has
+about 28k ephemeral ports per source address, so clients are spread over
+127.0.0.x. Every connection takes a file descriptor on both sides: the
+benchmark raises RLIMIT_NOFILE to its hard limit and skips the levels
+that still do not fit.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import orjson
+
+from bench.loadgen import ServerProcess, free_port, wait_for_port
+
+
+DEFAULT_LEVELS = (1000, 10000, 50000)
+# Budgets per idle connection and per room, in KiB of server RSS. Before connection and room state
+# was compacted this benchmark measured 44.0-45.0 KiB per connection (1k and 10k connections) and
+# 3.2-3.6 KiB per room (10k); the budgets sit below that, so a run that loses the savings fails.
+DEFAULT_CONNECTION_BUDGET_KB = 41.0
+DEFAULT_ROOM_BUDGET_KB = 3.0
+# Fewest one-person rooms added to price a room
+MIN_SOLO_ROOMS = 1000
+# Connections per source address, well inside the ephemeral port range
+PER_SOURCE_ADDRESS = 20000
+# Descriptors the benchmark needs beyond the connections themselves
+SPARE_FDS = 256
+
+
+class IdleClient(asyncio.Protocol):
+    """Completes the upgrade and sends one join, then only answers pings."""
+
+    def __init__(self, room_id: str, name: str, joined: asyncio.Future) -> None:
+        self.room_id = room_id
+        self.name = name
+        self.joined = joined
+        self.transport: Optional[asyncio.Transport] = None
+        self._buffer = b""
+        self._upgraded = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        key = base64.b64encode(os.urandom(16)).decode()
+        transport.write((
+            "GET /ws HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+        ).encode())
+
+    def data_received(self, data: bytes) -> None:
+        buffer = self._buffer + data
+        if not self._upgraded:
+            head, sep, buffer = buffer.partition(b"\r\n\r\n")
+            if not sep:
+                self._buffer = head
+                return
+            if b" 101 " not in head.split(b"\r\n", 1)[0]:
+                self._finish(False)
+                return
+            self._upgraded = True
+            join = {"type": "join", "roomId": self.room_id, "name": self.name}
+            self.transport.write(masked_frame(0x1, orjson.dumps(join)))
+        # Server frames are unmasked: opcode, length (7, 16 or 64 bit), payload
+        while len(buffer) >= 2:
+            opcode, length, offset = buffer[0] & 0x0F, buffer[1] & 0x7F, 2
+            if length == 126:
+                if len(buffer) < 4:
+                    break
+                length, offset = int.from_bytes(buffer[2:4], "big"), 4
+            elif length == 127:
+                if len(buffer) < 10:
+                    break
+                length, offset = int.from_bytes(buffer[2:10], "big"), 10
+            if len(buffer) < offset + length:
+                break
+            payload, buffer = buffer[offset:offset + length], buffer[offset + length:]
+            if opcode == 0x9:
+                self.transport.write(masked_frame(0xA, payload))
+            elif opcode == 0x1 and not self.joined.done():
+                if payload.startswith(b'{"type":"joined"'):
+                    self._finish(True)
+                elif payload.startswith(b'{"type":"error"'):
+                    self._finish(False)
+            elif opcode == 0x8:
+                self._finish(False)
+        self._buffer = buffer
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._finish(False)
+
+    def _finish(self, joined: bool) -> None:
+        if not self.joined.done():
+            self.joined.set_result(joined)
+
+
+def masked_frame(opcode: int, payload: bytes) -> bytes:
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x80 | opcode, 0x80 | length))
+    else:
+        header = bytes((0x80 | opcode, 0x80 | 126)) + length.to_bytes(2, "big")
+    return header + mask + masked
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        target = hard if hard != resource.RLIM_INFINITY else 1 << 20
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def start_server(port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        # Idle means idle: no application heartbeats, and no caps in the way
+        HEARTBEAT_INTERVAL="0",
+        MAX_CONNECTIONS="0",
+        MAX_ROOM_PARTICIPANTS="0",
+        LOG_LEVEL="WARNING",
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--backlog", "4096"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return proc
+
+
+async def open_clients(
+    port: int, rooms: List[str], start: int, clients: List[asyncio.Transport], concurrency: int
+) -> int:
+    """Connect one client per entry of `rooms`; returns how many joined."""
+    loop = asyncio.get_running_loop()
+    gate = asyncio.Semaphore(concurrency)
+    joined = 0
+
+    async def one(index: int, room_id: str) -> None:
+        nonlocal joined
+        source = f"127.0.0.{2 + index // PER_SOURCE_ADDRESS}"
+        async with gate:
+            future = loop.create_future()
+            try:
+                transport, _ = await loop.create_connection(
+                    lambda: IdleClient(room_id, f"u{index}", future), "127.0.0.1", port, local_addr=(source, 0)
+                )
+            except OSError:
+                return
+            clients.append(transport)
+            try:
+                if await asyncio.wait_for(future, timeout=30):
+                    joined += 1
+            except asyncio.TimeoutError:
+                pass
+
+    await asyncio.gather(*(one(start + i, room_id) for i, room_id in enumerate(rooms)))
+    return joined
+
+
+async def settle(server: ServerProcess, seconds: float) -> float:
+    """Let the server finish sending and collect garbage, then read its RSS (MiB)."""
+    await asyncio.sleep(seconds)
+    return server.rss_mb() or 0.0
+
+
+async def measure(level: int, room_size: int, concurrency: int, settle_seconds: float) -> dict:
+    port = free_port()
+    proc = start_server(port)
+    server = ServerProcess(proc.pid)
+    clients: List[asyncio.Transport] = []
+    try:
+        # Warm up imports, caches and the first room before the baseline
+        await open_clients(port, ["warmup"], 0, clients, 1)
+        base = await settle(server, settle_seconds)
+
+        rooms = [f"room-{i // room_size}" for i in range(level)]
+        started = time.perf_counter()
+        joined = await open_clients(port, rooms, 1, clients, concurrency)
+        ramp = time.perf_counter() - started
+        after_connections = await settle(server, settle_seconds)
+
+        # One-person rooms: each costs a connection plus a room
+        extra = max(MIN_SOLO_ROOMS, level // room_size)
+        extra_joined = await open_clients(port, [f"solo-{i}" for i in range(extra)], 1 + level, clients, concurrency)
+        after_rooms = await settle(server, settle_seconds)
+    finally:
+        for transport in clients:
+            transport.abort()
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    per_connection = (after_connections - base) * 1024 / max(1, joined)
+    per_solo = (after_rooms - after_connections) * 1024 / max(1, extra_joined)
+    return {
+        "connections": level,
+        "joined": joined,
+        "rooms": (level + room_size - 1) // room_size,
+        "room_size": room_size,
+        "ramp_seconds": round(ramp, 2),
+        "rss_mb": {"baseline": round(base, 1), "connections": round(after_connections, 1), "rooms": round(after_rooms, 1)},
+        "kb_per_connection": round(per_connection, 2),
+        # A solo room's cost beyond that of the connection in it
+        "kb_per_room": round(max(0.0, per_solo - per_connection), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--levels", type=int, nargs="+", default=list(DEFAULT_LEVELS))
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=500, help="connection attempts in flight")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before each RSS reading")
+    parser.add_argument("--connection-budget-kb", type=float, default=DEFAULT_CONNECTION_BUDGET_KB)
+    parser.add_argument("--room-budget-kb", type=float, default=DEFAULT_ROOM_BUDGET_KB)
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args()
+
+    fd_limit = raise_fd_limit()
+    results: List[dict] = []
+    skipped: Dict[int, str] = {}
+    for level in args.levels:
+        # The server subprocess inherits the limit; this process holds the other end of each socket
+        needed = level + max(MIN_SOLO_ROOMS, level // args.room_size) + SPARE_FDS
+        if needed > fd_limit:
+            skipped[level] = f"needs {needed} file descriptors, RLIMIT_NOFILE is {fd_limit}"
+            continue
+        results.append(asyncio.run(measure(level, args.room_size, args.concurrency, args.settle)))
+
+    failures = []
+    for result in results:
+        if result["joined"] < result["connections"]:
+            failures.append(f"{result['connections']}: only {result['joined']} clients joined")
+        if result["kb_per_connection"] > args.connection_budget_kb:
+            failures.append(f"{result['connections']}: {result['kb_per_connection']} KiB per connection "
+                            f"> budget {args.connection_budget_kb}")
+        if result["kb_per_room"] > args.room_budget_kb:
+            failures.append(f"{result['connections']}: {result['kb_per_room']} KiB per room > budget {args.room_budget_kb}")
+
+    if args.json:
+        print(orjson.dumps({
+            "results": results,
+            "skipped": skipped,
+            "budget_kb": {"connection": args.connection_budget_kb, "room": args.room_budget_kb},
+            "failures": failures,
+        }, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode())
+    else:
+        for result in results:
+            print(f"{result['connections']:>6} connections ({result['joined']} joined) in {result['rooms']} rooms: "
+                  f"{result['kb_per_connection']:.2f} KiB/connection, {result['kb_per_room']:.2f} KiB/room "
+                  f"(rss {result['rss_mb']['baseline']} -> {result['rss_mb']['connections']} -> "
+                  f"{result['rss_mb']['rooms']} MB, ramp {result['ramp_seconds']} s)")
+        for level, reason in skipped.items():
+            print(f"{level:>6} connections: skipped, {reason}")
+        for failure in failures:
+            print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
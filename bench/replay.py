@@ -0,0 +1,421 @@
+"""Replay a signaling trace against a local server.
+
+Reads a file recorded with TRACE_FILE (see app.services.trace) and
+re-creates its traffic: every recorded connection opens, sends its
+messages and closes at the recorded offsets, divided by --speed (0 sends
+as fast as possible). Payloads are not recorded, so each message is
+rebuilt from its type, target and size; offers, answers, ICE and chat
+carry a timestamp marker so their delivery latency can be measured.
+Rooms and clients keep their anonymized numbers ("replay-<room>").
+
+The server runs in a thread of this process on its own event loop, where
+a probe measures event-loop lag; with --url the trace is replayed against
+a running server instead, without lag figures. The report has delivery
+latency per message type (p50/p99/max), join and ping round trips, how
+far sends slipped behind the schedule, and the messages received next to
+those the trace recorded as queued.
+
+    python -m bench.replay trace.bin                    # recorded timing
+    python -m bench.replay trace.bin --speed 10 --json  # ten times faster
+
+Binary-protocol connections are replayed as JSON, and resumed sessions as
+fresh joins.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import orjson
+import websockets
+
+from app.services.trace import (
+    FLAG_BATCHED,
+    KIND_CLOSE,
+    KIND_EVICT,
+    KIND_IN,
+    KIND_JOINED,
+    KIND_OPEN,
+    KIND_OUT,
+    TraceReader,
+    TraceRecord,
+)
+from bench.loadgen import elapsed_ms, free_port, percentile, stamp, wait_for_port
+
+
+# Seconds a message for a peer waits for that peer's connection to join
+PEER_JOIN_TIMEOUT = 5.0
+# Width of a stamp() marker, counted in the recorded size of the message carrying it
+MARKER_WIDTH = 16
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latency: Dict[str, List[float]] = {
+            "offer": [], "answer": [], "ice": [], "chat": [], "join": [], "ping": [],
+        }
+        # ms each send went out after its scheduled time
+        self.slip: List[float] = []
+        self.lag: List[float] = []
+        self.sent = 0
+        self.received_by_type: Dict[str, int] = {}
+        self.recorded_by_type: Dict[str, int] = {}
+        self.recorded_evictions = 0
+        self.skipped: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+
+    def skip(self, reason: str) -> None:
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+
+class Connection:
+    """One recorded /ws connection: sends its messages in order and timestamps what it receives."""
+
+    def __init__(self, number: int, url: str, stats: Stats) -> None:
+        self.number = number
+        self.url = url
+        self.stats = stats
+        self.ws = None
+        self.client_id: Optional[str] = None
+        self.joined = asyncio.Event()
+        # (message, connection it is addressed to); None closes the connection
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.join_sent: Optional[str] = None
+        self.pings: Deque[str] = deque()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        stats = self.stats
+        try:
+            self.ws = await websockets.connect(self.url, subprotocols=["vc.json.1"], max_size=None, open_timeout=30)
+        except Exception:
+            stats.errors["connect"] = stats.errors.get("connect", 0) + 1
+            return
+        reader = asyncio.create_task(self.read_loop())
+        try:
+            while True:
+                item = await self.outbox.get()
+                if item is None:
+                    return
+                message, target = item
+                if target is not None:
+                    if not target.joined.is_set():
+                        try:
+                            await asyncio.wait_for(target.joined.wait(), timeout=PEER_JOIN_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            stats.skip("peer-not-joined")
+                            continue
+                    message["to"] = target.client_id
+                await self.ws.send(orjson.dumps(self.mark(message)).decode())
+                stats.sent += 1
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+            reader.cancel()
+
+    def mark(self, message: dict) -> dict:
+        """Stamp the send time into the message (or each message of a batch)."""
+        msg_type = message.get("type")
+        if msg_type == "batch":
+            for inner in message["messages"]:
+                self.mark(inner)
+        elif msg_type in ("offer", "answer"):
+            message["sdp"] = stamp() + message["sdp"]
+        elif msg_type == "ice":
+            message["candidate"]["usernameFragment"] = stamp()
+        elif msg_type == "chat":
+            message["message"] = stamp() + message["message"]
+        elif msg_type == "join":
+            self.join_sent = stamp()
+        elif msg_type == "ping":
+            self.pings.append(stamp())
+        return message
+
+    async def read_loop(self) -> None:
+        stats = self.stats
+        try:
+            async for raw in self.ws:
+                message = orjson.loads(raw)
+                msg_type = message.get("type")
+                stats.received_by_type[msg_type] = stats.received_by_type.get(msg_type, 0) + 1
+                if msg_type == "joined":
+                    self.client_id = message.get("clientId")
+                    self.joined.set()
+                    self._record("join", self.join_sent)
+                elif msg_type in ("offer", "answer"):
+                    self._record(msg_type, (message.get("sdp") or "").partition(" ")[0])
+                elif msg_type == "ice":
+                    for candidate in message.get("candidates") or [message.get("candidate")]:
+                        self._record("ice", (candidate or {}).get("usernameFragment"))
+                elif msg_type == "chat":
+                    if message.get("fromClientId") != self.client_id:
+                        self._record("chat", (message.get("message") or "").partition(" ")[0])
+                elif msg_type == "pong" and self.pings:
+                    self._record("ping", self.pings.popleft())
+                elif msg_type == "ping":
+                    await self.ws.send('{"type":"pong"}')
+                elif msg_type == "error":
+                    error = message.get("error") or "error"
+                    stats.errors[error] = stats.errors.get(error, 0) + 1
+        except websockets.ConnectionClosed:
+            pass
+
+    def _record(self, kind: str, marker: Optional[str]) -> None:
+        latency = elapsed_ms(marker) if marker else None
+        if latency is not None:
+            self.stats.latency[kind].append(latency)
+
+
+def padding(size: int, used: int) -> str:
+    return "x" * max(0, size - used)
+
+
+def synthesize(msg_type: str, record: TraceRecord, vad: Dict[int, bool]) -> Optional[dict]:
+    """A stand-in for a recorded message of this type, about as large as the original."""
+    size = record.size
+    if msg_type == "join":
+        return {"type": "join", "roomId": f"replay-{record.room}", "name": f"client-{record.conn}"}
+    if msg_type in ("offer", "answer"):
+        return {"type": msg_type, "sdp": " " + padding(size, 60 + MARKER_WIDTH)}
+    if msg_type == "ice":
+        return {"type": "ice", "candidate": {
+            "candidate": "candidate:" + padding(size, 120 + MARKER_WIDTH), "sdpMid": "0", "sdpMLineIndex": 0,
+        }}
+    if msg_type == "chat":
+        return {"type": "chat", "message": " " + padding(size, 30 + MARKER_WIDTH)}
+    if msg_type == "pitch":
+        return {"type": "pitch", "hz": 150}
+    if msg_type == "vad":
+        # Recorded flips alternate, whatever their values were
+        speaking = vad[record.conn] = not vad.get(record.conn, False)
+        return {"type": "vad", "speaking": speaking}
+    if msg_type == "mute":
+        return {"type": "mute", "muted": False}
+    if msg_type == "media-state":
+        return {"type": "media-state", "hasAudio": True, "hasVideo": False}
+    if msg_type == "history":
+        return {"type": "history", "limit": 50}
+    if msg_type == "roster-sync":
+        return {"type": "roster-sync", "since": 0}
+    if msg_type == "peer-connection":
+        return {"type": "peer-connection", "state": "connected", "ms": 0}
+    if msg_type in ("ping", "pong", "leave"):
+        return {"type": msg_type}
+    return None
+
+
+class Replayer:
+    def __init__(self, url: str, reader: TraceReader, speed: float, stats: Stats) -> None:
+        self.url = url
+        self.reader = reader
+        self.speed = speed
+        self.stats = stats
+        self.connections: Dict[int, Connection] = {}
+        # Anonymized client number -> the connection that joined as it
+        self.clients: Dict[int, Connection] = {}
+        self.vad: Dict[int, bool] = {}
+
+    def connection(self, number: int) -> Connection:
+        # Traces that start mid-session open connections on their first message
+        conn = self.connections.get(number)
+        if conn is None:
+            conn = self.connections[number] = Connection(number, self.url, self.stats)
+        return conn
+
+    def message(self, record: TraceRecord) -> Optional[Tuple[dict, Optional[Connection]]]:
+        msg_type = self.reader.type_name(record.type)
+        message = synthesize(msg_type, record, self.vad)
+        if message is None:
+            self.stats.skip(f"unreplayable:{msg_type}")
+            return None
+        target = None
+        if record.peer and msg_type in ("offer", "answer", "ice"):
+            target = self.clients.get(record.peer)
+            if target is None:
+                self.stats.skip("unknown-peer")
+                return None
+        return message, target
+
+    async def run(self) -> float:
+        """Send everything on schedule; returns the replay's wall-clock duration."""
+        stats = self.stats
+        records = list(self.reader.records())
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        i = 0
+        while i < len(records):
+            record = records[i]
+            i += 1
+            if record.kind == KIND_OUT:
+                name = self.reader.type_name(record.type)
+                stats.recorded_by_type[name] = stats.recorded_by_type.get(name, 0) + 1
+                continue
+            if record.kind == KIND_EVICT:
+                stats.recorded_evictions += 1
+                continue
+            if self.speed > 0:
+                delay = started + record.t_ns / 1e9 / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                stats.slip.append(max(0.0, -delay) * 1000)
+            if record.kind == KIND_OPEN:
+                self.connection(record.conn)
+            elif record.kind == KIND_JOINED:
+                self.clients[record.client] = self.connection(record.conn)
+            elif record.kind == KIND_CLOSE:
+                self.connection(record.conn).outbox.put_nowait(None)
+            elif record.kind == KIND_IN and not record.flags & FLAG_BATCHED:
+                conn = self.connection(record.conn)
+                if self.reader.type_name(record.type) == "batch":
+                    # The messages of a batch are recorded right after its envelope
+                    inner = []
+                    while i < len(records) and records[i].kind == KIND_IN and records[i].flags & FLAG_BATCHED:
+                        item = self.message(records[i])
+                        i += 1
+                        # Targets are resolved when a batch is built, so it can go out as one frame
+                        if item and (item[1] is None or item[1].client_id):
+                            if item[1] is not None:
+                                item[0]["to"] = item[1].client_id
+                            inner.append(item[0])
+                        elif item:
+                            stats.skip("peer-not-joined")
+                    if inner:
+                        conn.outbox.put_nowait(({"type": "batch", "messages": inner}, None))
+                    continue
+                item = self.message(record)
+                if item:
+                    conn.outbox.put_nowait(item)
+        return loop.time() - started
+
+    async def finish(self, settle: float) -> None:
+        """Let queued messages go out and deliveries arrive, then close what the trace left open."""
+        while any(not conn.outbox.empty() and not conn.task.done() for conn in self.connections.values()):
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(settle)
+        for conn in self.connections.values():
+            conn.outbox.put_nowait(None)
+        for conn in self.connections.values():
+            await conn.task
+
+
+async def probe_lag(samples: List[float], interval: float) -> None:
+    """Record how late each timer fires on the running loop, in ms."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected) * 1000)
+
+
+def start_server_thread(port: int, lag: List[float], interval: float):
+    """Run the app on its own event loop in a daemon thread, with a lag probe on that loop."""
+    import uvicorn
+
+    from app.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+
+    async def serve() -> None:
+        probe = asyncio.create_task(probe_lag(lag, interval))
+        try:
+            await server.serve()
+        finally:
+            probe.cancel()
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+    thread.start()
+    wait_for_port(port)
+    return server, thread
+
+
+def summary(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.50),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": max(values) if values else None,
+    }
+
+
+async def replay(url: str, reader: TraceReader, speed: float, settle: float, stats: Stats) -> dict:
+    replayer = Replayer(url, reader, speed, stats)
+    duration = await replayer.run()
+    await replayer.finish(settle)
+    return {
+        "trace": {"records": len(reader), "started_ns": reader.started_ns, "pid": reader.meta.get("pid")},
+        "speed": speed,
+        "connections": len(replayer.connections),
+        "replay_seconds": round(duration, 3),
+        "messages_sent": stats.sent,
+        "latency": {kind: summary(values) for kind, values in stats.latency.items()},
+        "schedule_slip": summary(stats.slip),
+        "event_loop_lag": summary(stats.lag) if stats.lag else None,
+        "received_by_type": stats.received_by_type,
+        "recorded_by_type": stats.recorded_by_type,
+        "recorded_evictions": stats.recorded_evictions,
+        "skipped": stats.skipped,
+        "errors": stats.errors,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", help="file recorded with TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression; 0 sends as fast as possible")
+    parser.add_argument("--url", help="target ws:// URL; default runs the app in this process")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait for deliveries after the last send")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="seconds between event-loop lag probes")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args()
+
+    stats = Stats()
+    server = thread = None
+    if args.url:
+        url = args.url
+    else:
+        port = free_port()
+        url = f"ws://127.0.0.1:{port}/ws"
+        server, thread = start_server_thread(port, stats.lag, args.lag_interval)
+    try:
+        with TraceReader(args.trace) as reader:
+            result = asyncio.run(replay(url, reader, args.speed, args.settle, stats))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=10)
+    result["target"] = args.url or "in-process"
+
+    if args.json:
+        print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+        return
+
+    print(f"{result['trace']['records']} records, {result['connections']} connections, "
+          f"{result['messages_sent']} messages sent in {result['replay_seconds']} s at speed {args.speed}")
+    for kind, lat in result["latency"].items():
+        if lat["count"]:
+            print(f"{kind:<10} p50 {lat['p50_ms']:.2f} ms  p99 {lat['p99_ms']:.2f} ms  max {lat['max_ms']:.2f} ms  "
+                  f"(n={lat['count']})")
+    slip = result["schedule_slip"]
+    if slip["count"]:
+        print(f"schedule slip p50 {slip['p50_ms']:.2f} ms  p99 {slip['p99_ms']:.2f} ms  max {slip['max_ms']:.2f} ms")
+    lag = result["event_loop_lag"]
+    if lag:
+        print(f"event-loop lag p50 {lag['p50_ms']:.2f} ms  p99 {lag['p99_ms']:.2f} ms  max {lag['max_ms']:.2f} ms")
+    for name in sorted(set(result["recorded_by_type"]) | set(result["received_by_type"])):
+        print(f"{name:<14} recorded {result['recorded_by_type'].get(name, 0):>7}  "
+              f"received {result['received_by_type'].get(name, 0):>7}")
+    if result["skipped"]:
+        print(f"skipped: {result['skipped']}")
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
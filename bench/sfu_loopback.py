@@ -0,0 +1,120 @@
+"""Exercise SFU mode with loopback aiortc peers on one machine.
+
+Each simulated client publishes a synthetic audio and video track through
+RoomService + SfuService, using the same offer/answer messages a browser
+would. The run checks that every client ends up receiving a frame from each
+of the other clients' tracks. Needs aiortc.
+
+    python -m bench.sfu_loopback --clients 4
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+import orjson
+
+from app.services.rooms import RoomService
+from app.services.sfu import SFU_AVAILABLE, SFU_PEER_ID, SfuService
+
+if SFU_AVAILABLE:
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import AudioStreamTrack, VideoStreamTrack
+
+
+class LoopbackSocket:
+    """Stands in for a client's WebSocket and answers the SFU's offers."""
+
+    def __init__(self) -> None:
+        self.pc = None
+        self.on_offer = None
+
+    async def send_text(self, data: str) -> None:
+        message = orjson.loads(data)
+        if message.get("type") == "offer" and message.get("from") == SFU_PEER_ID:
+            await self.on_offer(message["sdp"])
+
+    async def send_bytes(self, data: bytes) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+async def run(clients: int, timeout: float) -> dict:
+    service = RoomService()
+    sfu = SfuService(service, mode="always")
+    room_id = "loopback"
+    received = {}
+    start = time.perf_counter()
+
+    for i in range(clients):
+        socket = LoopbackSocket()
+        client = await service.join(room_id, socket, f"peer-{i}")
+        sfu.update_mode(room_id, i + 1)
+        pc = RTCPeerConnection()
+        pc.addTrack(AudioStreamTrack())
+        pc.addTrack(VideoStreamTrack())
+        tracks = received[client.client_id] = []
+
+        @pc.on("track")
+        def on_track(track, tracks=tracks) -> None:
+            tracks.append(track)
+
+        async def on_offer(sdp: str, pc=pc, client_id=client.client_id) -> None:
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="offer"))
+            await pc.setLocalDescription(await pc.createAnswer())
+            await sfu.handle_answer(room_id, client_id, pc.localDescription.sdp)
+
+        socket.pc, socket.on_offer = pc, on_offer
+        await pc.setLocalDescription(await pc.createOffer())
+        answer = await sfu.handle_offer(room_id, client.client_id, pc.localDescription.sdp)
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer, type="answer"))
+
+    expected = 2 * (clients - 1)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and any(len(t) < expected for t in received.values()):
+        await asyncio.sleep(0.1)
+    negotiated = time.perf_counter() - start
+
+    # Every forwarded track must actually deliver media
+    flowing = 0
+    for tracks in received.values():
+        for track in tracks:
+            try:
+                await asyncio.wait_for(track.recv(), timeout=timeout)
+                flowing += 1
+            except asyncio.TimeoutError:
+                pass
+
+    room = service.rooms.get(room_id)
+    for client_id in list(room.clients if room else []):
+        service.leave(room_id, client_id)
+    await sfu.stop()
+
+    return {
+        "clients": clients,
+        "expected_tracks_per_client": expected,
+        "tracks_per_client": sorted(len(t) for t in received.values()),
+        "tracks_flowing": flowing,
+        "negotiation_seconds": round(negotiated, 3),
+        "ok": flowing == clients * expected,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+    if not SFU_AVAILABLE:
+        raise SystemExit("aiortc is not installed (pip install aiortc)")
+    result = asyncio.run(run(args.clients, args.timeout))
+    print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+    if not result["ok"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
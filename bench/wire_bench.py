@@ -0,0 +1,127 @@
+"""Compare the JSON and vc.bin.1 wire protocols.
+
+Reports bytes per message for representative signaling traffic and the CPU
+time RoomService spends per broadcast (encode + enqueue) for a room full of
+JSON clients versus a room full of binary clients.
+
+    python -m bench.wire_bench --room-size 10 --iterations 2000 --rounds 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+import orjson
+
+from app.services.rooms import RoomService
+from app.services.wire import Payload
+
+
+class SinkWebSocket:
+    """Stands in for a WebSocket; discards frames."""
+
+    async def send_text(self, data: str) -> None:
+        pass
+
+    async def send_bytes(self, data: bytes) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+def sample_messages(sender: str, peer_ids: list) -> dict:
+    sdp = "v=0\r\n" + "a=candidate:1 1 udp 2122260223 192.168.1.10 54321 typ host\r\n" * 40
+    return {
+        "offer": {"type": "offer", "from": sender, "sdp": sdp},
+        "ice": {
+            "type": "ice",
+            "from": sender,
+            "candidate": {
+                "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 61021 typ srflx raddr 0.0.0.0 rport 0",
+                "sdpMid": "0",
+                "sdpMLineIndex": 0,
+            },
+        },
+        "chat": {"type": "chat", "fromClientId": sender, "fromName": "Guest", "message": "hello everyone"},
+        "mute": {"type": "mute", "clientId": sender, "muted": True},
+        "media-state": {"type": "media-state", "clientId": sender, "hasAudio": True, "hasVideo": False},
+        "telemetry": {"type": "telemetry", "peers": [[cid, 180, 1] for cid in peer_ids]},
+        "peer-left": {"type": "peer-left", "clientId": sender, "name": "Guest"},
+    }
+
+
+async def build_room(service: RoomService, room_id: str, size: int, binary: bool) -> list:
+    clients = []
+    for i in range(size):
+        clients.append(await service.join(room_id, SinkWebSocket(), f"peer-{i}", binary=binary))
+    return clients
+
+
+async def run(room_size: int, iterations: int, rounds: int = 5) -> dict:
+    service = RoomService(send_queue_max=iterations + 16, send_queue_high_water=iterations + 16)
+    json_clients = await build_room(service, "json", room_size, binary=False)
+    bin_clients = await build_room(service, "bin", room_size, binary=True)
+    handles = service.rooms["bin"].handles
+
+    sender = bin_clients[0].client_id
+    samples = sample_messages(sender, [c.client_id for c in bin_clients])
+    sizes = {}
+    for name, message in samples.items():
+        sizes[name] = {
+            "json": len(orjson.dumps(message)),
+            "binary": len(Payload(message).binary(handles)),
+        }
+
+    # Rounds alternate between the protocols after a warm-up round, and the best round counts,
+    # so neither protocol is measured cold
+    cpu = {"json": float("inf"), "binary": float("inf")}
+    for round_number in range(rounds + 1):
+        for label, room_id, clients in (("json", "json", json_clients), ("binary", "bin", bin_clients)):
+            message = dict(samples["chat"], fromClientId=clients[0].client_id)
+            start = time.process_time()
+            for _ in range(iterations):
+                await service.broadcast(room_id, message)
+            elapsed = time.process_time() - start
+            for client in clients:
+                client.queue.clear()
+            if round_number:
+                cpu[label] = min(cpu[label], elapsed / iterations * 1e6)
+
+    for room_id in list(service.rooms):
+        for client_id in list(service.rooms[room_id].clients):
+            service.leave(room_id, client_id)
+
+    return {
+        "room_size": room_size,
+        "iterations": iterations,
+        "rounds": rounds,
+        "bytes_per_message": sizes,
+        "cpu_us_per_broadcast": cpu,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--room-size", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per protocol; the best is reported")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.room_size, args.iterations, max(1, args.rounds)))
+    if args.json:
+        print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
+        return
+
+    print(f"{'message':<14}{'json B':>10}{'binary B':>10}{'ratio':>8}")
+    for name, size in result["bytes_per_message"].items():
+        print(f"{name:<14}{size['json']:>10}{size['binary']:>10}{size['binary'] / size['json']:>8.2f}")
+    cpu = result["cpu_us_per_broadcast"]
+    print(f"\nCPU per chat broadcast to {args.room_size} clients: "
+          f"json {cpu['json']:.1f} us, binary {cpu['binary']:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,42 @@ const state = {
   roomId: null,
   name: null,
   clientId: null,
+  joinSeq: 0,
+  joinStartedAt: 0,
   peers: new Map(),
   localStream: null,
   muted: false,
-  analyser: null,
-  vadInterval: null,
-  pitchInterval: null,
+  audioCtx: null,
+  workletReady: null,
+  analysers: new Map(),
+  mediaPolicy: null,
+  lastPitch: 0,
+  pendingPitch: null,
+  pitchTimer: null,
+  lastPitchSentAt: 0,
+  telemetryHz: 5,
+  lastSpeaking: false,
   isBackgroundTab: false,
   notificationPermission: 'default',
   audioContexts: new Set(),
+  binary: false,
+  wireTable: Wire.createPeerTable(),
+  outbox: [],
+  outboxTimer: null,
+  sfu: null,
+  rosterVersion: 0,
+  rosterSyncPending: false,
+  participantItems: new Map(),
+  resumeToken: null,
+  leaving: false,
+  reconnectAttempts: 0,
+  reconnectTimer: null,
+  heartbeatTimer: null,
+  lastServerFrame: 0,
+  oldestChatSeq: null,
+  newestChatSeq: 0,
+  hasMoreHistory: false,
+  historyPending: false,
 };
 
 const el = (id) => document.getElementById(id);
@@ -107,6 +134,44 @@ function appendMessage(text, me = false) {
   messages.scrollTop = messages.scrollHeight;
 }
 
+function chatMessageElement(msg) {
+  const isMe = msg.fromClientId && msg.fromClientId === state.clientId;
+  const div = document.createElement('div');
+  div.className = `msg ${isMe ? 'me' : 'other'}`;
+  div.textContent = `${isMe ? 'You' : msg.fromName}: ${msg.message}`;
+  return div;
+}
+
+/* History arrives oldest first; older pages are prepended without moving the view */
+function renderHistory(list, hasMore, initial) {
+  state.historyPending = false;
+  state.hasMoreHistory = !!hasMore;
+  if (!list || !list.length) return;
+  state.oldestChatSeq = list[0].seq;
+  if (initial) state.newestChatSeq = list[list.length - 1].seq || 0;
+  const fragment = document.createDocumentFragment();
+  list.forEach((m) => fragment.appendChild(chatMessageElement(m)));
+  if (initial) { messages.replaceChildren(fragment); messages.scrollTop = messages.scrollHeight; return; }
+  const fromBottom = messages.scrollHeight - messages.scrollTop;
+  messages.prepend(fragment);
+  messages.scrollTop = messages.scrollHeight - fromBottom;
+}
+
+/* Live messages carry the seq of the room's history; one already shown (replayed on resume) is dropped */
+function acceptChat(msg) {
+  if (!msg.seq) return true;
+  if (msg.seq <= state.newestChatSeq) return false;
+  state.newestChatSeq = msg.seq;
+  if (state.oldestChatSeq === null) state.oldestChatSeq = msg.seq;
+  return true;
+}
+
+function requestOlderHistory() {
+  if (!state.hasMoreHistory || state.historyPending || state.oldestChatSeq === null) return;
+  state.historyPending = true;
+  send({ type: 'history', before: state.oldestChatSeq, limit: 50 });
+}
+
 function ensureTileElements(clientId, name, isLocal=false) {
   let wrap = document.getElementById(`tile-${clientId}`);
   if (!wrap) {
@@ -182,6 +247,7 @@ function setPitchUI(clientId, hz){
 }
 
 function removePeerTile(clientId) {
+  stopAnalysis(clientId);
   const wrap = document.getElementById(`tile-${clientId}`);
   if (wrap && wrap.parentNode) wrap.parentNode.removeChild(wrap);
 }
@@ -207,57 +273,58 @@ function hideParticipantsSection() {
   }
 }
 
+function participantItem(clientId, name, isYou = false) {
+  const li = document.createElement('li');
+  const nameEl = document.createElement('span');
+  nameEl.className = 'participant-name';
+  nameEl.textContent = isYou ? `${name} (you)` : name;
+  const idEl = document.createElement('span');
+  idEl.className = 'participant-id';
+  idEl.textContent = clientId;
+  li.append(nameEl, idEl);
+  return li;
+}
+
+/* Full render on joined only; presence deltas then add/remove single items */
 function updateParticipantsList(peers) {
   if (!participantsList) return;
-  
-  participantsList.innerHTML = '';
-  
-  // Add current user
-  if (state.name && state.clientId) {
-    const currentUserLi = document.createElement('li');
-    currentUserLi.innerHTML = `
-      <span class="participant-name">${state.name} (you)</span>
-      <span class="participant-id">${state.clientId}</span>
-    `;
-    participantsList.appendChild(currentUserLi);
-  }
-  
-  // Add other participants
-  peers.forEach((peer) => {
-    const li = document.createElement('li');
-    li.innerHTML = `
-      <span class="participant-name">${peer.name}</span>
-      <span class="participant-id">${peer.clientId}</span>
-    `;
-    participantsList.appendChild(li);
-  });
+  state.participantItems.clear();
+  const fragment = document.createDocumentFragment();
+  if (state.name && state.clientId) fragment.appendChild(participantItem(state.clientId, state.name, true));
+  peers.forEach((peer) => { const li = participantItem(peer.clientId, peer.name); state.participantItems.set(peer.clientId, li); fragment.appendChild(li); });
+  participantsList.replaceChildren(fragment);
 }
 
-function updateParticipantsListFromPeers() {
-  if (!participantsList) return;
-  
-  participantsList.innerHTML = '';
-  
-  // Add current user
-  if (state.name && state.clientId) {
-    const currentUserLi = document.createElement('li');
-    currentUserLi.innerHTML = `
-      <span class="participant-name">${state.name} (you)</span>
-      <span class="participant-id">${state.clientId}</span>
-    `;
-    participantsList.appendChild(currentUserLi);
-  }
-  
-  // Add other participants from state.peers Map
-  state.peers.forEach((peer, clientId) => {
-    const li = document.createElement('li');
-    li.innerHTML = `
-      <span class="participant-name">${peer.name}</span>
-      <span class="participant-id">${clientId}</span>
-    `;
-    participantsList.appendChild(li);
-  });
+function addParticipant(clientId, name) {
+  if (!participantsList || state.participantItems.has(clientId)) return;
+  const li = participantItem(clientId, name);
+  state.participantItems.set(clientId, li);
+  participantsList.appendChild(li);
+}
+
+function removeParticipant(clientId) {
+  const li = state.participantItems.get(clientId);
+  if (li) li.remove();
+  state.participantItems.delete(clientId);
+}
+
+/* Presence deltas carry the room's roster version; on a gap, ask the server for just the missing ones */
+function acceptRosterDelta(msg) {
+  if (typeof msg.rosterVersion !== 'number') return true;
+  if (msg.rosterVersion <= state.rosterVersion) return false;
+  if (msg.rosterVersion > state.rosterVersion + 1) { requestRosterSync(); return false; }
+  state.rosterVersion = msg.rosterVersion;
+  return true;
 }
+function requestRosterSync() { if (state.rosterSyncPending) return; state.rosterSyncPending = true; send({ type: 'roster-sync', since: state.rosterVersion }); }
+function handleRoster(msg) { state.rosterSyncPending = false; if (msg.deltas) msg.deltas.forEach(handleMessage); else if (msg.peers) applyRosterSnapshot(msg.peers, msg.version); }
+function applyRosterSnapshot(peers, version) {
+  const present = new Set(peers.map((p) => p.clientId));
+  for (const id of [...state.peers.keys()]) if (!present.has(id)) removePeer(id);
+  for (const p of peers) if (!state.peers.has(p.clientId)) { const peer = rememberPeer(p, performance.now()); addParticipant(p.clientId, p.name); if (!state.sfu && peer.roles.offerer) openPeer(p.clientId); }
+  state.rosterVersion = version;
+}
+function removePeer(clientId) { const peer = state.peers.get(clientId); try { peer && peer.pc && peer.pc.close(); } catch {} removePeerTile(clientId); removeParticipant(clientId); state.peers.delete(clientId); if (state.sfu) state.sfu.streams.delete(clientId); }
 
 function mediaConstraints(videoPreferred=true){
   const audio = { echoCancellation: true, noiseSuppression: true, autoGainControl: true };
@@ -282,8 +349,7 @@ async function ensureMedia() {
   state.localStream = await getMediaWithFallback();
   if (state.localStream) {
     addPeerTile('local', state.name || 'Me', state.localStream, true);
-    setupLocalVAD(state.localStream);
-    setupLocalPitch(state.localStream);
+    setupLocalAnalysis(state.localStream);
     send({ type: 'media-state', hasAudio: hasAudioTrack(state.localStream), hasVideo: hasVideoTrack(state.localStream) });
   }
   return state.localStream;
@@ -292,9 +358,51 @@ async function ensureMedia() {
 function hasAudioTrack(stream){ return !!(stream && stream.getAudioTracks().find(t=>t.enabled !== false)); }
 function hasVideoTrack(stream){ return !!(stream && stream.getVideoTracks().length); }
 
+/* Mesh negotiation. The server numbers members in join order (joinSeq); toward each peer the later joiner
+   offers and is impolite, the earlier one answers and is polite, so both sides of a pair agree without talking.
+   Connections follow the perfect-negotiation pattern: offers come from onnegotiationneeded, an impolite peer
+   ignores a colliding offer and a polite one rolls back its own. */
+function rolesToward(p) {
+  if (typeof p.offerer === 'boolean') return { offerer: p.offerer, polite: p.polite };
+  const mine = state.joinSeq || 0, theirs = p.joinSeq || 0;
+  const offerer = mine !== theirs ? mine > theirs : state.clientId > p.clientId;
+  return { offerer, polite: !offerer };
+}
+// Record a peer from joined/peer-joined/roster; seenAt starts its time-to-connected clock
+function rememberPeer(p, seenAt) {
+  const peer = state.peers.get(p.clientId) || { seenAt };
+  peer.name = p.name; peer.joinSeq = p.joinSeq;
+  if (!peer.pc) peer.roles = rolesToward(p);
+  state.peers.set(p.clientId, peer);
+  return peer;
+}
+function openPeer(clientId) {
+  const peer = state.peers.get(clientId) || { name: 'Peer' };
+  if (peer.pc) return peer;
+  // A peer we have not been told about yet can only reach us with an offer: it is the offerer
+  peer.roles = peer.roles || { offerer: false, polite: true };
+  if (peer.seenAt === undefined) peer.seenAt = performance.now();
+  Object.assign(peer, { makingOffer: false, ignoreOffer: false, settingAnswer: false, reported: false });
+  state.peers.set(clientId, peer);
+  peer.pc = createPeerConnection(clientId);
+  addLocalTracksTo(peer.pc);
+  // With no tracks of our own nothing would trigger negotiation; offer to receive instead
+  if (peer.roles.offerer && !state.localStream) { peer.pc.addTransceiver('audio', { direction: 'recvonly' }); peer.pc.addTransceiver('video', { direction: 'recvonly' }); }
+  return peer;
+}
+function reportConnection(clientId, pc) {
+  const peer = state.peers.get(clientId);
+  if (!peer || peer.pc !== pc || peer.reported || (pc.connectionState !== 'connected' && pc.connectionState !== 'failed')) return;
+  peer.reported = true;
+  send({ type: 'peer-connection', state: pc.connectionState, ms: Math.round(performance.now() - peer.seenAt) });
+}
+
 function createPeerConnection(targetId) {
   const pc = new RTCPeerConnection({ iceServers: [ { urls: 'stun:stun.l.google.com:19302' } ] });
-  pc.onicecandidate = (ev) => { if (ev.candidate) send({ type: 'ice', to: targetId, candidate: ev.candidate }); };
+  pc.onicecandidate = (ev) => { if (ev.candidate) sendBatched({ type: 'ice', to: targetId, candidate: ev.candidate }); };
+  pc.onnegotiationneeded = async () => { const peer = state.peers.get(targetId); if (!peer || peer.pc !== pc) return; try { peer.makingOffer = true; await pc.setLocalDescription(); send({ type: 'offer', to: targetId, sdp: pc.localDescription.sdp }); } catch (e) { console.error('Offer failed:', e); } finally { peer.makingOffer = false; } };
+  pc.addEventListener('connectionstatechange', () => reportConnection(targetId, pc));
+  watchPolicy(pc);
   pc.ontrack = (ev) => {
     const [stream] = ev.streams;
     const peer = state.peers.get(targetId) || { name: 'Peer' };
@@ -306,101 +414,162 @@ function createPeerConnection(targetId) {
   return pc;
 }
 
+/* SFU mode: one connection to the server, which forwards everyone else's tracks.
+   The server re-offers as publishers come and go; its offers map transceiver mids to clientIds. */
+const SFU_PEER_ID = 'sfu';
+function connectSfu() {
+  closeSfu();
+  const pc = new RTCPeerConnection({ iceServers: [ { urls: 'stun:stun.l.google.com:19302' } ] });
+  const sfu = { pc, makingOffer: false, tracks: {}, streams: new Map() };
+  state.sfu = sfu;
+  if (state.localStream) addLocalTracksTo(pc); else { pc.addTransceiver('audio', { direction: 'recvonly' }); pc.addTransceiver('video', { direction: 'recvonly' }); }
+  pc.onicecandidate = (ev) => { if (ev.candidate) sendBatched({ type: 'ice', to: SFU_PEER_ID, candidate: ev.candidate }); };
+  watchPolicy(pc);
+  pc.onnegotiationneeded = async () => { try { sfu.makingOffer = true; await pc.setLocalDescription(); send({ type: 'offer', to: SFU_PEER_ID, sdp: pc.localDescription.sdp }); } catch (e) { console.error('SFU offer failed:', e); } finally { sfu.makingOffer = false; } };
+  pc.ontrack = (ev) => {
+    const owner = sfu.tracks[ev.transceiver.mid];
+    if (!owner) return;
+    let stream = sfu.streams.get(owner);
+    if (!stream) { stream = new MediaStream(); sfu.streams.set(owner, stream); }
+    stream.addTrack(ev.track);
+    const peer = state.peers.get(owner) || { name: 'Peer' };
+    peer.stream = stream;
+    state.peers.set(owner, peer);
+    addPeerTile(owner, peer.name || 'Peer', stream, false);
+    setupRemotePitch(owner, stream);
+  };
+}
+function closeSfu() { if (!state.sfu) return; try { state.sfu.pc.close(); } catch {} state.sfu = null; }
+/* We are the polite side: a server offer that collides with ours wins (setRemoteDescription rolls ours back) */
+async function handleSfuOffer(payload) { const sfu = state.sfu; if (!sfu) return; Object.assign(sfu.tracks, payload.tracks || {}); await sfu.pc.setRemoteDescription({ type: 'offer', sdp: payload.sdp }); await sfu.pc.setLocalDescription(); send({ type: 'answer', to: SFU_PEER_ID, sdp: sfu.pc.localDescription.sdp }); }
+function switchToSfu() { state.peers.forEach((p) => { try { p.pc && p.pc.close(); } catch {} p.pc = null; }); connectSfu(); }
+
+/* The server sends a media policy sized to the room (app/services/media.py); it is applied to every sender with
+   setParameters, which takes effect without renegotiation. Encodings exist only once a sender is negotiated,
+   so the policy is re-applied whenever a connection settles. */
+function applyMediaPolicy(policy) {
+  if (!policy) return;
+  const prev = state.mediaPolicy;
+  state.mediaPolicy = policy;
+  if (prev && prev.video !== policy.video && state.localStream && hasVideoTrack(state.localStream)) toast(policy.video ? 'Video resumed' : 'Room is large: sending audio only');
+  if (state.sfu) applyPolicyTo(state.sfu.pc);
+  else state.peers.forEach((p) => { if (p.pc) applyPolicyTo(p.pc); });
+}
+async function applyPolicyTo(pc) {
+  const policy = state.mediaPolicy;
+  if (!policy || pc.signalingState === 'closed') return;
+  for (const sender of pc.getSenders()) {
+    const track = sender.track;
+    if (!track) continue;
+    const params = sender.getParameters();
+    if (!params.encodings || !params.encodings.length) continue;
+    for (const enc of params.encodings) {
+      if (track.kind === 'audio') { enc.maxBitrate = policy.audioMaxBitrate; continue; }
+      enc.active = !!policy.video;
+      if (!policy.video) continue;
+      enc.maxBitrate = policy.maxBitrate;
+      enc.maxFramerate = policy.maxFramerate;
+      const height = track.getSettings().height || policy.maxHeight;
+      enc.scaleResolutionDownBy = Math.max(1, height / policy.maxHeight);
+    }
+    try { await sender.setParameters(params); } catch (e) { console.warn('Failed to apply media policy:', e); }
+  }
+}
+function watchPolicy(pc) { pc.addEventListener('signalingstatechange', () => { if (pc.signalingState === 'stable') applyPolicyTo(pc); }); }
+
 function addLocalTracksTo(pc){ if (!state.localStream) return; state.localStream.getTracks().forEach((t) => pc.addTrack(t, state.localStream)); }
-function replaceOrAddTrackOnPeers(){ if (!state.localStream) return; for (const [id, peer] of state.peers.entries()){ if (!peer.pc) continue; const senders = peer.pc.getSenders(); for (const track of state.localStream.getTracks()){ const sender = senders.find(s => s.track && s.track.kind === track.kind); if (sender) sender.replaceTrack(track); else peer.pc.addTrack(track, state.localStream); } } }
+function replaceOrAddTrackOnPeers(){ if (!state.localStream) return; if (state.sfu) { const senders = state.sfu.pc.getSenders(); for (const track of state.localStream.getTracks()) { const sender = senders.find(s => s.track && s.track.kind === track.kind); if (sender) sender.replaceTrack(track); else state.sfu.pc.addTrack(track, state.localStream); } return; } for (const [id, peer] of state.peers.entries()){ if (!peer.pc) continue; const senders = peer.pc.getSenders(); for (const track of state.localStream.getTracks()){ const sender = senders.find(s => s.track && s.track.kind === track.kind); if (sender) sender.replaceTrack(track); else peer.pc.addTrack(track, state.localStream); } } }
 
-function send(obj) { if (state.ws && state.ws.readyState === WebSocket.OPEN) state.ws.send(JSON.stringify(obj)); }
+// Messages passed to sendBatched within SIGNAL_BATCH_MS go out as one batch frame
+const SIGNAL_BATCH_MS = 10;
+function sendBatched(obj) { state.outbox.push(obj); if (!state.outboxTimer) state.outboxTimer = setTimeout(flushOutbox, SIGNAL_BATCH_MS); }
+function flushOutbox() { const messages = state.outbox; state.outbox = []; state.outboxTimer = null; if (messages.length === 1) send(messages[0]); else if (messages.length) send({ type: 'batch', messages }); }
+const RECONNECT_BASE_MS = 500, RECONNECT_MAX_MS = 5000, RECONNECT_MAX_ATTEMPTS = 8;
+function send(obj) { if (state.ws && state.ws.readyState === WebSocket.OPEN) state.ws.send(state.binary ? Wire.encode(obj, state.wireTable) : JSON.stringify(obj)); }
 
 function setMutedUI(clientId, muted) { const badge = document.getElementById(`badge-${clientId}`); if (!badge) return; if (muted) { badge.textContent = 'Muted'; badge.classList.add('muted'); badge.classList.remove('speaking'); } else { badge.textContent = ''; badge.classList.remove('muted'); } }
 function setSpeakingUI(clientId, speaking) { const ring = document.getElementById(`ring-${clientId}`); const badge = document.getElementById(`badge-${clientId}`); if (ring) ring.classList.toggle('active', speaking); if (badge && !badge.classList.contains('muted')) badge.classList.toggle('speaking', speaking); }
 
-function setupLocalVAD(stream){ 
-  try{ 
-    const ctx = new (window.AudioContext || window.webkitAudioContext)(); 
-    const src = ctx.createMediaStreamSource(stream); 
-    const analyser = ctx.createAnalyser(); 
-    analyser.fftSize = 512; 
-    src.connect(analyser); 
-    const data = new Uint8Array(analyser.frequencyBinCount); 
-    state.analyser = analyser; 
-    
-    // Track this audio context for background handling
+/* Pitch and VAD for every stream run in one shared AudioContext, on the audio thread: each stream feeds a
+   'voice-analyser' AudioWorklet node (public/pitch-worklet.js), and results come back in one batch per tick */
+const PITCH_WORKLET_URL = (document.querySelector('script[data-pitch-worklet]') || { dataset: {} }).dataset.pitchWorklet || '/static/pitch-worklet.js';
+function sharedAudioContext() {
+  if (!state.audioCtx) {
+    const ctx = new (window.AudioContext || window.webkitAudioContext)();
+    state.audioCtx = ctx;
+    // Track the context for background handling
     state.audioContexts.add(ctx);
-    
-    if (state.vadInterval) clearInterval(state.vadInterval); 
-    state.vadInterval = setInterval(()=>{ 
-      analyser.getByteFrequencyData(data); 
-      let sum = 0; for (let i=0;i<data.length;i++) sum += data[i]; 
-      const avg = sum / data.length; 
-      setSpeakingUI('local', avg > 25 && !state.muted); 
-      
-      // Keep audio context active even in background
-      if (ctx.state === 'suspended') {
-        ctx.resume().catch(e => console.warn('Failed to resume audio context:', e));
-      }
-    }, 120); 
-    
-    // Ensure audio context is running
-    if (ctx.state === 'suspended') {
-      ctx.resume().catch(e => console.warn('Failed to resume audio context:', e));
-    }
-  }catch(e){ console.warn('VAD unavailable', e); } 
-}
-
-function estimatePitchFromStream(stream, callback){
-  try{
-    const audioCtx = new (window.AudioContext || window.webkitAudioContext)();
-    const source = audioCtx.createMediaStreamSource(stream);
-    const analyser = audioCtx.createAnalyser();
-    analyser.fftSize = 2048;
-    source.connect(analyser);
-    const buffer = new Float32Array(analyser.fftSize);
-    const sampleRate = audioCtx.sampleRate;
-    
-    // Track this audio context for background handling
-    state.audioContexts.add(audioCtx);
-    
-    function autoCorrelate(buf, sr){
-      let SIZE = buf.length;
-      let rms = 0; for (let i=0;i<SIZE;i++){ let v = buf[i]; rms += v*v; }
-      rms = Math.sqrt(rms / SIZE);
-      if (rms < 0.01) return -1;
-      let r1=0, r2=SIZE-1, thres=0.2;
-      for (let i=0;i<SIZE/2;i++){ if (Math.abs(buf[i])<thres){ r1=i; break; } }
-      for (let i=1;i<SIZE/2;i++){ if (Math.abs(buf[SIZE-i])<thres){ r2=SIZE-i; break; } }
-      buf = buf.slice(r1, r2); SIZE = buf.length;
-      const c = new Array(SIZE).fill(0);
-      for (let tau=0; tau<SIZE; tau++){
-        for (let i=0;i<SIZE-tau;i++) c[tau] += buf[i]*buf[i+tau];
-      }
-      let d=0; while (c[d]>c[d+1]) d++;
-      let maxval=-1, maxpos=-1; for (let i=d; i<SIZE; i++){ if (c[i] > maxval){ maxval=c[i]; maxpos=i; } }
-      let T = maxpos; if (T===0) return -1; return sr/T;
-    }
-    function tick(){ 
-      analyser.getFloatTimeDomainData(buffer); 
-      const hz = autoCorrelate(buffer, sampleRate); 
-      callback(hz>80 && hz<500 ? hz : -1); 
-      
-      // Keep audio context active in background
-      if (audioCtx.state === 'suspended') {
-        audioCtx.resume().catch(e => console.warn('Failed to resume pitch audio context:', e));
-      }
-    }
-    
-    // Ensure audio context is running
-    if (audioCtx.state === 'suspended') {
-      audioCtx.resume().catch(e => console.warn('Failed to resume pitch audio context:', e));
-    }
-    return setInterval(tick, 300);
-  }catch(e){ console.warn('Pitch detection unavailable', e); return null; }
+    state.workletReady = ctx.audioWorklet ? ctx.audioWorklet.addModule(PITCH_WORKLET_URL) : Promise.reject(new Error('AudioWorklet not supported'));
+  }
+  if (state.audioCtx.state === 'suspended') state.audioCtx.resume().catch(e => console.warn('Failed to resume audio context:', e));
+  return state.audioCtx;
+}
+
+async function analyseStream(id, stream, onResult) {
+  if (!stream || !stream.getAudioTracks().length) return; // ontrack fires again when the audio track arrives
+  const existing = state.analysers.get(id);
+  if (existing && existing.stream === stream) return;
+  stopAnalysis(id);
+  const entry = { stream, onResult, source: null, node: null };
+  state.analysers.set(id, entry);
+  try {
+    const ctx = sharedAudioContext();
+    await state.workletReady;
+    if (state.analysers.get(id) !== entry) return; // stopped or replaced while the module loaded
+    entry.source = ctx.createMediaStreamSource(stream);
+    entry.node = new AudioWorkletNode(ctx, 'voice-analyser', { numberOfInputs: 1, numberOfOutputs: 1, outputChannelCount: [1], processorOptions: { id } });
+    entry.node.port.onmessage = (ev) => handleAnalysis(ev.data);
+    entry.source.connect(entry.node);
+    // The node only outputs silence; connecting it keeps the graph pulling it
+    entry.node.connect(ctx.destination);
+  } catch (e) { console.warn('Pitch/VAD analysis unavailable', e); }
 }
 
-function setupLocalPitch(stream){ if (state.pitchInterval) clearInterval(state.pitchInterval); state.pitchInterval = estimatePitchFromStream(stream, (hz)=>{ setPitchUI('local', hz); if (hz && hz>0) send({ type: 'pitch', hz }); }); }
-function setupRemotePitch(clientId, stream){ estimatePitchFromStream(stream, (hz)=> setPitchUI(clientId, hz)); }
+function stopAnalysis(id) {
+  const entry = state.analysers.get(id);
+  if (!entry) return;
+  state.analysers.delete(id);
+  if (entry.node) { entry.node.port.postMessage('stop'); try { entry.source.disconnect(); entry.node.disconnect(); } catch {} }
+}
+
+function handleAnalysis(batch) { for (const [id, hz, speaking] of batch) { const entry = state.analysers.get(id); if (entry) entry.onResult(hz, speaking); } }
+
+function setupLocalAnalysis(stream) {
+  analyseStream('local', stream, (hz, vad) => {
+    const speaking = vad && !state.muted;
+    setSpeakingUI('local', speaking);
+    // Only report changes; the server folds them into the room telemetry tick
+    if (speaking !== state.lastSpeaking) { state.lastSpeaking = speaking; send({ type: 'vad', speaking }); }
+    setPitchUI('local', hz);
+    const rounded = hz > 0 ? Math.round(hz) : 0;
+    reportPitch(rounded);
+  });
+}
+/* The server folds pitch into the room tick at telemetryHz, so at most one report goes out per tick,
+   carrying the latest value; estimates arrive faster than the pitch rate limit allows */
+function reportPitch(hz) {
+  state.pendingPitch = hz;
+  if (state.pitchTimer) return;
+  const wait = state.lastPitchSentAt + 1000 / state.telemetryHz - performance.now();
+  if (wait <= 0) flushPitch(); else state.pitchTimer = setTimeout(flushPitch, wait);
+}
+function flushPitch() {
+  state.pitchTimer = null;
+  const hz = state.pendingPitch;
+  state.pendingPitch = null;
+  if (hz === null || hz === state.lastPitch) return;
+  state.lastPitch = hz;
+  state.lastPitchSentAt = performance.now();
+  send({ type: 'pitch', hz });
+}
+function handleTelemetry(payload){ for (const [clientId, hz, speaking] of payload.peers || []) { if (clientId === state.clientId) continue; setPitchUI(clientId, hz); setSpeakingUI(clientId, !!speaking); } }
+function setupRemotePitch(clientId, stream){ analyseStream(clientId, stream, (hz) => setPitchUI(clientId, hz)); }
 
 async function handleJoined(payload) {
   state.clientId = payload.clientId;
+  state.oldestChatSeq = null;
+  state.newestChatSeq = 0;
+  renderHistory(payload.history, payload.hasMoreHistory, true);
   
   // Save state with clientId when successfully joined
   if (state.roomId && state.name) {
@@ -408,32 +577,63 @@ async function handleJoined(payload) {
   }
   
   // Show participants section and update the list
+  state.rosterVersion = payload.rosterVersion || 0;
+  state.rosterSyncPending = false;
   showParticipantsSection();
   updateParticipantsList(payload.peers);
   
   try {
-    if (state.localStream) {
-      const stream = state.localStream; renderPeersList(payload.peers);
-      for (const p of payload.peers) { const pc = createPeerConnection(p.clientId); addLocalTracksTo(pc); state.peers.set(p.clientId, { pc, name: p.name }); const offer = await pc.createOffer(); await pc.setLocalDescription(offer); send({ type: 'offer', to: p.clientId, sdp: offer.sdp }); }
-    } else {
+    if (payload.media === 'sfu') {
       renderPeersList(payload.peers);
-      for (const p of payload.peers) { const pc = createPeerConnection(p.clientId); state.peers.set(p.clientId, { pc, name: p.name }); const offer = await pc.createOffer(); await pc.setLocalDescription(offer); send({ type: 'offer', to: p.clientId, sdp: offer.sdp }); }
-      el('enableMicBtn').disabled = false; showAlert('You joined with text chat only. Click <b>Enable Mic</b> to join voice chat when ready.');
+      for (const p of payload.peers) state.peers.set(p.clientId, { name: p.name });
+      connectSfu();
+      if (!state.localStream) el('enableMicBtn').disabled = false;
+      return;
     }
+    renderPeersList(payload.peers);
+    // All connections start at once; each offers as soon as its negotiationneeded fires. Peers we answer
+    // get their connection when their offer arrives.
+    for (const p of payload.peers) { const peer = rememberPeer(p, state.joinStartedAt); if (peer.roles.offerer) openPeer(p.clientId); }
+    if (!state.localStream) { el('enableMicBtn').disabled = false; showAlert('You joined with text chat only. Click <b>Enable Mic</b> to join voice chat when ready.'); }
   } catch (e) { appendMessage('Permission denied. You joined without mic. Click Enable Mic to retry.'); el('enableMicBtn').disabled = false; showAlert('Microphone/camera access failed. Please allow access for this site in the browser and Windows settings.'); }
 }
 
-async function handleOffer(payload) { const from = payload.from; const pc = createPeerConnection(from); if (state.localStream) addLocalTracksTo(pc); state.peers.set(from, { pc, name: (state.peers.get(from)?.name) || 'Peer' }); await pc.setRemoteDescription({ type: 'offer', sdp: payload.sdp }); const answer = await pc.createAnswer(); await pc.setLocalDescription(answer); send({ type: 'answer', to: from, sdp: answer.sdp }); }
-async function handleAnswer(payload) { const from = payload.from; const peer = state.peers.get(from); if (!peer?.pc) return; await peer.pc.setRemoteDescription({ type: 'answer', sdp: payload.sdp }); }
-async function handleIce(payload) { const from = payload.from; const peer = state.peers.get(from); if (!peer?.pc) return; try { await peer.pc.addIceCandidate(payload.candidate); } catch (e) { console.error('Failed to add ICE', e); } }
+async function handleOffer(payload) { if (payload.from === SFU_PEER_ID) return handleSfuOffer(payload); if (state.sfu) return; openPeer(payload.from); return handleDescription(payload); }
+async function handleAnswer(payload) { if (payload.from === SFU_PEER_ID) { if (state.sfu) await state.sfu.pc.setRemoteDescription({ type: 'answer', sdp: payload.sdp }); return; } return handleDescription(payload); }
+async function handleDescription(payload) {
+  const from = payload.from; const peer = state.peers.get(from); if (!peer?.pc) return; const pc = peer.pc;
+  const isOffer = payload.type === 'offer';
+  // Glare: an offer while we are making (or hold) our own
+  const readyForOffer = !peer.makingOffer && (pc.signalingState === 'stable' || peer.settingAnswer);
+  peer.ignoreOffer = isOffer && !readyForOffer && !peer.roles.polite;
+  if (peer.ignoreOffer) return;
+  try {
+    peer.settingAnswer = !isOffer;
+    // A polite peer's pending offer is rolled back implicitly
+    await pc.setRemoteDescription({ type: payload.type, sdp: payload.sdp });
+    peer.settingAnswer = false;
+    if (isOffer) { await pc.setLocalDescription(); send({ type: 'answer', to: from, sdp: pc.localDescription.sdp }); }
+  } catch (e) { peer.settingAnswer = false; console.error(`Failed to apply ${payload.type}:`, e); }
+}
+async function handleIce(payload) { const from = payload.from; const peer = state.peers.get(from); if (!peer?.pc) return; const candidates = payload.candidates || [payload.candidate]; for (const candidate of candidates) { try { await peer.pc.addIceCandidate(candidate); } catch (e) { if (!peer.ignoreOffer) console.error('Failed to add ICE', e); } } }
+
+function handleMessage(msg) { switch (msg.type) { case 'joined': state.reconnectAttempts = 0; state.joinSeq = msg.joinSeq || 0; state.telemetryHz = msg.telemetryHz || state.telemetryHz; if (msg.resumed) { state.resumeToken = msg.resumeToken; applyRosterSnapshot(msg.peers || [], msg.rosterVersion || 0); toast('Reconnected'); } else { if (state.resumeToken) teardownPeers(); /* session expired: start over */ state.resumeToken = msg.resumeToken; handleJoined(msg); } applyMediaPolicy(msg.mediaPolicy); startHeartbeat(msg.heartbeat); el('muteBtn').disabled = false; el('leaveBtn').disabled = false; break; case 'peer-joined': if (!acceptRosterDelta(msg)) break; toast(`${msg.name} joined the room`); { const peer = rememberPeer(msg, performance.now()); if (!state.sfu && peer.roles.offerer) openPeer(msg.clientId); } addParticipant(msg.clientId, msg.name); break; case 'peer-left': if (!acceptRosterDelta(msg)) break; toast(`${msg.name || msg.clientId} left the room`); removePeer(msg.clientId); break; case 'roster': handleRoster(msg); break; case 'chat': if (!acceptChat(msg)) break; messages.appendChild(chatMessageElement(msg)); messages.scrollTop = messages.scrollHeight; break; case 'history': renderHistory(msg.messages, msg.hasMore, false); break; case 'offer': handleOffer(msg); break; case 'answer': handleAnswer(msg); break; case 'ice': handleIce(msg); break; case 'mute': setMutedUI(msg.clientId, !!msg.muted); break; case 'media-state': { const target = state.peers.get(msg.clientId); if (target && target.stream) addPeerTile(msg.clientId, target.name || 'Peer', target.stream, false); break; } case 'telemetry': handleTelemetry(msg); break; case 'media-mode': if (msg.mode === 'sfu' && !state.sfu) switchToSfu(); break; case 'media-policy': applyMediaPolicy(msg); break; case 'batch': (msg.messages || []).forEach(handleMessage); break; case 'ping': send({ type: 'pong' }); break; case 'pong': break; case 'error': appendMessage(`Error: ${msg.message || msg.error}`); if (msg.error === 'room-full' || msg.error === 'server-full' || msg.error === 'revoked') state.resumeToken = null; /* refused: the server closes the socket, don't retry */ break; } }
 
 function connect(roomId, name) { 
   // Request notification permission when joining
   requestNotificationPermission();
   
-  state.ws = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws`); 
-  state.ws.onopen = () => { send({ type: 'join', roomId, name, token: localStorage.getItem('whop_token') || '' }); }; 
-  state.ws.onmessage = (ev) => { const msg = JSON.parse(ev.data); switch (msg.type) { case 'joined': handleJoined(msg); el('muteBtn').disabled = false; el('leaveBtn').disabled = false; break; case 'peer-joined': toast(`${msg.name} joined the room`); state.peers.set(msg.clientId, { name: msg.name }); updateParticipantsListFromPeers(); break; case 'peer-left': toast(`${msg.name || msg.clientId} left the room`); removePeerTile(msg.clientId); state.peers.delete(msg.clientId); updateParticipantsListFromPeers(); break; case 'chat': { const isMe = msg.fromClientId && msg.fromClientId === state.clientId; appendMessage(`${isMe ? 'You' : msg.fromName}: ${msg.message}`, !!isMe); break; } case 'offer': handleOffer(msg); break; case 'answer': handleAnswer(msg); break; case 'ice': handleIce(msg); break; case 'mute': setMutedUI(msg.clientId, !!msg.muted); break; case 'media-state': { const target = state.peers.get(msg.clientId); if (target && target.stream) addPeerTile(msg.clientId, target.name || 'Peer', target.stream, false); break; } case 'pitch': setPitchUI(msg.clientId, msg.hz); break; case 'error': appendMessage(`Error: ${msg.error}`); break; } }; state.ws.onclose = () => { el('muteBtn').disabled = true; el('leaveBtn').disabled = true; el('enableMicBtn').disabled = true; hideParticipantsSection(); if (state.pitchInterval) clearInterval(state.pitchInterval); if (state.vadInterval) clearInterval(state.vadInterval); }; }
+  state.ws = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.host}/ws`, Wire.PROTOCOLS); 
+  state.ws.binaryType = 'arraybuffer';
+  state.ws.onopen = () => { state.lastServerFrame = Date.now(); state.binary = state.ws.protocol === Wire.BINARY; state.joinStartedAt = performance.now(); send({ type: 'join', roomId, name, token: localStorage.getItem('whop_token') || '', resumeToken: state.resumeToken || undefined }); }; 
+  state.ws.onmessage = (ev) => { state.lastServerFrame = Date.now(); handleMessage(typeof ev.data === 'string' ? JSON.parse(ev.data) : Wire.decode(ev.data, state.wireTable)); }; state.ws.onclose = () => { stopHeartbeat(); if (!state.leaving && state.resumeToken && state.reconnectAttempts < RECONNECT_MAX_ATTEMPTS) { scheduleReconnect(roomId, name); return; } state.resumeToken = null; el('muteBtn').disabled = true; el('leaveBtn').disabled = true; el('enableMicBtn').disabled = true; hideParticipantsSection(); stopAnalysis('local'); }; }
+
+/* A dropped socket reconnects with the resume token; the server keeps our session (and peers keep their connections) for a grace period */
+function scheduleReconnect(roomId, name) { const delay = Math.min(RECONNECT_MAX_MS, RECONNECT_BASE_MS * 2 ** state.reconnectAttempts); state.reconnectAttempts++; if (state.reconnectAttempts === 1) toast('Connection lost, reconnecting...'); state.reconnectTimer = setTimeout(() => { state.reconnectTimer = null; if (!state.leaving) connect(roomId, name); }, delay); }
+/* Any frame from the server proves the connection is alive; ping when it goes quiet and drop it (and resume) once it has been silent past the server's timeout */
+function startHeartbeat(config) { stopHeartbeat(); if (!config || !config.interval || !config.timeout) return; const ws = state.ws; state.heartbeatTimer = setInterval(() => { if (state.ws !== ws) { stopHeartbeat(); return; } const idle = Date.now() - state.lastServerFrame; if (idle >= config.timeout * 1000) { /* a half-open socket may never fire onclose by itself */ const onclose = ws.onclose; ws.onclose = null; try { ws.close(); } catch {} if (onclose) onclose(); } else if (idle >= config.interval * 1000) send({ type: 'ping' }); }, config.interval * 500); }
+function stopHeartbeat() { if (state.heartbeatTimer) { clearInterval(state.heartbeatTimer); state.heartbeatTimer = null; } }
+function teardownPeers() { closeSfu(); state.peers.forEach((p, id) => { try { p.pc && p.pc.close(); } catch {} removePeerTile(id); }); state.peers.clear(); }
 
 function setupUI() {
   const modal = alertModal(); if (modal) document.getElementById('alertClose').onclick = hideAlert;
@@ -447,13 +647,16 @@ function setupUI() {
     console.log('Restored previous room state:', restoredState);
   }
   
-  el('joinBtn').onclick = async () => { const room = el('room').value.trim(); const name = el('name').value.trim() || 'Guest'; if (!room) return; state.roomId = room; state.name = name; saveRoomState(room, name, null); // Save state immediately if (!state.localStream) { state.localStream = await getMediaWithFallback(); if (state.localStream) { addPeerTile('local', name || 'Me', state.localStream, true); setupLocalVAD(state.localStream); setupLocalPitch(state.localStream); } else { console.log('No audio/video access available, joining with text chat only'); showAlert('No audio/video access available. You can still participate in text chat. Click <b>Enable Mic</b> later if you want to join voice chat.'); } } connect(room, name); };
-  el('enableMicBtn').onclick = async () => { try { state.localStream = await getMediaWithFallback(); if (state.localStream) { addPeerTile('local', state.name || 'Me', state.localStream, true); setupLocalVAD(state.localStream); setupLocalPitch(state.localStream); replaceOrAddTrackOnPeers(); send({ type: 'media-state', hasAudio: hasAudioTrack(state.localStream), hasVideo: hasVideoTrack(state.localStream) }); el('enableMicBtn').disabled = true; hideAlert(); } else { showAlert('Still no access to mic/camera. Check Windows privacy settings and browser site permissions.'); } } catch (e) { showAlert('Still no access to mic/camera. Check Windows privacy settings and browser site permissions.'); } };
+  el('joinBtn').onclick = async () => { const room = el('room').value.trim(); const name = el('name').value.trim() || 'Guest'; if (!room) return; state.roomId = room; state.name = name; state.leaving = false; state.reconnectAttempts = 0; saveRoomState(room, name, null); /* Save state immediately */ if (!state.localStream) { state.localStream = await getMediaWithFallback(); if (state.localStream) { addPeerTile('local', name || 'Me', state.localStream, true); setupLocalAnalysis(state.localStream); } else { console.log('No audio/video access available, joining with text chat only'); showAlert('No audio/video access available. You can still participate in text chat. Click <b>Enable Mic</b> later if you want to join voice chat.'); } } connect(room, name); };
+  el('enableMicBtn').onclick = async () => { try { state.localStream = await getMediaWithFallback(); if (state.localStream) { addPeerTile('local', state.name || 'Me', state.localStream, true); setupLocalAnalysis(state.localStream); replaceOrAddTrackOnPeers(); send({ type: 'media-state', hasAudio: hasAudioTrack(state.localStream), hasVideo: hasVideoTrack(state.localStream) }); el('enableMicBtn').disabled = true; hideAlert(); } else { showAlert('Still no access to mic/camera. Check Windows privacy settings and browser site permissions.'); } } catch (e) { showAlert('Still no access to mic/camera. Check Windows privacy settings and browser site permissions.'); } };
+  /* Closing the tab is a real leave, not a dropped connection to be resumed */
+  window.addEventListener('pagehide', () => { state.leaving = true; send({ type: 'leave' }); });
+  messages.addEventListener('scroll', () => { if (messages.scrollTop === 0) requestOlderHistory(); });
   const sendCurrentMessage = () => { const val = el('msgInput').value.trim(); if (!val) return; send({ type: 'chat', message: val }); el('msgInput').value = ''; };
   el('sendBtn').onclick = () => { sendCurrentMessage(); };
   el('msgInput').addEventListener('keydown', (e) => { if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); sendCurrentMessage(); } });
   el('muteBtn').onclick = () => { state.muted = !state.muted; if (state.localStream) state.localStream.getAudioTracks().forEach(t => t.enabled = !state.muted); el('muteBtn').textContent = state.muted ? 'Unmute' : 'Mute'; if (state.localStream) send({ type: 'mute', muted: state.muted }); };
-  el('leaveBtn').onclick = () => { send({ type: 'leave' }); try { state.ws && state.ws.close(); } catch {} state.peers.forEach((p, id) => { try { p.pc && p.pc.close(); } catch {} removePeerTile(id); }); state.peers.clear(); hideAlert(); hideParticipantsSection(); clearRoomState(); // Clear saved state when leaving if (state.pitchInterval) clearInterval(state.pitchInterval); if (state.vadInterval) clearInterval(state.vadInterval); };
+  el('leaveBtn').onclick = () => { state.leaving = true; state.resumeToken = null; if (state.reconnectTimer) { clearTimeout(state.reconnectTimer); state.reconnectTimer = null; } send({ type: 'leave' }); try { state.ws && state.ws.close(); } catch {} teardownPeers(); hideAlert(); hideParticipantsSection(); clearRoomState(); /* Clear saved state when leaving */ stopAnalysis('local'); };
 }
 
 window.addEventListener('load', setupUI);
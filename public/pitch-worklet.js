@@ -0,0 +1,139 @@
+/* Pitch and voice-activity analysis on the audio rendering thread.
+   One 'voice-analyser' node runs per stream, all in the page's single AudioContext.
+   Audio is decimated to ~12 kHz, and pitch is estimated with YIN over preallocated
+   typed arrays; VAD is smoothed RMS energy with a hangover. The processors share
+   this global scope: each writes its latest result to `results`, and one of them
+   (the leader) posts the whole batch to the main thread every POST_INTERVAL. */
+
+const TARGET_RATE = 12000;          // pitch (80-500 Hz) needs far less than 48 kHz
+const MIN_HZ = 80, MAX_HZ = 500;
+const WINDOW_SECONDS = 0.04;        // YIN integration window
+const YIN_THRESHOLD = 0.15;
+const SILENCE_RMS = 0.01;           // below this there is no pitch to find
+const PITCH_INTERVAL = 0.15;        // seconds between pitch estimates per stream
+const POST_INTERVAL = 0.15;         // seconds between batches posted to the main thread
+const VAD_ON_RMS = 0.02, VAD_OFF_RMS = 0.012;   // hysteresis on smoothed energy
+const VAD_SMOOTHING = 0.9;
+const VAD_HANGOVER = 0.3;           // seconds speech is held after energy drops
+
+// id -> [hz, speaking]; shared by every processor in this AudioContext
+const results = new Map();
+const processors = new Set();
+let leader = null;
+let nextPost = 0;
+
+class VoiceAnalyser extends AudioWorkletProcessor {
+  constructor(options) {
+    super();
+    this.id = options.processorOptions.id;
+    this.alive = true;
+    this.decimation = Math.max(1, Math.floor(sampleRate / TARGET_RATE));
+    const rate = sampleRate / this.decimation;
+    this.rate = rate;
+    this.window = Math.ceil(rate * WINDOW_SECONDS);
+    this.minLag = Math.floor(rate / MAX_HZ);
+    this.maxLag = Math.ceil(rate / MIN_HZ);
+    const size = this.window + this.maxLag + 1;
+    // Ring buffer of decimated samples, unrolled into `frame` for each estimate
+    this.ring = new Float32Array(size);
+    this.frame = new Float32Array(size);
+    this.diff = new Float32Array(this.maxLag + 2);
+    this.pos = 0;
+    this.filled = 0;
+    this.acc = 0;
+    this.accCount = 0;
+    this.nextPitch = 0;
+    this.hz = -1;
+    this.level = 0;
+    this.speaking = false;
+    this.lastVoice = -1;
+    processors.add(this);
+    if (!leader) leader = this;
+    this.port.onmessage = (ev) => { if (ev.data === 'stop') this.stop(); };
+  }
+
+  stop() {
+    this.alive = false;
+    processors.delete(this);
+    results.delete(this.id);
+    if (leader === this) leader = processors.values().next().value || null;
+  }
+
+  process(inputs) {
+    if (!this.alive) return false;
+    const channel = inputs[0] && inputs[0][0];
+    if (channel) this.consume(channel);
+    if (currentTime >= this.nextPitch) {
+      this.nextPitch = currentTime + PITCH_INTERVAL;
+      this.hz = this.filled >= this.ring.length ? this.estimate() : -1;
+    }
+    results.set(this.id, [this.hz, this.speaking]);
+    if (leader === this && currentTime >= nextPost) {
+      nextPost = currentTime + POST_INTERVAL;
+      const batch = [];
+      for (const [id, [hz, speaking]] of results) batch.push([id, hz, speaking]);
+      this.port.postMessage(batch);
+    }
+    return true;
+  }
+
+  consume(channel) {
+    let energy = 0;
+    const d = this.decimation, ring = this.ring, size = ring.length;
+    for (let i = 0; i < channel.length; i++) {
+      const v = channel[i];
+      energy += v * v;
+      // Averaging decimator; crude, but pitch only needs the low band
+      this.acc += v;
+      if (++this.accCount === d) {
+        ring[this.pos] = this.acc / d;
+        this.pos = (this.pos + 1) % size;
+        if (this.filled < size) this.filled++;
+        this.acc = 0;
+        this.accCount = 0;
+      }
+    }
+    const rms = Math.sqrt(energy / channel.length);
+    this.level = VAD_SMOOTHING * this.level + (1 - VAD_SMOOTHING) * rms;
+    if (this.level >= VAD_ON_RMS) { this.speaking = true; this.lastVoice = currentTime; }
+    else if (this.speaking && this.level < VAD_OFF_RMS && currentTime - this.lastVoice > VAD_HANGOVER) this.speaking = false;
+  }
+
+  estimate() {
+    const ring = this.ring, frame = this.frame, size = ring.length, diff = this.diff, W = this.window;
+    // Oldest sample first
+    for (let i = 0, j = this.pos; i < size; i++, j = (j + 1) % size) frame[i] = ring[j];
+    let energy = 0;
+    for (let i = 0; i < W; i++) energy += frame[i] * frame[i];
+    if (Math.sqrt(energy / W) < SILENCE_RMS) return -1;
+
+    // YIN: difference function, cumulative mean normalisation, absolute threshold
+    let running = 0;
+    diff[0] = 1;
+    for (let tau = 1; tau <= this.maxLag; tau++) {
+      let sum = 0;
+      for (let i = 0; i < W; i++) { const delta = frame[i] - frame[i + tau]; sum += delta * delta; }
+      running += sum;
+      diff[tau] = running > 0 ? sum * tau / running : 1;
+    }
+    let tau = this.minLag;
+    for (; tau <= this.maxLag; tau++) {
+      if (diff[tau] < YIN_THRESHOLD) {
+        while (tau + 1 <= this.maxLag && diff[tau + 1] < diff[tau]) tau++;
+        break;
+      }
+    }
+    if (tau > this.maxLag) return -1;
+    // Parabolic interpolation around the minimum
+    let lag = tau;
+    if (tau > 1 && tau < this.maxLag) {
+      const a = diff[tau - 1], b = diff[tau], c = diff[tau + 1];
+      const denom = a + c - 2 * b;
+      if (denom !== 0) lag = tau + (a - c) / (2 * denom);
+    }
+    const hz = this.rate / lag;
+    return hz >= MIN_HZ && hz <= MAX_HZ ? hz : -1;
+  }
+}
+
+registerProcessor('voice-analyser', VoiceAnalyser);
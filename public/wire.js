@@ -0,0 +1,132 @@
+// Client codec for the vc.bin.1 signaling subprotocol (see app/services/wire.py).
+// Frames start with a one-byte tag; peers are addressed by the small per-room
+// handle from joined/peer-joined. Decoded messages have the same shape as the
+// JSON protocol, so the rest of app.js does not care which one is in use.
+const Wire = (() => {
+  const BINARY = 'vc.bin.1';
+  const JSON_PROTOCOL = 'vc.json.1';
+  const PROTOCOLS = [BINARY, JSON_PROTOCOL];
+
+  const TAG = { JSON: 0, OFFER: 1, ANSWER: 2, ICE: 3, CHAT: 4, MUTE: 5, MEDIA_STATE: 6, TELEMETRY: 7, PEER_LEFT: 8, PITCH: 9, VAD: 10, BATCH: 11 };
+  const FLAG_AUDIO = 1, FLAG_VIDEO = 2;
+  const encoder = new TextEncoder();
+  const decoder = new TextDecoder();
+
+  // handle <-> clientId for the current room
+  function createPeerTable() {
+    const byHandle = new Map();
+    const byClientId = new Map();
+    return {
+      set(handle, clientId, name) { if (!handle) return; byHandle.set(handle, { clientId, name }); byClientId.set(clientId, handle); },
+      remove(handle) { const p = byHandle.get(handle); if (p) byClientId.delete(p.clientId); byHandle.delete(handle); },
+      get(handle) { return byHandle.get(handle); },
+      handleOf(clientId) { return byClientId.get(clientId) || 0; },
+      clear() { byHandle.clear(); byClientId.clear(); },
+    };
+  }
+
+  function frame(tag, headerBytes, body) {
+    const bodyBytes = body === undefined ? new Uint8Array(0) : body;
+    const buf = new Uint8Array(1 + headerBytes + bodyBytes.length);
+    buf[0] = tag;
+    buf.set(bodyBytes, 1 + headerBytes);
+    return buf;
+  }
+
+  function withPeer(tag, peer, body) {
+    const buf = frame(tag, 2, body);
+    new DataView(buf.buffer).setUint16(1, peer);
+    return buf;
+  }
+
+  // Client -> server
+  function encode(msg, table) {
+    /* Signaling to a peer without a handle (the SFU) goes as JSON */
+    if ((msg.type === 'offer' || msg.type === 'answer' || msg.type === 'ice') && !table.handleOf(msg.to)) return frame(TAG.JSON, 0, encoder.encode(JSON.stringify(msg)));
+    switch (msg.type) {
+      case 'offer': return withPeer(TAG.OFFER, table.handleOf(msg.to), encoder.encode(msg.sdp || ''));
+      case 'answer': return withPeer(TAG.ANSWER, table.handleOf(msg.to), encoder.encode(msg.sdp || ''));
+      case 'ice': return withPeer(TAG.ICE, table.handleOf(msg.to), encoder.encode(JSON.stringify(msg.candidate)));
+      case 'chat': return frame(TAG.CHAT, 0, encoder.encode(msg.message || ''));
+      case 'mute': return Uint8Array.of(TAG.MUTE, msg.muted ? 1 : 0);
+      case 'media-state': return Uint8Array.of(TAG.MEDIA_STATE, (msg.hasAudio ? FLAG_AUDIO : 0) | (msg.hasVideo ? FLAG_VIDEO : 0));
+      case 'pitch': { const buf = frame(TAG.PITCH, 2); new DataView(buf.buffer).setUint16(1, Math.max(0, Math.min(0xffff, Math.round(msg.hz || 0)))); return buf; }
+      case 'vad': return Uint8Array.of(TAG.VAD, msg.speaking ? 1 : 0);
+      case 'batch': {
+        // tag, then repeated (u16 length, frame)
+        const frames = (msg.messages || []).map((m) => encode(m, table));
+        const buf = new Uint8Array(1 + frames.reduce((n, f) => n + 2 + f.length, 0));
+        const view = new DataView(buf.buffer);
+        buf[0] = TAG.BATCH;
+        let off = 1;
+        for (const f of frames) { view.setUint16(off, f.length); buf.set(f, off + 2); off += 2 + f.length; }
+        return buf;
+      }
+      default: return frame(TAG.JSON, 0, encoder.encode(JSON.stringify(msg)));
+    }
+  }
+
+  function peerId(table, handle) { const p = table.get(handle); return p ? p.clientId : String(handle); }
+
+  // Server -> client
+  function decode(buffer, table) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    const tag = view.getUint8(0);
+    switch (tag) {
+      case TAG.JSON: {
+        const msg = JSON.parse(decoder.decode(bytes.subarray(1)));
+        if (msg.type === 'joined') {
+          table.clear();
+          table.set(msg.handle, msg.clientId, null);
+          (msg.peers || []).forEach((p) => table.set(p.handle, p.clientId, p.name));
+        } else if (msg.type === 'roster') {
+          (msg.peers || []).forEach((p) => table.set(p.handle, p.clientId, p.name));
+          (msg.deltas || []).forEach((d) => { if (d.type === 'peer-joined') table.set(d.handle, d.clientId, d.name); });
+        } else if (msg.type === 'peer-joined') {
+          table.set(msg.handle, msg.clientId, msg.name);
+        }
+        return msg;
+      }
+      case TAG.OFFER:
+      case TAG.ANSWER:
+        return { type: tag === TAG.OFFER ? 'offer' : 'answer', from: peerId(table, view.getUint16(1)), sdp: decoder.decode(bytes.subarray(3)) };
+      case TAG.ICE: {
+        // The server bundles candidates for the same pair into an array
+        const body = JSON.parse(decoder.decode(bytes.subarray(3)));
+        const from = peerId(table, view.getUint16(1));
+        return Array.isArray(body) ? { type: 'ice', from, candidates: body } : { type: 'ice', from, candidate: body };
+      }
+      case TAG.CHAT: {
+        const nameLen = view.getUint16(7);
+        const msg = { type: 'chat', fromClientId: peerId(table, view.getUint16(1)), fromName: decoder.decode(bytes.subarray(9, 9 + nameLen)), message: decoder.decode(bytes.subarray(9 + nameLen)) };
+        const seq = view.getUint32(3);
+        if (seq) msg.seq = seq;
+        return msg;
+      }
+      case TAG.MUTE:
+        return { type: 'mute', clientId: peerId(table, view.getUint16(1)), muted: !!view.getUint8(3) };
+      case TAG.MEDIA_STATE: {
+        const flags = view.getUint8(3);
+        return { type: 'media-state', clientId: peerId(table, view.getUint16(1)), hasAudio: !!(flags & FLAG_AUDIO), hasVideo: !!(flags & FLAG_VIDEO) };
+      }
+      case TAG.TELEMETRY: {
+        const count = view.getUint16(1);
+        const peers = new Array(count);
+        for (let i = 0, off = 3; i < count; i++, off += 5) peers[i] = [peerId(table, view.getUint16(off)), view.getUint16(off + 2), view.getUint8(off + 4)];
+        return { type: 'telemetry', peers };
+      }
+      case TAG.PEER_LEFT: {
+        const handle = view.getUint16(1);
+        const peer = table.get(handle);
+        table.remove(handle);
+        const rosterVersion = bytes.length >= 7 ? view.getUint32(3) : undefined;
+        return { type: 'peer-left', clientId: peer ? peer.clientId : String(handle), name: peer ? peer.name : null, rosterVersion };
+      }
+      default:
+        return { type: 'unknown', tag };
+    }
+  }
+
+  return { BINARY, PROTOCOLS, createPeerTable, encode, decode };
+})();